@@ -0,0 +1,141 @@
+"""
+Strategies for choosing between the backends that run a version
+
+Picking uniformly at random ignores how busy each backend is, so one slow
+backend (say, in a long GC pause) keeps getting its full share of requests and
+they all pile up behind it. The other strategies here look at how many requests
+each backend has outstanding, and optionally at how quickly it's been
+answering, and steer requests away from the slow ones
+"""
+
+import math
+import random
+
+import tornado.ioloop
+
+
+class RandomBalancer(object):
+
+    """
+    Pick any backend, uniformly at random
+    """
+
+    name = 'random'
+
+    def __init__(self, outstanding):
+        # outstanding(backend) -> how many requests it has in flight
+        self.outstanding = outstanding
+
+    def choose(self, backends):
+        return random.choice(backends)
+
+    def record(self, backend, latency):
+        pass
+
+    def forget(self, backend):
+        pass
+
+    def to_json(self):
+        return {'name': self.name}
+
+
+class LeastOutstandingBalancer(RandomBalancer):
+
+    """
+    Pick the backend with the fewest requests in flight, breaking ties at
+    random. This looks at every backend of the version, so it suits versions
+    with a handful of backends rather than hundreds
+    """
+
+    name = 'least_outstanding'
+
+    def choose(self, backends):
+        # start from a random place so that ties don't always go to the first
+        start = random.randrange(len(backends))
+
+        best = None
+        best_load = None
+        for i in xrange(len(backends)):
+            backend = backends[(start + i) % len(backends)]
+            load = self.outstanding(backend)
+            if best is None or load < best_load:
+                best, best_load = backend, load
+                if not load:
+                    break
+
+        return best
+
+
+class PowerOfTwoBalancer(RandomBalancer):
+
+    """
+    Pick two backends at random and use whichever has fewer requests in
+    flight. Nearly as good as least_outstanding at avoiding busy backends, in
+    constant time, and without every request herding onto the same idle one
+    """
+
+    name = 'p2c'
+
+    def choose(self, backends):
+        if len(backends) == 1:
+            return backends[0]
+
+        first, second = random.sample(backends, 2)
+        if self.load(second) < self.load(first):
+            return second
+        return first
+
+    def load(self, backend):
+        return self.outstanding(backend)
+
+
+class EwmaBalancer(PowerOfTwoBalancer):
+
+    """
+    Like p2c, but weighs each backend's outstanding requests by an
+    exponentially weighted moving average of how long it's been taking to
+    answer, with older samples decaying away over `decay` seconds. Backends we
+    haven't heard from yet look free, so they get tried straight away
+    """
+
+    name = 'ewma'
+
+    def __init__(self, outstanding, decay=10.0):
+        super(EwmaBalancer, self).__init__(outstanding)
+        self.decay = decay
+
+        # backend -> [average latency, when we last updated it]
+        self.latencies = {}
+
+    def record(self, backend, latency):
+        now = tornado.ioloop.IOLoop.current().time()
+
+        entry = self.latencies.get(backend)
+        if entry is None:
+            self.latencies[backend] = [latency, now]
+            return
+
+        average, updated = entry
+        weight = math.exp(-max(now - updated, 0) / self.decay)
+        entry[0] = average * weight + latency * (1 - weight)
+        entry[1] = now
+
+    def forget(self, backend):
+        self.latencies.pop(backend, None)
+
+    def load(self, backend):
+        entry = self.latencies.get(backend)
+        if entry is None:
+            return 0
+        return entry[0] * (self.outstanding(backend) + 1)
+
+    def to_json(self):
+        return {'name': self.name,
+                'latencies': dict(('%s:%d' % backend, round(entry[0], 6))
+                                  for (backend, entry)
+                                  in self.latencies.iteritems())}
+
+
+BALANCERS = dict((balancer.name, balancer)
+                 for balancer in (RandomBalancer, LeastOutstandingBalancer,
+                                  PowerOfTwoBalancer, EwmaBalancer))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python2.7
+
+"""
+A repeatable load test of the proxy
+
+Starts some simpleserver backends and a proxy in front of them on localhost,
+sends the proxy requests at a fixed rate (or as fast as it'll take them), and
+prints what happened as JSON: throughput, latency percentiles, and how much CPU
+and memory the proxy used doing it.
+
+    python -m exproxyment.bench --rps=1000 --concurrency=100 --duration=30 \\
+        --backend_latency=0.01 --proxy_args='--balancing=p2c'
+
+Latencies are measured from when each request was due to be sent rather than
+when it was, so a proxy that falls behind the rate shows up in the numbers
+instead of just quietly sending fewer requests
+"""
+
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.locks
+from tornado.options import define, options, parse_command_line
+
+from .drain import child_pids
+from .pool import ConnectionPools
+
+logger = logging.getLogger(__name__)
+
+define('backends', type=int, default=3,
+       help="how many simpleserver backends to start")
+define('port', type=int, default=7600,
+       help="port for the proxy. the backends get the ones after it")
+define('proxy_args', default='',
+       help="more command line arguments for the proxy")
+define('backend_latency', type=float, default=0,
+       help="seconds each backend takes over each request")
+define('backend_payload_size', type=int, default=0,
+       help="bytes of padding in each backend response")
+define('backend_error_rate', type=float, default=0,
+       help="fraction of backend responses that are 500s")
+define('path', default='/')
+define('rps', type=float, default=500,
+       help="requests per second to send (0 for as many as we can)")
+define('concurrency', type=int, default=50,
+       help="most requests to have outstanding at once")
+define('duration', type=float, default=10.0,
+       help="seconds to measure for")
+define('warmup', type=float, default=2.0,
+       help="seconds to send requests for before we start measuring")
+define('timeout', type=float, default=10.0,
+       help="seconds before we give up on a request")
+
+
+class Results(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.codes = {}
+        self.errors = 0
+
+    def to_json(self, elapsed):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1,
+                                 int(fraction * len(latencies)))]
+
+        return {'requests': len(latencies),
+                'seconds': elapsed,
+                'throughput': len(latencies) / elapsed if elapsed else None,
+                'codes': dict((str(code), count)
+                              for (code, count) in self.codes.iteritems()),
+                'errors': self.errors,
+                'latency': {
+                    'mean': (sum(latencies) / len(latencies)
+                             if latencies else None),
+                    'p50': percentile(0.5),
+                    'p99': percentile(0.99),
+                    'p999': percentile(0.999),
+                    'max': latencies[-1] if latencies else None,
+                }}
+
+
+@tornado.gen.coroutine
+def generate(pools, port, duration, results):
+    ioloop = tornado.ioloop.IOLoop.current()
+    slots = tornado.locks.Semaphore(options.concurrency)
+
+    @tornado.gen.coroutine
+    def one(due):
+        yield slots.acquire()
+        try:
+            response = yield pools.fetch('127.0.0.1', port, 'GET',
+                                         options.path,
+                                         tornado.httputil.HTTPHeaders(),
+                                         connect_timeout=options.timeout,
+                                         request_timeout=options.timeout)
+        except Exception:
+            results.errors += 1
+        else:
+            results.codes[response.code] = (
+                results.codes.get(response.code, 0) + 1)
+        finally:
+            slots.release()
+
+        results.latencies.append(ioloop.time() - due)
+
+    start = ioloop.time()
+    end = start + duration
+    requests = []
+
+    if options.rps:
+        sent = 0
+        while True:
+            now = ioloop.time()
+            if now >= end:
+                break
+
+            # send everything that's come due since we last looked
+            due = start + sent / options.rps
+            while due <= now:
+                requests.append(one(due))
+                sent += 1
+                due = start + sent / options.rps
+
+            yield tornado.gen.sleep(max(0, due - ioloop.time()))
+
+    else:
+        @tornado.gen.coroutine
+        def worker():
+            while ioloop.time() < end:
+                yield one(ioloop.time())
+
+        requests = [worker() for _ in xrange(options.concurrency)]
+
+    yield requests
+
+
+def process_tree(pid):
+    """
+    `pid` and its children, which matters when the proxy forks workers
+    """
+
+    return [pid] + child_pids(pid)
+
+
+def usage(pid):
+    """
+    (cpu seconds, rss bytes) of `pid` and its children, or None if we can't
+    tell (we read them from /proc)
+    """
+
+    if not os.path.isdir('/proc'):
+        return None
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    cpu = 0.0
+    rss = 0
+
+    for each in process_tree(pid):
+        try:
+            with open('/proc/%d/stat' % (each,)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        # utime and stime, then rss in pages (fields 14, 15 and 24 of stat,
+        # counting from the pid)
+        cpu += (int(fields[11]) + int(fields[12])) / float(ticks)
+        rss += int(fields[21]) * page_size
+
+    return cpu, rss
+
+
+def start(args):
+    logger.info("Starting %s", ' '.join(args))
+    return subprocess.Popen([sys.executable, '-m'] + args)
+
+
+def wait_until_healthy(port, deadline):
+    client = tornado.httpclient.HTTPClient()
+
+    try:
+        while time.time() < deadline:
+            try:
+                response = client.fetch('http://127.0.0.1:%d/health' % (port,),
+                                         raise_error=False)
+                if response.code == 200:
+                    return
+            except Exception:
+                pass
+            time.sleep(0.2)
+    finally:
+        client.close()
+
+    raise Exception("the proxy on port %d never got healthy" % (port,))
+
+
+def main():
+    parse_command_line()
+
+    backend_ports = range(options.port + 1, options.port + 1 + options.backends)
+    processes = []
+
+    try:
+        for port in backend_ports:
+            processes.append(start([
+                'exproxyment.simpleserver',
+                '--port=%d' % (port,),
+                '--version=bench',
+                '--latency=%s' % (options.backend_latency,),
+                '--payload_size=%d' % (options.backend_payload_size,),
+                '--error_rate=%s' % (options.backend_error_rate,),
+                '--logging=warning']))
+
+        proxy = start([
+            'exproxyment.server',
+            '--port=%d' % (options.port,),
+            '--backends=%s' % (','.join('127.0.0.1:%d' % (port,)
+                                        for port in backend_ports),),
+            '--logging=warning'] + shlex.split(options.proxy_args))
+        processes.append(proxy)
+
+        wait_until_healthy(options.port, time.time() + 30)
+
+        pools = ConnectionPools(max_idle=options.concurrency,
+                                max_total=options.concurrency)
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        if options.warmup:
+            ioloop.run_sync(lambda: generate(pools, options.port,
+                                             options.warmup, Results()))
+
+        results = Results()
+        before = usage(proxy.pid)
+        started = time.time()
+
+        ioloop.run_sync(lambda: generate(pools, options.port,
+                                         options.duration, results))
+
+        elapsed = time.time() - started
+        after = usage(proxy.pid)
+
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+
+    report = results.to_json(elapsed)
+    report['proxy'] = None
+    if before is not None and after is not None:
+        cpu = after[0] - before[0]
+        report['proxy'] = {'cpu_seconds': cpu,
+                           'cpu_percent': 100 * cpu / elapsed,
+                           'rss_bytes': after[1]}
+    report['config'] = dict((name, getattr(options, name))
+                            for name in ('backends', 'proxy_args',
+                                         'backend_latency',
+                                         'backend_payload_size',
+                                         'backend_error_rate', 'path', 'rps',
+                                         'concurrency', 'duration'))
+
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+An in-memory cache of backend responses to GETs
+
+Static assets and the like are identical for every request to the same version,
+so there's no point asking a backend for them every time. Responses are cached
+the way a shared HTTP cache would (Cache-Control, Expires and Vary), under keys
+that include the version that the request was routed to, so that different
+versions never see each other's responses. Concurrent misses for the same key
+wait for a single fetch rather than all going to the backends, and an entry
+that has only just gone stale can be served while it's refreshed in the
+background
+"""
+
+from email.utils import parsedate_tz, mktime_tz
+import logging
+import time
+
+import tornado.concurrent
+
+from .headers import normalize
+from .utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# responses that can be cached when they say how long they're good for
+CACHEABLE_CODES = frozenset([200, 203, 204, 300, 301, 404, 410])
+
+# roughly what an entry costs besides its body and headers
+ENTRY_OVERHEAD = 256
+
+
+def parse_cache_control(value):
+    """
+    'public, max-age=60' -> {'public': None, 'max-age': '60'}
+    """
+
+    directives = {}
+
+    for directive in (value or '').split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+
+    return directives
+
+
+def seconds(directives, name):
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_date(value):
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+class CacheEntry(object):
+
+    __slots__ = ('key', 'backend', 'response', 'size', 'stored', 'expires',
+                 'stale_until')
+
+    def __init__(self, key, backend, response, size, stored, expires,
+                 stale_until):
+        # what it's stored under, which depends on the request's headers if
+        # the response varies on them
+        self.key = key
+        self.backend = backend
+        self.response = response
+        self.size = size
+        self.stored = stored
+        self.expires = expires
+        self.stale_until = stale_until
+
+    def fresh(self, now):
+        return now < self.expires
+
+    def usable_stale(self, now):
+        return now < self.stale_until
+
+
+class ResponseCache(object):
+
+    """
+    Holds up to `max_bytes` of responses, none bigger than `max_object`.
+    Entries are served for up to `stale_while_revalidate` seconds after they
+    expire while we fetch a fresh copy, unless the response says otherwise
+    """
+
+    def __init__(self, max_bytes, max_object=1024 * 1024,
+                 stale_while_revalidate=0):
+        self.max_object = max_object
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self.entries = LRUCache(max_bytes, weigh=lambda entry: entry.size)
+        # (version, uri) -> the headers that its response varies on
+        self.vary = LRUCache(max(1, max_bytes // 1024))
+        # key -> Future resolving to the CacheEntry (or None) that the fetch
+        # for that key produced, for requests to wait on rather than fetch
+        self.pending = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stores = 0
+
+    def to_json(self):
+        return {'entries': len(self.entries),
+                'bytes': self.entries.weight,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'stores': self.stores,
+                'evictions': self.entries.evictions}
+
+    def cacheable_request(self, request):
+        if request.method != 'GET' or 'Authorization' in request.headers:
+            return False
+
+        directives = parse_cache_control(request.headers.get('Cache-Control'))
+        return 'no-cache' not in directives and 'no-store' not in directives
+
+    def key(self, version, uri, headers):
+        vary = self.vary.get((version, uri), ())
+        return (version, uri) + tuple(headers.get(name) for name in vary)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def wait(self, key):
+        """
+        A Future for the fetch already underway for `key`, or None
+        """
+
+        return self.pending.get(key)
+
+    def start(self, key):
+        self.pending[key] = tornado.concurrent.Future()
+
+    def finish(self, key, entry):
+        future = self.pending.pop(key, None)
+        if future is not None:
+            future.set_result(entry)
+
+    def store(self, version, uri, request_headers, backend, response, now):
+        """
+        Cache `response` if it can be. Returns its CacheEntry or None
+        """
+
+        if response.code not in CACHEABLE_CODES:
+            return None
+
+        headers = response.headers
+        if 'Set-Cookie' in headers:
+            # someone's cookie is nobody else's business
+            return None
+
+        directives = parse_cache_control(headers.get('Cache-Control'))
+        if ('no-store' in directives or 'no-cache' in directives
+                or 'private' in directives):
+            return None
+
+        vary = tuple(sorted(normalize(name)
+                            for name in headers.get('Vary', '').split(',')
+                            if name.strip()))
+        if 'Vary' in headers and (not vary or '*' in vary):
+            return None
+
+        lifetime = seconds(directives, 's-maxage')
+        if lifetime is None:
+            lifetime = seconds(directives, 'max-age')
+        if lifetime is None:
+            expires = parse_date(headers.get('Expires'))
+            if expires is None:
+                # we don't guess how long things are good for
+                return None
+            date = parse_date(headers.get('Date')) or time.time()
+            lifetime = max(0, expires - date)
+
+        # it may have been sitting in another cache before it got to us
+        try:
+            lifetime -= int(headers.get('Age', 0))
+        except ValueError:
+            pass
+
+        if lifetime <= 0:
+            return None
+
+        size = (len(response.body) + ENTRY_OVERHEAD
+                + sum(len(name) + len(value)
+                      for (name, value) in headers.get_all()))
+        if size > self.max_object:
+            return None
+
+        stale = seconds(directives, 'stale-while-revalidate')
+        if stale is None:
+            stale = self.stale_while_revalidate
+        if 'must-revalidate' in directives or 'proxy-revalidate' in directives:
+            stale = 0
+
+        self.vary.put((version, uri), vary)
+        key = self.key(version, uri, request_headers)
+
+        entry = CacheEntry(key, backend, response, size, now,
+                           now + lifetime, now + lifetime + stale)
+        self.entries.put(key, entry)
+        self.stores += 1
+
+        return entry
@@ -0,0 +1,187 @@
+"""
+Compressing responses for clients that can take them compressed
+
+Backends don't have to bother compressing anything themselves: we gzip (or,
+if the brotli module is installed, brotli) responses on the way out according
+to the client's Accept-Encoding and the response's Content-Type. Responses
+that the backend already compressed pass through untouched.
+
+Compressing a big body takes long enough to stall every other request on the
+IOLoop, so anything over `inline_length` is compressed on a small pool of
+threads instead. zlib lets go of the GIL while it works, so this really does
+run alongside the IOLoop
+"""
+
+from multiprocessing.pool import ThreadPool
+import zlib
+
+import tornado.concurrent
+import tornado.ioloop
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# besides anything text/*
+COMPRESSIBLE_TYPES = frozenset(['application/javascript',
+                                'application/x-javascript',
+                                'application/json', 'application/xml',
+                                'application/atom+xml', 'application/rss+xml',
+                                'application/xhtml+xml', 'image/svg+xml'])
+
+
+def accepted_encodings(accept_encoding):
+    """
+    'gzip;q=1.0, br, identity;q=0' -> set(['gzip', 'br'])
+    """
+
+    accepted = set()
+
+    for entry in (accept_encoding or '').split(','):
+        parts = entry.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if quality > 0:
+            accepted.add(coding)
+
+    return accepted
+
+
+def gzip_compress(body, level):
+    # 16 + MAX_WBITS gets us a gzip header and trailer rather than zlib's
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def brotli_compress(body, level):
+    # brotli's quality goes up to 11, but past about 5 it's too slow for
+    # compressing on the fly
+    return brotli.compress(body, quality=min(level, 5))
+
+
+class Compressor(object):
+
+    def __init__(self, level=6, min_length=1024, inline_length=16 * 1024,
+                 threads=2):
+        self.level = level
+        self.min_length = min_length
+        self.inline_length = inline_length
+        self.threads = threads
+
+        # started the first time we need it, since threads don't survive
+        # fork_processes
+        self.pool = None
+
+        self.encoders = {'gzip': gzip_compress}
+        if brotli is not None:
+            self.encoders['br'] = brotli_compress
+
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def to_json(self):
+        return {'encodings': sorted(self.encoders),
+                'compressed': self.compressed,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out}
+
+    def compressible(self, response):
+        """
+        Whether `response` is the sort of thing that we'd compress for a
+        client that can take it
+        """
+
+        headers = response.headers
+
+        if response.code in (204, 206, 304) or 'Content-Range' in headers:
+            # no body, or only part of one
+            return False
+
+        if 'Content-Encoding' in headers:
+            # the backend did it already
+            return False
+
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+
+        content_type = headers.get('Content-Type', '').split(';')[0].strip()
+        return (content_type.startswith('text/')
+                or content_type in COMPRESSIBLE_TYPES)
+
+    def encoding_for(self, request, response):
+        """
+        What to compress `response` to `request` with, or None to leave it
+        """
+
+        if request.method == 'HEAD' or len(response.body) < self.min_length:
+            return None
+
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+
+        # brotli does better than gzip, so take it when we can
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and encoding in self.encoders:
+                return encoding
+
+        return None
+
+    def compress(self, body, encoding):
+        """
+        A Future resolving to `body` compressed with `encoding`
+        """
+
+        self.compressed += 1
+        self.bytes_in += len(body)
+
+        future = tornado.concurrent.Future()
+        encoder = self.encoders[encoding]
+
+        if len(body) <= self.inline_length:
+            # not worth the trip to another thread
+            self.done(future, encoder(body, self.level))
+            return future
+
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        level = self.level
+
+        def work():
+            # python 2's pools have no error callback, so failures come back
+            # as results
+            try:
+                return True, encoder(body, level)
+            except Exception as e:
+                return False, e
+
+        def callback(result):
+            ioloop.add_callback(self.finished, future, result)
+
+        self.pool.apply_async(work, callback=callback)
+
+        return future
+
+    def finished(self, future, result):
+        ok, value = result
+        if ok:
+            self.done(future, value)
+        else:
+            future.set_exception(value)
+
+    def done(self, future, compressed):
+        self.bytes_out += len(compressed)
+        future.set_result(compressed)
@@ -14,7 +14,13 @@ define('backends', default='')
 define('show', default=False, type=bool)
 define('add', default=None, type=str)
 define('remove', default=None, type=str)
+define('ttl', default=None, type=float,
+       help="with --add, seconds until the backends are deregistered unless"
+            " they're added again")
 define('weights', default='')
+define('limits', default=None, type=str,
+       help="timeouts and in-flight limits to change, as JSON. the ones left"
+            " out stay as they are")
 define('server', default='localhost:7000')
 define('health', default=False, type=bool)
 define('activity', default=False, type=bool)
@@ -47,7 +53,7 @@ def main():
 
     parse_command_line()
 
-    if options.backends or options.weights:
+    if options.backends or options.weights or options.limits:
         config = {}
 
         if options.backends:
@@ -56,15 +62,21 @@ def main():
         if options.weights:
             config['weights'] = parse_weights(options.weights)
 
-        configure('/exproxyment/configure', config)
+        if options.limits:
+            config['limits'] = json.loads(options.limits)
 
-    if options.add:
-        config = {'backends': parse_backends(options.add)}
-        configure('/exproxyment/register', config)
+        configure('/exproxyment/configure', config)
 
-    if options.remove:
-        config = {'backends': parse_backends(options.remove)}
-        configure('/exproxyment/deregister', config)
+    if options.add or options.remove:
+        # both at once, so that nothing is routed to one without the other
+        config = {}
+        if options.add:
+            config['add'] = parse_backends(options.add)
+        if options.remove:
+            config['remove'] = parse_backends(options.remove)
+        if options.ttl:
+            config['ttl'] = options.ttl
+        configure('/exproxyment/backends', config)
 
     if options.show:
         ret = configure('/exproxyment/configure')
@@ -74,6 +86,7 @@ def main():
         else:
             print 'backends:', unparse_backends(ret['backends'])
             print 'weights:', unparse_weights(ret['weights'])
+            print 'limits:', json.dumps(ret['limits'], sort_keys=True)
 
     if options.health:
         ret = configure('/health')
@@ -81,11 +94,19 @@ def main():
             print json.dumps(ret)
         else:
             for backend in ret['backends']:
-                print '%s:%d(%s): %s' % (
+                print '%s:%d(%s): %s%s%s%s' % (
                     backend['host'], backend['port'],
                     backend['version'] or 'unknown',
                     'healthy' if backend['healthy'] else 'unhealthy',
+                    ' (ejected)' if backend.get('ejected') else '',
+                    ' (draining)' if backend.get('draining') else '',
+                    (' (lease %ds)' % (backend['lease'],)
+                     if backend.get('lease') is not None else ''),
                 )
+            if 'balancing' in ret:
+                print 'balancing:', ret['balancing']['name']
+            if 'generation' in ret:
+                print 'generation:', ret['generation']
 
         if not ret['healthy']:
             # TODO right now configure() will bail with an exception before we
@@ -104,6 +125,13 @@ def main():
                     backend['host'], backend['port'],
                     activity['uri'],
                 )
+            if ret.get('next_offset') is not None:
+                print '... %d in flight in all' % (ret['total'],)
+            for pool in ret['pools']:
+                print 'pool %s:%d: %d active, %d idle, %d waiting' % (
+                    pool['host'], pool['port'],
+                    pool['active'], pool['idle'], pool['waiting'],
+                )
 
     sys.exit(exit_status)
 
@@ -0,0 +1,171 @@
+"""
+Stopping and restarting without dropping anyone's requests
+
+On SIGTERM we stop accepting connections, stop keeping the ones we have alive,
+and exit once the requests that we're in the middle of have finished (or we've
+waited long enough for them). SIGHUP does the same, but first starts a new
+copy of the proxy with our arguments and hands it our listening sockets, so
+that connections that arrive while we're draining queue up for the new one
+rather than being refused. That's how to upgrade the proxy without any
+downtime.
+
+The new copy gets the same arguments that we did, and keeps everything that's
+been changed through /exproxyment/configure since we started, weights
+included. So reconfigure a running proxy through that, not with SIGHUP. To
+change its arguments, stop it and start it again with the new ones: with a
+--state_file it picks up where it left off, except that a --weights that it's
+given wins over the saved weights.
+
+The new process finds the sockets through the environment, as
+'fd:family,fd:family', along with a file holding our state (see persist.py) so
+that it can route requests as soon as it starts rather than after its first
+round of health checks
+"""
+
+import fcntl
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+import tornado.gen
+import tornado.ioloop
+from tornado.platform.auto import set_close_exec
+
+from .persist import read_state, write_state
+
+logger = logging.getLogger(__name__)
+
+LISTEN_FDS = 'EXPROXYMENT_LISTEN_FDS'
+HANDOFF_STATE = 'EXPROXYMENT_HANDOFF_STATE'
+
+
+def inherited_sockets():
+    """
+    The listening sockets that the process we're taking over from handed us,
+    or None if it didn't
+    """
+
+    value = os.environ.pop(LISTEN_FDS, None)
+    if not value:
+        return None
+
+    sockets = []
+
+    for each in value.split(','):
+        fd, family = [int(part) for part in each.split(':')]
+
+        # fromfd gives us a duplicate, so we don't need the original
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+        sockets.append(sock)
+
+    return sockets
+
+
+def inherited_state():
+    """
+    The state that the process we're taking over from handed us, or None
+    """
+
+    path = os.environ.pop(HANDOFF_STATE, None)
+    if not path:
+        return None
+
+    state = read_state(path)
+
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    return state
+
+
+def hand_off(sockets, module, state=None):
+    """
+    Start `python -m module` with our arguments, handing it `sockets` and, if
+    we have it, `state`
+    """
+
+    for sock in sockets:
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+    env = dict(os.environ)
+    env[LISTEN_FDS] = ','.join('%d:%d' % (sock.fileno(), sock.family)
+                               for sock in sockets)
+
+    if state is not None:
+        fd, path = tempfile.mkstemp(prefix='exproxyment-', suffix='.json')
+        os.close(fd)
+        try:
+            write_state(path, state)
+        except (IOError, OSError) as e:
+            logger.warn("Couldn't hand over our state (%s)", e)
+        else:
+            env[HANDOFF_STATE] = path
+
+    try:
+        process = subprocess.Popen([sys.executable, '-m', module]
+                                   + sys.argv[1:], env=env)
+    finally:
+        for sock in sockets:
+            set_close_exec(sock.fileno())
+
+    logger.info("Handed our listening sockets to pid %d", process.pid)
+
+    return process
+
+
+def child_pids(pid):
+    """
+    The processes whose parent is `pid` (from /proc, so only where there is
+    one)
+    """
+
+    children = []
+
+    if not os.path.isdir('/proc'):
+        return children
+
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % (entry,)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+
+    return children
+
+
+@tornado.gen.coroutine
+def drain(server, in_flight, timeout, poll=0.1):
+    """
+    Stop `server` accepting connections and keeping them alive, and wait up to
+    `timeout` seconds for the requests holding (or waiting for) slots in
+    `in_flight` to finish. Returns whether they all did
+    """
+
+    server.stop()
+    # connections are closed after the request that they're on now, if any
+    server.conn_params.no_keep_alive = True
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    deadline = ioloop.time() + timeout
+
+    while in_flight.active or in_flight.waiters:
+        if ioloop.time() >= deadline:
+            raise tornado.gen.Return(False)
+        yield tornado.gen.sleep(poll)
+
+    raise tornado.gen.Return(True)
@@ -0,0 +1,136 @@
+"""
+The requests that we're waiting on backends for right now
+
+Every proxied request is added here when we send it to a backend and removed
+when it comes back, so both have to be cheap. Each request gets a small record
+in a slot of a list, with freed slots reused, and running counts per backend
+and per version are kept as we go so that nobody has to walk the table to find
+out how busy a backend is
+"""
+
+import random
+
+
+class InFlightRequest(object):
+
+    __slots__ = ('id', 'slot', 'source_host', 'method', 'uri', 'version',
+                 'backend', 'started')
+
+    def __init__(self, id, slot, source_host, method, uri, version, backend,
+                 started):
+        self.id = id
+        self.slot = slot
+        self.source_host = source_host
+        self.method = method
+        # just the path and query, the backend says where it's going
+        self.uri = uri
+        self.version = version
+        self.backend = backend
+        self.started = started
+
+    def to_json(self):
+        return {'id': self.id,
+                'source_host': self.source_host,
+                'method': self.method,
+                'backend': self.backend.to_json(),
+                'version': self.version,
+                'uri': 'http://%s:%d%s' % (self.backend.host,
+                                           self.backend.port,
+                                           self.uri),
+                'started': self.started}
+
+
+class InFlightTable(object):
+
+    def __init__(self):
+        # InFlightRequests, or None for free slots
+        self.slots = []
+        self.free = []
+        self.next_id = 0
+
+        self.by_backend = {}
+        self.by_version = {}
+
+    def __len__(self):
+        return len(self.slots) - len(self.free)
+
+    def add(self, source_host, method, uri, version, backend, started):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.slots)
+            self.slots.append(None)
+
+        self.next_id += 1
+        request = InFlightRequest(self.next_id, slot, source_host, method, uri,
+                                  version, backend, started)
+        self.slots[slot] = request
+
+        self.by_backend[backend] = self.by_backend.get(backend, 0) + 1
+        self.by_version[version] = self.by_version.get(version, 0) + 1
+
+        return request
+
+    def remove(self, request):
+        if (request.slot >= len(self.slots)
+                or self.slots[request.slot] is not request):
+            return
+
+        self.slots[request.slot] = None
+        self.free.append(request.slot)
+
+        self.decrement(self.by_backend, request.backend)
+        self.decrement(self.by_version, request.version)
+
+        if len(self.free) == len(self.slots):
+            # everything's finished, so start packing from the front again
+            # rather than keeping the list at its high water mark
+            del self.slots[:]
+            del self.free[:]
+
+    @staticmethod
+    def decrement(counts, key):
+        count = counts[key] - 1
+        if count:
+            counts[key] = count
+        else:
+            del counts[key]
+
+    def outstanding(self, backend):
+        return self.by_backend.get(backend, 0)
+
+    def page(self, offset=0, limit=100):
+        """
+        Up to `limit` requests from the slots from `offset` on, and the offset
+        to ask for the next page from (None if there isn't one)
+        """
+
+        requests = []
+        slot = max(offset, 0)
+        while slot < len(self.slots) and len(requests) < limit:
+            if self.slots[slot] is not None:
+                requests.append(self.slots[slot])
+            slot += 1
+
+        return requests, (slot if slot < len(self.slots) else None)
+
+    def sample(self, count):
+        """
+        Up to `count` requests picked at random
+        """
+
+        if not self.slots:
+            return []
+
+        found = {}
+
+        # most slots are full most of the time, so a few random probes are
+        # much cheaper than listing the whole table
+        for _ in xrange(count * 4):
+            request = self.slots[random.randrange(len(self.slots))]
+            if request is not None:
+                found[request.id] = request
+                if len(found) >= count:
+                    break
+
+        return found.values()
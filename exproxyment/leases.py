@@ -0,0 +1,82 @@
+"""
+Backends that only stay registered for as long as they keep saying so
+
+Autoscaled backends register themselves with a time to live and then keep
+registering again (heartbeating) well within it. One that dies stops
+heartbeating, its lease runs out, and it's removed without anyone having to
+deregister it
+"""
+
+import heapq
+
+
+class Leases(object):
+
+    def __init__(self):
+        # backend -> when its lease runs out
+        self.expiry = {}
+        # (expiry, backend), for finding the expired ones without looking at
+        # every lease. entries that have since been renewed or revoked are
+        # skipped when they come up
+        self.heap = []
+
+        self.expired_count = 0
+        # bumped by every grant, renewals included, which don't otherwise
+        # change anything that's watched for changes (see persist.py)
+        self.grants = 0
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def __contains__(self, backend):
+        return backend in self.expiry
+
+    def grant(self, backend, ttl, now):
+        """
+        Lease `backend` for `ttl` seconds from `now`, replacing any lease that
+        it already had
+        """
+
+        expires = now + ttl
+        self.expiry[backend] = expires
+        heapq.heappush(self.heap, (expires, backend))
+        self.grants += 1
+
+    def revoke(self, backend):
+        self.expiry.pop(backend, None)
+
+    def remaining(self, backend, now):
+        """
+        Seconds left on `backend`'s lease, or None if it doesn't have one
+        """
+
+        expires = self.expiry.get(backend)
+        if expires is None:
+            return None
+        return max(0, expires - now)
+
+    def expired(self, now):
+        """
+        Revoke and return the backends whose leases have run out
+        """
+
+        expired = []
+
+        while self.heap and self.heap[0][0] <= now:
+            expires, backend = heapq.heappop(self.heap)
+            if self.expiry.get(backend) == expires:
+                del self.expiry[backend]
+                expired.append(backend)
+
+        if len(self.heap) > 2 * len(self.expiry) + 64:
+            # heartbeats leave a lot of superseded entries behind
+            self.heap = [(expires, backend)
+                         for (backend, expires) in self.expiry.iteritems()]
+            heapq.heapify(self.heap)
+
+        self.expired_count += len(expired)
+        return expired
+
+    def to_json(self):
+        return {'leased': len(self.expiry),
+                'expired': self.expired_count}
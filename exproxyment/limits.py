@@ -0,0 +1,192 @@
+"""
+Timeouts and limits on how much work we send to the backends at once
+
+Without these an overloaded version just piles up more and more waiting
+requests. Instead each backend (and the proxy as a whole) has a limit on
+requests in flight, requests over the limit wait in line for a short time, and
+anything still waiting after that is turned away straight away with a 503
+"""
+
+from collections import deque
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+
+class Limiter(object):
+
+    """
+    Counts requests in flight against a limit that can change at any time. A
+    limit of None means no limit
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.active = 0
+        self.waiters = deque()
+        self.shed = 0
+
+    def to_json(self):
+        return {'limit': self.limit,
+                'active': self.active,
+                'waiting': len(self.waiters),
+                'shed': self.shed}
+
+    def available(self):
+        return self.limit is None or self.active < self.limit
+
+    @tornado.gen.coroutine
+    def acquire(self, timeout):
+        """
+        Take a slot, waiting up to `timeout` seconds for one to free up.
+        Returns whether we got one
+        """
+
+        if self.available() and not self.waiters:
+            self.active += 1
+            raise tornado.gen.Return(True)
+
+        if not timeout:
+            self.shed += 1
+            raise tornado.gen.Return(False)
+
+        waiter = tornado.concurrent.Future()
+        self.waiters.append(waiter)
+
+        try:
+            # release() hands its slot directly to the waiter
+            yield tornado.gen.with_timeout(
+                tornado.ioloop.IOLoop.current().time() + timeout,
+                waiter)
+        except tornado.gen.TimeoutError:
+            if waiter.done():
+                # release() handed us its slot after we'd timed out but
+                # before we got to run. it's ours now, so we have to use it
+                # (and release it) or it's gone for good
+                raise tornado.gen.Return(True)
+
+            try:
+                self.waiters.remove(waiter)
+            except ValueError:
+                pass
+            self.shed += 1
+            raise tornado.gen.Return(False)
+
+        raise tornado.gen.Return(True)
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self.wake()
+
+    def wake(self):
+        while self.waiters and self.available():
+            self.active += 1
+            self.waiters.popleft().set_result(None)
+
+
+class Limits(object):
+
+    """
+    The timeouts and in-flight limits we proxy with. The timeouts are in
+    seconds and can be overridden for requests whose paths start with one of
+    the prefixes in `routes`. A value of None means no limit
+    """
+
+    TIMEOUTS = ('connect_timeout', 'first_byte_timeout', 'total_timeout')
+    LIMITS = ('max_in_flight', 'max_in_flight_per_backend', 'queue_timeout')
+
+    def __init__(self, connect_timeout=5.0, first_byte_timeout=20.0,
+                 total_timeout=None, max_in_flight=None,
+                 max_in_flight_per_backend=None, queue_timeout=0.1,
+                 routes=None):
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.total_timeout = total_timeout
+        # as on the command line, 0 in flight means no limit rather than
+        # turning everything away
+        self.max_in_flight = max_in_flight or None
+        self.max_in_flight_per_backend = max_in_flight_per_backend or None
+        self.queue_timeout = queue_timeout
+
+        # path prefix -> {timeout name: value}, longest prefixes first
+        self.routes = sorted((routes or {}).items(),
+                             key=lambda (prefix, overrides): -len(prefix))
+
+    def timeouts_for(self, path):
+        """
+        The (connect, first byte, total) timeouts for a request to `path`
+        """
+
+        timeouts = dict((name, getattr(self, name))
+                        for name in self.TIMEOUTS)
+
+        for prefix, overrides in self.routes:
+            if path.startswith(prefix):
+                timeouts.update(overrides)
+                break
+
+        return tuple(timeouts[name] for name in self.TIMEOUTS)
+
+    def to_json(self):
+        js = dict((name, getattr(self, name))
+                  for name in self.TIMEOUTS + self.LIMITS)
+        js['routes'] = dict(self.routes)
+        return js
+
+    @staticmethod
+    def valid(value):
+        return value is None or (not isinstance(value, bool)
+                                 and isinstance(value, (int, long, float))
+                                 and value >= 0)
+
+    @classmethod
+    def from_json(cls, js):
+        """
+        Build Limits from JSON like that returned by to_json, raising
+        ValueError if it's malformed. Anything left out gets the default
+        """
+
+        if not isinstance(js, dict):
+            raise ValueError(js)
+
+        for name, value in js.items():
+            if name == 'routes':
+                continue
+            if name not in cls.TIMEOUTS + cls.LIMITS:
+                raise ValueError(name)
+            if not cls.valid(value):
+                raise ValueError(name)
+
+        routes = js.get('routes')
+        if routes is None:
+            routes = {}
+        if not isinstance(routes, dict):
+            raise ValueError('routes')
+
+        for prefix, overrides in routes.items():
+            if not (isinstance(overrides, dict)
+                    and all(name in cls.TIMEOUTS and cls.valid(value)
+                            for (name, value) in overrides.items())):
+                raise ValueError(prefix)
+
+        kwargs = dict((str(name), value) for (name, value) in js.items())
+        return cls(**kwargs)
+
+    def updated(self, js):
+        """
+        These Limits with the ones in `js` (JSON like that returned by
+        to_json) changed, raising ValueError if it's malformed. Anything left
+        out stays as it is, except that "routes" replaces all of the routes
+        """
+
+        if not isinstance(js, dict):
+            raise ValueError(js)
+
+        merged = self.to_json()
+        merged.update(js)
+        return self.from_json(merged)
@@ -0,0 +1,266 @@
+"""
+Counters and latency histograms in the Prometheus text format
+
+The point of running two versions side by side is comparing them, so
+everything here is labelled by version and backend. Recording happens on every
+proxied request, so it's kept cheap: each (version, backend) gets one object
+with preallocated fixed-bucket histograms, and recording a request is a dict
+lookup and some additions
+"""
+
+from bisect import bisect_left
+
+# upper bounds in seconds. the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # one more than the bounds for everything over the last one
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%s"} %d'
+                         % (name, labels, bound, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels, repr(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels, self.count))
+
+        return lines
+
+
+class UpstreamMetrics(object):
+
+    """
+    What we've seen of the requests that we sent to one backend for one
+    version
+    """
+
+    __slots__ = ('codes', 'errors', 'retries', 'bytes_in', 'bytes_out',
+                 'latency')
+
+    def __init__(self):
+        # status code -> how many responses had it
+        self.codes = {}
+        # requests that didn't get a response at all
+        self.errors = 0
+        # requests we gave up on here and retried elsewhere
+        self.retries = 0
+        # request bytes sent to the backend, and response bytes it sent back
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+
+class HealthMetrics(object):
+
+    OUTCOMES = ('healthy', 'unhealthy', 'errors')
+    # a full check, one that it didn't have to parse a response for (the
+    # backend said 304, or sent the Etag that it sent last time), or just a
+    # connect
+    KINDS = ('full', 'cached', 'connect')
+
+    __slots__ = OUTCOMES + KINDS + ('seconds', 'bytes')
+
+    def __init__(self):
+        self.healthy = 0
+        self.unhealthy = 0
+        self.errors = 0
+
+        self.full = 0
+        self.cached = 0
+        self.connect = 0
+
+        # what checking on it has cost us
+        self.seconds = 0.0
+        self.bytes = 0
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def backend_label(backend):
+    return '%s:%d' % (backend.host, backend.port)
+
+
+def render_counters(name, description, counts):
+    """
+    Lines for some unlabelled counters, given (name, count) pairs and patterns
+    to put each name into
+    """
+
+    lines = []
+
+    for counter, count in counts:
+        lines.append('# HELP %s %s' % (name % (counter,),
+                                        description % (counter,)))
+        lines.append('# TYPE %s counter' % (name % (counter,),))
+        lines.append('%s %d' % (name % (counter,), count))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+
+    def __init__(self):
+        # status code we sent the client -> how many times
+        self.requests = {}
+        # (version, backend) -> UpstreamMetrics
+        self.upstreams = {}
+        # backend -> HealthMetrics
+        self.health = {}
+
+    def request(self, code):
+        self.requests[code] = self.requests.get(code, 0) + 1
+
+    def upstream(self, version, backend):
+        key = (version, backend)
+
+        metrics = self.upstreams.get(key)
+        if metrics is None:
+            metrics = self.upstreams[key] = UpstreamMetrics()
+
+        return metrics
+
+    def response(self, version, backend, code, latency, bytes_in=0,
+                 bytes_out=0):
+        metrics = self.upstream(version, backend)
+
+        metrics.codes[code] = metrics.codes.get(code, 0) + 1
+        metrics.latency.observe(latency)
+        metrics.bytes_in += bytes_in
+        metrics.bytes_out += bytes_out
+
+    def error(self, version, backend, bytes_in=0):
+        metrics = self.upstream(version, backend)
+
+        metrics.errors += 1
+        metrics.bytes_in += bytes_in
+
+    def retry(self, version, backend):
+        self.upstream(version, backend).retries += 1
+
+    def health_check(self, backend, healthy, error=False, kind='full',
+                     seconds=0.0, size=0):
+        metrics = self.health.get(backend)
+        if metrics is None:
+            metrics = self.health[backend] = HealthMetrics()
+
+        if error:
+            metrics.errors += 1
+        elif healthy:
+            metrics.healthy += 1
+        else:
+            metrics.unhealthy += 1
+
+        setattr(metrics, kind, getattr(metrics, kind) + 1)
+        metrics.seconds += seconds
+        metrics.bytes += size
+
+    def forget(self, backend):
+        for key in [key for key in self.upstreams if key[1] == backend]:
+            del self.upstreams[key]
+        self.health.pop(backend, None)
+
+    def render(self):
+        lines = []
+
+        upstreams = sorted(
+            ((version, backend_label(backend), metrics)
+             for ((version, backend), metrics) in self.upstreams.iteritems()),
+            key=lambda (version, backend, metrics): (version, backend))
+
+        def labels(version, backend):
+            return 'version="%s",backend="%s"' % (escape(version),
+                                                  escape(backend))
+
+        lines.append('# HELP exproxyment_requests_total Requests from clients'
+                     ' by the status code we answered with')
+        lines.append('# TYPE exproxyment_requests_total counter')
+        for code, count in sorted(self.requests.iteritems()):
+            lines.append('exproxyment_requests_total{code="%d"} %d'
+                         % (code, count))
+
+        lines.append('# HELP exproxyment_upstream_responses_total Responses'
+                     ' from backends by status code')
+        lines.append('# TYPE exproxyment_upstream_responses_total counter')
+        for version, backend, metrics in upstreams:
+            for code, count in sorted(metrics.codes.iteritems()):
+                lines.append(
+                    'exproxyment_upstream_responses_total{%s,code="%d"} %d'
+                    % (labels(version, backend), code, count))
+
+        for name, attr, description in (
+                ('exproxyment_upstream_errors_total', 'errors',
+                 'Requests to backends that got no response'),
+                ('exproxyment_upstream_retries_total', 'retries',
+                 'Requests retried on another backend after this one failed'),
+                ('exproxyment_upstream_request_bytes_total', 'bytes_in',
+                 'Request body bytes sent to backends'),
+                ('exproxyment_upstream_response_bytes_total', 'bytes_out',
+                 'Response body bytes received from backends')):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % (name,))
+            for version, backend, metrics in upstreams:
+                lines.append('%s{%s} %d' % (name, labels(version, backend),
+                                            getattr(metrics, attr)))
+
+        name = 'exproxyment_upstream_latency_seconds'
+        lines.append('# HELP %s Time for backends to respond' % (name,))
+        lines.append('# TYPE %s histogram' % (name,))
+        for version, backend, metrics in upstreams:
+            lines.extend(metrics.latency.render(name,
+                                                labels(version, backend)))
+
+        name = 'exproxyment_health_checks_total'
+        lines.append('# HELP %s Health checks by outcome' % (name,))
+        lines.append('# TYPE %s counter' % (name,))
+        health = sorted((escape(backend_label(backend)), metrics)
+                        for (backend, metrics) in self.health.iteritems())
+        for backend, metrics in health:
+            for outcome in HealthMetrics.OUTCOMES:
+                lines.append('%s{backend="%s",outcome="%s"} %d'
+                             % (name, backend, outcome,
+                                getattr(metrics, outcome)))
+
+        name = 'exproxyment_health_probes_total'
+        lines.append('# HELP %s Health checks by how much checking they took'
+                     % (name,))
+        lines.append('# TYPE %s counter' % (name,))
+        for backend, metrics in health:
+            for kind in HealthMetrics.KINDS:
+                lines.append('%s{backend="%s",kind="%s"} %d'
+                             % (name, backend, kind, getattr(metrics, kind)))
+
+        for name, attr, description, pattern in (
+                ('exproxyment_health_probe_seconds_total', 'seconds',
+                 'Time spent checking on backends', '%s{backend="%s"} %.6f'),
+                ('exproxyment_health_probe_bytes_total', 'bytes',
+                 'Health check response bytes from backends',
+                 '%s{backend="%s"} %d')):
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % (name,))
+            for backend, metrics in health:
+                lines.append(pattern % (name, backend, getattr(metrics, attr)))
+
+        return '\n'.join(lines) + '\n'
@@ -31,8 +31,9 @@ def multijob(jobs):
         del pids[diedfirst]
 
     for pid, job in pids.items():
-        logging.info('killing %r', job)
-        os.kill(pid, signal.SIGINT)
+        # SIGTERM rather than SIGINT so that proxies finish what they're doing
+        logging.info('stopping %r', job)
+        os.kill(pid, signal.SIGTERM)
 
     while pids:
         logging.debug('waiting on %r more jobs: %r',
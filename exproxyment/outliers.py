@@ -0,0 +1,95 @@
+"""
+Passive health checking from the outcomes of real proxied requests
+
+The HealthDaemon only notices a backend dying on its next check, and in the
+meantime real users keep getting sent to it. The OutlierDetector watches every
+proxied request instead and ejects backends that fail too many of them, so that
+a dying backend only costs a few requests
+"""
+
+import logging
+
+import tornado.ioloop
+
+from .utils import SlidingCounts
+
+logger = logging.getLogger(__name__)
+
+
+class BackendOutcomes(object):
+
+    __slots__ = ('consecutive_errors', 'counts')
+
+    REQUESTS, ERRORS = 0, 1
+
+    def __init__(self, window, now):
+        self.consecutive_errors = 0
+        self.counts = SlidingCounts(window, now)
+
+
+class OutlierDetector(object):
+
+    """
+    Ejects a backend that fails `consecutive_errors` requests in a row, or at
+    least `error_rate` of at least `min_requests` requests over the last
+    `window` seconds. `eject` is called with the backend and the
+    `ejection_time` and returns whether the backend was actually ejected.
+    Setting `consecutive_errors` or `error_rate` to 0 turns off that rule
+    """
+
+    def __init__(self, eject, consecutive_errors=5, error_rate=0.5,
+                 min_requests=20, window=10.0, ejection_time=30.0):
+        self.eject = eject
+        self.consecutive_errors = consecutive_errors
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.ejection_time = ejection_time
+
+        self.outcomes = {}
+        self.ejections = 0
+
+    def record(self, backend, ok):
+        now = tornado.ioloop.IOLoop.current().time()
+
+        outcomes = self.outcomes.get(backend)
+        if outcomes is None:
+            outcomes = self.outcomes[backend] = BackendOutcomes(self.window,
+                                                                now)
+
+        outcomes.counts.add(now, outcomes.REQUESTS)
+
+        if ok:
+            outcomes.consecutive_errors = 0
+            return
+
+        outcomes.counts.add(now, outcomes.ERRORS)
+        outcomes.consecutive_errors += 1
+
+        reason = self.check(outcomes, now)
+        if reason is None:
+            return
+
+        if self.eject(backend, self.ejection_time):
+            self.ejections += 1
+            logger.warn("Ejecting %r for %.0fs (%s)",
+                        backend, self.ejection_time, reason)
+
+            # it starts with a clean slate when it comes back
+            del self.outcomes[backend]
+
+    def check(self, outcomes, now):
+        if (self.consecutive_errors
+                and outcomes.consecutive_errors >= self.consecutive_errors):
+            return '%d errors in a row' % (outcomes.consecutive_errors,)
+
+        if self.error_rate:
+            requests, errors = outcomes.counts.totals(now)
+            if (requests >= self.min_requests
+                    and errors >= self.error_rate * requests):
+                return '%.0f of %.0f requests failed' % (errors, requests)
+
+        return None
+
+    def forget(self, backend):
+        self.outcomes.pop(backend, None)
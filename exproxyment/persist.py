@@ -0,0 +1,115 @@
+"""
+Saving our state to a file so that a restart doesn't start from nothing
+
+Without this a restarted proxy only knows the backends that it was given on
+the command line, knows nothing about their health, and 504s everything until
+the health checks have caught up. Backends that registered themselves are
+lost altogether. So the leader writes its backends, their last known health
+and versions, and the weights to a file whenever they've changed, and main()
+loads that at startup as a first guess that the health checks then confirm or
+correct.
+
+The file is compact JSON, written to a temporary file and renamed into place
+so that a crash halfway through a write never leaves a truncated one behind
+"""
+
+import json
+import logging
+import os
+import time
+
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+
+def read_state(path):
+    """
+    What was saved in `path`, or None if there's nothing usable there
+    """
+
+    try:
+        with open(path) as f:
+            js = json.load(f)
+    except IOError as e:
+        logger.info("No saved state to load from %s (%s)", path, e)
+        return None
+    except ValueError as e:
+        logger.warn("Ignoring the unreadable saved state in %s (%s)", path, e)
+        return None
+
+    if not (isinstance(js, dict) and isinstance(js.get('backends'), list)):
+        logger.warn("Ignoring the malformed saved state in %s", path)
+        return None
+
+    return js
+
+
+def write_state(path, js):
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+
+    try:
+        with open(temporary, 'w') as f:
+            json.dump(js, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+
+
+class StateSaver(object):
+
+    """
+    Write `state` to `path` every `interval` seconds, if it's changed since
+    we last did. Renewing a lease doesn't change the state's generation, since
+    requests go to the same places, but it does change what we'd save
+    """
+
+    def __init__(self, state, path, interval=5.0, ioloop=None):
+        self.state = state
+        self.path = path
+
+        self.saved_generation = None
+        self.saved_grants = None
+        self.saves = 0
+        self.failures = 0
+
+        self.periodic = PeriodicCallback(self.save, interval * 1000, ioloop)
+
+    def start(self):
+        self.periodic.start()
+
+    def stop(self):
+        self.periodic.stop()
+
+    def save(self, force=False):
+        generation = self.state.generation
+        grants = self.state.leases.grants
+        if (generation == self.saved_generation
+                and grants == self.saved_grants and not force):
+            return
+
+        js = self.state.to_json()
+        js['saved_at'] = time.time()
+
+        try:
+            write_state(self.path, js)
+        except (IOError, OSError) as e:
+            self.failures += 1
+            logger.warn("Couldn't save our state to %s (%s)", self.path, e)
+            return
+
+        self.saved_generation = generation
+        self.saved_grants = grants
+        self.saves += 1
+
+    def to_json(self):
+        return {'path': self.path,
+                'generation': self.saved_generation,
+                'saves': self.saves,
+                'failures': self.failures}
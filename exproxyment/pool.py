@@ -0,0 +1,374 @@
+"""
+Persistent keep-alive HTTP/1.1 connections to backends
+
+tornado's simple AsyncHTTPClient opens a new TCP connection for every fetch,
+which costs a connect round trip on every proxied request and burns through
+ephemeral ports under load. Instead we keep a small pool of idle connections to
+each backend and reuse them
+"""
+
+from collections import namedtuple, deque
+import logging
+import sys
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.tcpclient
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+
+logger = logging.getLogger(__name__)
+
+# methods that are safe to send again if we aren't sure that the first one got
+# through
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class PooledResponse(namedtuple('PooledResponse',
+                                'code reason headers body')):
+    pass
+
+
+class ResponseDelegate(tornado.httputil.HTTPMessageDelegate):
+
+    """
+    Collects a response from an HTTP1Connection, handing it off to the caller's
+    callbacks as it arrives if they gave us any
+    """
+
+    def __init__(self, header_callback=None, streaming_callback=None):
+        self.header_callback = header_callback
+        self.streaming_callback = streaming_callback
+
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+
+    def headers_received(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers
+
+        if self.header_callback is not None:
+            return self.header_callback(start_line, headers)
+
+    def data_received(self, chunk):
+        if self.streaming_callback is not None:
+            # if this returns a Future the connection waits on it before
+            # reading any more, which gives us backpressure
+            return self.streaming_callback(chunk)
+
+        self.chunks.append(chunk)
+
+
+class BackendPool(object):
+
+    """
+    The connections we hold open to a single backend
+    """
+
+    def __init__(self, host, port, max_idle, max_total, idle_timeout,
+                 on_empty=None):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.on_empty = on_empty
+
+        # most recently used last, so that we reuse the warmest connections and
+        # let the coldest ones time out
+        self.idle = deque()
+        self.active = 0
+        self.waiting = 0
+        self.slots = tornado.locks.Semaphore(max_total)
+
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+
+    def to_json(self):
+        return {'host': self.host,
+                'port': self.port,
+                'active': self.active,
+                'idle': len(self.idle),
+                'waiting': self.waiting,
+                'created': self.created,
+                'reused': self.reused,
+                'closed': self.closed}
+
+    @tornado.gen.coroutine
+    def checkout(self, connect_timeout):
+        while self.idle:
+            stream, timeout = self.idle.pop()
+            tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+            stream.set_close_callback(None)
+
+            if not stream.closed():
+                self.reused += 1
+                raise tornado.gen.Return((stream, True))
+
+            self.closed += 1
+
+        connect = tornado.tcpclient.TCPClient().connect(self.host, self.port)
+        if connect_timeout:
+            connect = tornado.gen.with_timeout(
+                tornado.ioloop.IOLoop.current().time() + connect_timeout,
+                connect,
+                quiet_exceptions=(tornado.iostream.StreamClosedError,))
+
+        try:
+            stream = yield connect
+        except tornado.gen.TimeoutError:
+            raise tornado.httpclient.HTTPError(599, 'Timeout while connecting')
+
+        stream.set_nodelay(True)
+        self.created += 1
+
+        raise tornado.gen.Return((stream, False))
+
+    def checkin(self, stream):
+        if stream.closed() or len(self.idle) >= self.max_idle:
+            self.close(stream)
+            return
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        timeout = ioloop.call_later(self.idle_timeout, self.expire, stream)
+        entry = (stream, timeout)
+
+        # an idle stream with a close callback is watched for the backend
+        # hanging up on us, so we notice that before we try to reuse it
+        stream.set_close_callback(lambda: self.discard(entry))
+        self.idle.append(entry)
+
+    def discard(self, entry):
+        try:
+            self.idle.remove(entry)
+        except ValueError:
+            return
+
+        stream, timeout = entry
+        tornado.ioloop.IOLoop.current().remove_timeout(timeout)
+        self.close(stream)
+
+        self.maybe_empty()
+
+    def expire(self, stream):
+        for entry in self.idle:
+            if entry[0] is stream:
+                self.discard(entry)
+                return
+
+    def maybe_empty(self):
+        if (not self.idle and not self.active and not self.waiting
+                and self.on_empty is not None):
+            self.on_empty(self)
+
+    @tornado.gen.coroutine
+    def fetch(self, method, path, headers, body=None, body_producer=None,
+              header_callback=None, streaming_callback=None,
+              connect_timeout=None, first_byte_timeout=None,
+              request_timeout=None, limited=True):
+        now = tornado.ioloop.IOLoop.current().time()
+
+        # waiting for a connection to free up counts against the timeouts, so
+        # a backend that's saturated can't hold on to its callers forever
+        deadline = None
+        if request_timeout:
+            deadline = now + request_timeout
+
+        if limited:
+            # and until we have a connection, we're still connecting
+            connected_by = connect_timeout and now + connect_timeout
+            waits = [wait for wait in (deadline, connected_by) if wait]
+            wait_until = min(waits) if waits else None
+
+            self.waiting += 1
+            try:
+                yield self.slots.acquire(timeout=wait_until)
+            except tornado.gen.TimeoutError:
+                raise tornado.httpclient.HTTPError(
+                    599, 'Timeout waiting for a connection')
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+        try:
+            response = yield self.exchange(method, path, headers, body,
+                                           body_producer, header_callback,
+                                           streaming_callback,
+                                           connect_timeout,
+                                           first_byte_timeout,
+                                           deadline)
+        finally:
+            self.active -= 1
+            if limited:
+                self.slots.release()
+            self.maybe_empty()
+
+        raise tornado.gen.Return(response)
+
+    @tornado.gen.coroutine
+    def exchange(self, method, path, headers, body, body_producer,
+                 header_callback, streaming_callback, connect_timeout,
+                 first_byte_timeout, deadline):
+        ioloop = tornado.ioloop.IOLoop.current()
+
+        for attempt in (1, 2):
+            stream, reused = yield self.checkout(connect_timeout)
+            delegate = ResponseDelegate(header_callback, streaming_callback)
+
+            # timing out just means hanging up on the backend, which makes
+            # whatever we were doing with the connection fail
+            timed_out = []
+
+            def time_out(reason, stream=stream, delegate=delegate):
+                if reason == 'first byte' and delegate.start_line is not None:
+                    return
+                timed_out.append(reason)
+                stream.close()
+
+            timeouts = []
+            if deadline is not None:
+                timeouts.append(ioloop.call_at(deadline, time_out, 'total'))
+
+            def sent(time_out=time_out, timeouts=timeouts):
+                # the backend can't be expected to answer before it has the
+                # whole request, and a big upload can take a while to send
+                if first_byte_timeout:
+                    timeouts.append(ioloop.call_later(first_byte_timeout,
+                                                      time_out, 'first byte'))
+
+            try:
+                keep_alive = yield self.send(stream, method, path, headers,
+                                             body, body_producer, delegate,
+                                             bool(streaming_callback), sent)
+
+            except tornado.iostream.StreamClosedError:
+                self.close(stream)
+
+                if timed_out:
+                    raise tornado.httpclient.HTTPError(
+                        599, 'Timeout (%s)' % (timed_out[0],))
+
+                if (attempt == 1 and reused and body_producer is None
+                        and delegate.start_line is None
+                        and method in IDEMPOTENT_METHODS):
+                    # the backend closed an idle connection just as we picked
+                    # it up. that's not their failure, so try once more on a
+                    # fresh one. we can't tell whether it got the request
+                    # first, though, so only if it's safe to send again
+                    logger.debug("Reused connection to %s:%d was closed",
+                                 self.host, self.port)
+                    continue
+
+                raise
+
+            except:
+                self.close(stream)
+                raise
+
+            finally:
+                for timeout in timeouts:
+                    ioloop.remove_timeout(timeout)
+
+            break
+
+        if keep_alive:
+            self.checkin(stream)
+        else:
+            self.close(stream)
+
+        raise tornado.gen.Return(PooledResponse(
+            code=delegate.start_line.code,
+            reason=delegate.start_line.reason,
+            headers=delegate.headers,
+            body=b''.join(delegate.chunks)))
+
+    def close(self, stream):
+        self.closed += 1
+        stream.close()
+
+    @tornado.gen.coroutine
+    def send(self, stream, method, path, headers, body, body_producer,
+             delegate, streaming, sent=None):
+        if 'Host' not in headers:
+            headers['Host'] = '%s:%d' % (self.host, self.port)
+
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+
+        params = HTTP1ConnectionParameters(
+            decompress=False,
+            # a streamed body never sits in memory, so don't limit it
+            max_body_size=sys.maxsize if streaming else None)
+        connection = HTTP1Connection(stream, True, params,
+                                     (self.host, self.port))
+
+        start_line = tornado.httputil.RequestStartLine(method, path,
+                                                       'HTTP/1.1')
+        connection.write_headers(start_line, headers)
+
+        if body is not None:
+            connection.write(body)
+        elif body_producer is not None:
+            yield body_producer(connection.write)
+
+        connection.finish()
+        if sent is not None:
+            sent()
+
+        keep_alive = yield connection.read_response(delegate)
+
+        raise tornado.gen.Return(keep_alive and not stream.closed())
+
+
+class ConnectionPools(object):
+
+    """
+    A BackendPool for each backend that we talk to
+    """
+
+    def __init__(self, max_idle=16, max_total=256, idle_timeout=60.0):
+        self.max_idle = max_idle
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+
+        self.pools = {}
+
+    def pool_for(self, host, port):
+        pool = self.pools.get((host, port))
+
+        if pool is None:
+            pool = self.pools[(host, port)] = BackendPool(
+                host, port,
+                max_idle=self.max_idle,
+                max_total=self.max_total,
+                idle_timeout=self.idle_timeout,
+                on_empty=self.remove)
+
+        return pool
+
+    def remove(self, pool):
+        # forget about backends we aren't talking to anymore, so that a fleet
+        # that churns through backends doesn't leave pools around forever
+        if self.pools.get((pool.host, pool.port)) is pool:
+            del self.pools[(pool.host, pool.port)]
+
+    def fetch(self, host, port, method, path, headers, **kwargs):
+        """
+        Make a request to host:port over a pooled connection. Returns a Future
+        that resolves to a PooledResponse regardless of the response code, or
+        fails if we couldn't get a response at all. If a streaming_callback is
+        given then the body is passed to it instead of returned. Requests that
+        aren't `limited` don't count against (or wait for) max_total, which is
+        for health checks that have to get through to a saturated backend
+        """
+
+        return self.pool_for(host, port).fetch(method, path, headers,
+                                               **kwargs)
+
+    def to_json(self):
+        return sorted((pool.to_json() for pool in self.pools.values()),
+                      key=lambda x: (x['host'], x['port']))
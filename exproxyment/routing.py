@@ -0,0 +1,115 @@
+"""
+Immutable snapshots of everything that routing a request looks at
+
+ServerState's backends and weights change underneath running requests: a
+reconfiguration can swap out thousands of backends, and health checks finish
+whenever they finish. Rather than have requests read those while they're being
+changed, every change is recorded in ServerState and the next request to come
+along gets a new RoutingTable built from all of them at once. A request takes
+the current table once and routes from it alone, so it never sees a
+reconfiguration half applied.
+
+Tables are copy-on-write: a new one shares the backend lists and hash rings of
+every version that didn't change with the table before it
+"""
+
+from .utils import HashRing, WeightedChoice
+
+
+class RoutingTable(object):
+
+    """
+    The backends (and their states) as of `generation`, the healthy backends
+    of each version, and the version weights. Nothing here changes once it's
+    built, except that the tables derived from it are built the first time
+    they're needed
+    """
+
+    __slots__ = ('generation', 'backends', 'version_backends', 'versions',
+                 'weights', 'version_choice', 'version_ring', 'backend_rings')
+
+    def __init__(self, generation, backends, version_backends, weights,
+                 previous=None, changed_versions=()):
+        self.generation = generation
+        # backend -> BackendState
+        self.backends = backends
+        # version -> tuple of the healthy backends running it
+        self.version_backends = version_backends
+        # the versions that have at least one healthy backend
+        self.versions = frozenset(version_backends)
+        self.weights = weights
+
+        # the tables place_user draws from
+        self.version_choice = None
+        self.version_ring = None
+        # version -> consistent hash ring of its backends
+        self.backend_rings = {}
+
+        if previous is not None:
+            if (previous.weights == weights
+                    and previous.versions == self.versions):
+                self.version_choice = previous.version_choice
+                self.version_ring = previous.version_ring
+
+            for version, ring in previous.backend_rings.iteritems():
+                if version not in changed_versions:
+                    self.backend_rings[version] = ring
+
+    def to_json(self):
+        return {'generation': self.generation,
+                'versions': sorted(self.versions),
+                'backends': dict((version, len(backends))
+                                 for (version, backends)
+                                 in self.version_backends.iteritems())}
+
+    def healthy(self, for_version=None):
+        if for_version is None:
+            return bool(self.versions)
+        return for_version in self.versions
+
+    def backend_for(self, balancer, version, key=None, exclude=None):
+        backends = self.version_backends.get(version)
+        if not backends:
+            return None
+
+        if exclude:
+            # we only get here when retrying, so it's okay to be slow
+            backends = [backend for backend in backends
+                        if backend not in exclude]
+            return balancer.choose(backends) if backends else None
+
+        if key is None:
+            return balancer.choose(backends)
+
+        ring = self.backend_rings.get(version)
+        if ring is None:
+            ring = self.backend_rings[version] = HashRing(
+                (backend, 1) for backend in backends)
+        return ring.get(key)
+
+    def choose_version(self):
+        """
+        Pick one of the available versions at random according to the weights
+        """
+
+        if self.version_choice is None:
+            self.version_choice = WeightedChoice(
+                (version, self.weights.get(version, 0))
+                for version in sorted(self.versions))
+
+        return self.version_choice.choose()
+
+    def hash_version(self, key):
+        """
+        Like choose_version but always gives the same answer for the same key
+        as long as the weights and available versions stay the same, and
+        mostly the same answer when they change
+        """
+
+        if self.version_ring is None:
+            self.version_ring = HashRing(
+                ((version, self.weights.get(version, 0))
+                 for version in sorted(self.versions)),
+                points=1000)
+
+        return self.version_ring.get(key)
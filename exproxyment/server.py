@@ -1,30 +1,218 @@
 #!/usr/bin/env python2.7
 
 from collections import namedtuple
+import atexit
+import heapq
 import logging
+import os
 import random
 import json
-import urllib
+import shutil
+import signal
+import tempfile
+import time
 
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 import tornado.gen
-import tornado.httpclient
 import tornado.httputil
+import tornado.iostream
+import tornado.locks
+import tornado.queues
+import tornado.tcpclient
 from tornado.ioloop import PeriodicCallback
 from tornado.options import define, options, parse_command_line
 
 from .utils import parse_backends, parse_weights
 from .utils import unparse_backends, unparse_weights
+from .utils import RetryBudget, VersionCookies
+from .pool import ConnectionPools, IDEMPOTENT_METHODS
+from .routing import RoutingTable
+from .sync import SyncLeader, SyncFollower
+from .leases import Leases
+from .persist import StateSaver, read_state
+from .drain import child_pids, drain, hand_off, inherited_sockets
+from .drain import inherited_state
+from .outliers import OutlierDetector
+from .limits import Limits, Limiter
+from .balancing import BALANCERS, RandomBalancer
+from .metrics import Metrics, render_counters
+from .inflight import InFlightTable
+from .headers import HeaderPolicy, parse_header_names, parse_header_values
+from .cache import ResponseCache
+from .singleflight import SingleFlight
+from .compression import Compressor
+from .tuning import files_needed, raise_file_limit, tune_listening_sockets
+from .tuning import TunedHTTPServer
 
 logger = logging.getLogger(__name__)
 
 define('port', type=int, default=7000)
+define('num_processes', type=int, default=1,
+       help="how many processes to serve from (0 means one per CPU)")
 define('backends', default='')
 define('cookie_domain', default=None)
 define('weights', default='')
 define('soft_sticky', type=bool, default=True)
 define('hard_sticky', type=bool, default=False)
+define('compact_cookies', type=bool, default=False,
+       help="write version cookies as v1:<version> instead of as JSON. both"
+            " are always accepted")
+define('hash_sticky', default='',
+       help="place users by consistent-hashing these parts of the request:"
+            " 'ip' and/or header names, comma separated")
+define('streaming', type=bool, default=False,
+       help="pass request and response bodies through as they arrive"
+            " instead of buffering them")
+define('health_interval', type=float, default=5.0,
+       help="seconds between checks on a healthy backend")
+define('health_fast_interval', type=float, default=1.0,
+       help="seconds between checks on a backend that is new, has just"
+            " changed, or has just gone down")
+define('health_max_interval', type=float, default=30.0,
+       help="the longest to back off to between checks on a backend that"
+            " stays down")
+define('health_connect_checks', type=int, default=0,
+       help="how many checks on a healthy backend in a row can just connect"
+            " to it, rather than asking it for its health and version")
+define('health_concurrency', type=int, default=20,
+       help="how many health checks to run at once")
+define('health_timeout', type=float, default=0.5,
+       help="seconds to wait for a backend to answer a health check")
+define('state_file', default='',
+       help="file to save the backends, their health and the weights in, and"
+            " to pick them up from again when we restart")
+define('state_save_interval', type=float, default=5.0,
+       help="seconds between saving our state to --state_file, when it's"
+            " changed")
+define('state_max_age', type=float, default=300.0,
+       help="seconds after which the health saved in --state_file is too old"
+            " to start with, and we wait for fresh health checks instead")
+define('drain_timeout', type=float, default=30.0,
+       help="seconds to wait for requests in flight to finish when we're"
+            " stopped (SIGTERM) or restarted (SIGHUP)")
+define('backend_drain_timeout', type=float, default=30.0,
+       help="seconds that a deregistered backend gets to finish its requests"
+            " in flight before it's removed (0 to remove it straight away)")
+define('lease_check_interval', type=float, default=1.0,
+       help="seconds between looking for backends whose registration leases"
+            " have run out")
+define('outlier_consecutive_errors', type=int, default=5,
+       help="eject a backend after this many proxied requests to it fail in"
+            " a row (0 to disable)")
+define('outlier_error_rate', type=float, default=0.5,
+       help="eject a backend when this fraction of its proxied requests fail"
+            " (0 to disable)")
+define('outlier_min_requests', type=int, default=20,
+       help="only apply --outlier_error_rate with at least this many requests"
+            " in the window")
+define('outlier_window', type=float, default=10.0,
+       help="seconds of requests that --outlier_error_rate looks at")
+define('outlier_ejection_time', type=float, default=30.0,
+       help="seconds to keep an ejected backend out. it comes back then if"
+            " its health checks are passing, or once they are")
+define('outlier_max_ejected', type=float, default=0.5,
+       help="the most of the backends that can be ejected at once")
+define('remove_request_headers', default='',
+       help="comma separated headers to strip from requests to the backends")
+define('add_request_headers', default='',
+       help="comma separated Name:value headers to add to requests to the"
+            " backends")
+define('remove_response_headers', default='',
+       help="comma separated headers to strip from responses to clients")
+define('add_response_headers', default='',
+       help="comma separated Name:value headers to add to responses to"
+            " clients")
+define('forwarded_headers', type=bool, default=True,
+       help="tell the backends who the client was with X-Forwarded-For and"
+            " Forwarded")
+define('balancing', default='random',
+       help="how to choose between the backends of a version: one of %s"
+            % (', '.join(sorted(BALANCERS)),))
+define('balancing_decay', type=float, default=10.0,
+       help="seconds over which old latencies fade out of the ewma balancer's"
+            " averages")
+define('max_retries', type=int, default=2,
+       help="how many other backends to try an idempotent request on when"
+            " we can't get a response from the first")
+define('retry_budget_ratio', type=float, default=0.1,
+       help="retries may add up to at most this fraction of requests")
+define('retry_budget_min', type=float, default=10.0,
+       help="retries per second to allow regardless of the ratio")
+define('connect_timeout', type=float, default=5.0,
+       help="seconds to wait to connect to a backend")
+define('first_byte_timeout', type=float, default=20.0,
+       help="seconds to wait for a backend to start responding, once it"
+            " has the whole request")
+define('total_timeout', type=float, default=0,
+       help="seconds to allow for a whole backend request (0 for no limit)")
+define('max_in_flight', type=int, default=0,
+       help="requests to allow in flight through the whole proxy at once"
+            " (0 for no limit)")
+define('max_in_flight_per_backend', type=int, default=0,
+       help="requests to allow in flight to each backend at once"
+            " (0 for no limit)")
+define('queue_timeout', type=float, default=0.1,
+       help="seconds that a request over the in-flight limits waits for a"
+            " slot before we give up on it with a 503")
+define('backlog', type=int, default=128,
+       help="connections the kernel queues for us before we accept them")
+define('reuse_port', type=bool, default=False,
+       help="set SO_REUSEPORT, so that separately started proxies can share"
+            " the port")
+define('tcp_fastopen', type=int, default=0,
+       help="pending TCP Fast Open connections to allow (0 to turn it off)")
+define('client_nodelay', type=bool, default=False,
+       help="turn off Nagle's algorithm on client connections")
+define('client_idle_timeout', type=float, default=60.0,
+       help="seconds to keep an idle client keep-alive connection open")
+define('max_client_connections', type=int, default=0,
+       help="client connections to allow open at once, refusing any more"
+            " (0 for no limit). also sizes our open file limit")
+define('pool_max_idle', type=int, default=16,
+       help="idle keep-alive connections to hold open to each backend")
+define('pool_max_total', type=int, default=256,
+       help="connections to allow to each backend at once. requests beyond"
+            " this wait for a connection to free up")
+define('pool_idle_timeout', type=float, default=60.0,
+       help="seconds to hold an idle backend connection open")
+define('cache_size', type=int, default=0,
+       help="bytes of cacheable GET responses to keep in memory (0 to not"
+            " cache). not available with --streaming")
+define('cache_max_object', type=int, default=1024 * 1024,
+       help="bytes in the largest response that we'll cache")
+define('cache_stale_while_revalidate', type=float, default=0,
+       help="seconds after a cached response expires that we'll keep serving"
+            " it while we fetch a fresh one, for responses that don't say")
+define('singleflight_prefixes', default='',
+       help="comma separated path prefixes under which identical concurrent"
+            " GETs share one backend fetch. only for paths whose responses"
+            " don't depend on who's asking. not available with --streaming")
+define('compress', type=bool, default=False,
+       help="gzip (or brotli, if it's installed) responses for clients that"
+            " accept it. not available with --streaming")
+define('compress_level', type=int, default=6,
+       help="how hard to compress, from 1 to 9")
+define('compress_min_length', type=int, default=1024,
+       help="bytes in the smallest response worth compressing")
+define('compress_threads', type=int, default=2,
+       help="threads to compress large responses on, off the IOLoop")
+define('stream_queue_chunks', type=int, default=4,
+       help="how many chunks of a streamed request body to buffer before"
+            " pushing back on the client")
+
+# methods whose request bodies of unknown length tornado sends to the backend
+# chunked. when streaming any other method's, we do the chunking ourselves
+CHUNKED_METHODS = frozenset(['POST', 'PUT', 'PATCH'])
+
+# what a streamed request body's queue gets if the client hangs up part way
+# through it, so that the backend isn't left waiting for the rest
+BODY_ABORTED = object()
+
+# how often we look for draining backends that have finished their requests
+DRAIN_CHECK_INTERVAL = 0.25
 
 
 class BackendState(namedtuple('BackendState', 'healthy version')):
@@ -57,135 +245,754 @@ class Backend(namedtuple('Backend', 'host port')):
                 'port': self.port}
 
 
-class ActiveRequest(namedtuple('ActiveRequest', ('source_host', 'uri',
-                                                 'backend'))):
-
-    def to_json(self):
-        return {'source_host': self.source_host,
-                'backend': self.backend.to_json(),
-                'uri': self.uri}
-
-
 class ServerState(object):
 
     def __init__(self, backends=None, weights=None):
-        self.backends = backends or {}
+        self.backends = {}
+        self.requests = InFlightTable()
+        self.pools = ConnectionPools()
+        self.outliers = OutlierDetector(self.eject)
+        self.retry_budget = RetryBudget()
+        self.metrics = Metrics()
+        self.version_cookies = VersionCookies()
+        # a ResponseCache if we're caching responses
+        self.cache = None
+        # a SingleFlight if we're sharing fetches between identical requests
+        self.flights = None
+        # a Compressor if we're compressing responses
+        self.compressor = None
+        # the TunedHTTPServer that clients connect to
+        self.server = None
+        # a StateSaver if we're saving our state for the next time we start
+        self.saver = None
+        # set once we've been told to stop, while we finish what we're doing
+        self.stopping = False
+
+        self.limits = Limits()
+        # requests in flight across the whole proxy, and to each backend
+        self.in_flight = Limiter()
+        self.backend_limiters = {}
+
+        # how we choose between the backends of a version
+        self.balancer = RandomBalancer(self.outstanding)
+
+        # backend -> when it can come back, for backends that we've taken out
+        # of routing because they've been failing requests. at most
+        # max_ejected of the backends can be out at once. each process goes by
+        # the requests that it proxied itself, so with several processes these
+        # aren't shared through sync.py: a backend that's failing everyone's
+        # requests is soon ejected by all of them anyway
+        self.ejected = {}
+        self.max_ejected = 0.5
+
+        # the backends that registered with a time to live
+        self.leases = Leases()
+        # backend -> when we'll stop waiting for it, for backends that have
+        # been deregistered but still have requests in flight. they get no new
+        # requests, and are removed once the ones they have are done
+        self.draining = {}
+        # backend -> our generation once it started draining, for telling
+        # which of the other processes' reports on it are new enough (see
+        # sync.py)
+        self.drain_generations = {}
+
+        # set when we're running as one of several processes (see sync.py)
+        self.sync = None
+        # called whenever the backends or weights change
+        self.change_listeners = []
+
+        # the backends of each version that requests can be routed to right
+        # now (healthy and not ejected), kept current by everything that
+        # changes self.backends, and what's changed since we last published
+        # a RoutingTable
+
+        # version -> set of its routable backends
+        self.version_members = {}
+        # backend -> its version, for the routable ones
+        self.routable = {}
+        # versions whose members have changed since the last publish
+        self.changed_versions = set()
+        # whether anything at all has changed since the last publish
+        self.stale = False
+
+        # bumped by every change, so that processes can tell which of them
+        # are up to date (see sync.py)
+        self.generation = 0
+        self._routing = RoutingTable(self.generation, {}, {}, {})
+
         self.weights = weights or {}
-        self.requests = set()
-
-    def backend_for(self, version):
-        backends = [backend
-                    for (backend, state) in self.backends.iteritems()
-                    if state.version == version]
-        if backends:
-            return random.choice(backends)
-        return None
+
+        for backend, state in (backends or {}).iteritems():
+            self.set_backend_state(backend, state)
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @weights.setter
+    def weights(self, weights):
+        self._weights = dict(weights)
+        self.stale = True
+        self.changed()
+
+    @property
+    def routing(self):
+        """
+        The RoutingTable that requests should route from. Route each request
+        from a single one of these, rather than asking for it again halfway
+        through
+        """
+
+        if self.stale:
+            self.publish()
+        return self._routing
+
+    def publish(self):
+        """
+        Build a RoutingTable with all of the changes since the last one
+        """
+
+        previous = self._routing
+        changed_versions = self.changed_versions
+
+        version_backends = dict(previous.version_backends)
+        for version in changed_versions:
+            members = self.version_members.get(version)
+            if members:
+                version_backends[version] = tuple(members)
+            else:
+                version_backends.pop(version, None)
+
+        self._routing = RoutingTable(self.generation, dict(self.backends),
+                                     version_backends, self._weights,
+                                     previous=previous,
+                                     changed_versions=changed_versions)
+
+        self.changed_versions = set()
+        self.stale = False
+
+    def changed(self):
+        self.generation += 1
+        self.stale = True
+
+        for listener in self.change_listeners:
+            listener()
+
+    def backend_for(self, version, key=None, exclude=None):
+        return self.routing.backend_for(self.balancer, version, key, exclude)
 
     def healthy(self, for_version=None):
-        return any(state.healthy
-                   for backend, state in self.backends.iteritems()
-                   if for_version is None or for_version == state.version)
+        return self.routing.healthy(for_version)
 
     def available_versions(self):
-        return set(state.version for state in self.backends.values()
-                   if state.healthy)
+        return self.routing.versions
 
     def available_backends(self):
         return [backend for (backend, state) in self.backends.items()
                 if state.healthy]
 
+    def set_backend_state(self, backend, state):
+        oldstate = self.backends.get(backend)
+        self.backends[backend] = state
+
+        if oldstate == state:
+            return
+
+        self._unindex(backend)
+        self._index(backend, state)
+
+        self.changed()
+
+    def set_limits(self, limits):
+        self.limits = limits
+
+        self.in_flight.set_limit(limits.max_in_flight)
+        for limiter in self.backend_limiters.values():
+            limiter.set_limit(limits.max_in_flight_per_backend)
+
+        self.changed()
+
+    def backend_limiter(self, backend):
+        limiter = self.backend_limiters.get(backend)
+
+        if limiter is None:
+            limiter = self.backend_limiters[backend] = Limiter(
+                self.limits.max_in_flight_per_backend)
+
+        return limiter
+
+    def outstanding(self, backend):
+        return self.requests.outstanding(backend)
+
+    def eject(self, backend, duration):
+        """
+        Take a backend out of routing for `duration` seconds because it's been
+        failing real requests. After that it comes back as soon as it's
+        healthy, which it may already be. Returns whether it was ejected
+        """
+
+        state = self.backends.get(backend)
+
+        if state is None or backend in self.ejected:
+            return False
+
+        if len(self.ejected) + 1 > self.max_ejected * len(self.backends):
+            logger.warn("Not ejecting %r, too many backends are already out",
+                        backend)
+            return False
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        until = self.ejected[backend] = ioloop.time() + duration
+        self._unindex(backend)
+
+        # on a timer rather than on its next health check, since only the
+        # leader runs those and they only tell the others about changes
+        ioloop.call_at(until, self.readmit, backend, until)
+
+        self.changed()
+
+        return True
+
+    def readmit(self, backend, until):
+        if self.ejected.get(backend) != until:
+            # it's been removed (and maybe ejected again) since
+            return
+
+        logger.info("Readmitting %r", backend)
+        del self.ejected[backend]
+
+        state = self.backends[backend]
+        if state.healthy:
+            self._index(backend, state)
+            self.changed()
+
+    def _index(self, backend, state):
+        if not (state.healthy and state.version):
+            return
+
+        if backend in self.ejected or backend in self.draining:
+            return
+
+        self.version_members.setdefault(state.version, set()).add(backend)
+        self.routable[backend] = state.version
+        self.changed_versions.add(state.version)
+
+    def _unindex(self, backend):
+        version = self.routable.pop(backend, None)
+        if version is None:
+            return
+
+        members = self.version_members[version]
+        members.discard(backend)
+        if not members:
+            del self.version_members[version]
+        self.changed_versions.add(version)
+
     def set_backends(self, backends):
         # make sure to inherit the previous state if we already knew about this
         # server, otherwise re-adding an existing backend will wipe out all of
         # the health checks we know about and we'll start returning 504s
 
-        current_backends = self.backends
-        self.backends = {}
+        backends = set(backends)
+
+        for backend in self.backends.keys():
+            if backend not in backends:
+                self.remove_backend(backend)
 
         for backend in backends:
-            self.backends[backend] = current_backends.get(backend,
-                                                          BackendState(None, None))
+            self.add_backend(backend)
 
     def add_backend(self, backend):
-        self.backends[backend] = self.backends.get(backend,
-                                                   BackendState(None, None))
+        if backend not in self.backends:
+            self.set_backend_state(backend, BackendState(None, None))
 
     def remove_backend(self, backend):
         if backend in self.backends:
             del self.backends[backend]
+            self._unindex(backend)
+            self.ejected.pop(backend, None)
+            self.draining.pop(backend, None)
+            self.drain_generations.pop(backend, None)
+            self.leases.revoke(backend)
+            self.outliers.forget(backend)
+            self.backend_limiters.pop(backend, None)
+            self.balancer.forget(backend)
+            self.metrics.forget(backend)
+            self.changed()
+
+    def drain_backend(self, backend, timeout):
+        """
+        Stop sending new requests to `backend`, and remove it once the ones it
+        has are done or after `timeout` seconds, whichever comes first
+        """
+
+        if backend not in self.backends:
+            return
+
+        if not timeout:
+            self.remove_backend(backend)
+            return
+
+        if backend in self.draining:
+            return
+
+        now = tornado.ioloop.IOLoop.current().time()
+        self.draining[backend] = now + timeout
+        self._unindex(backend)
+
+        self.changed()
+        self.drain_generations[backend] = self.generation
+
+    def undrain(self, backend):
+        if self.draining.pop(backend, None) is not None:
+            del self.drain_generations[backend]
+            self._index(backend, self.backends[backend])
+            self.changed()
+
+    def drained(self, now):
+        """
+        The draining backends that are done, or that we're done waiting for
+        """
+
+        return [backend for (backend, until) in self.draining.iteritems()
+                if now >= until or not self.busy(backend)]
+
+    def busy(self, backend):
+        """
+        Whether any process might still have requests in flight to `backend`
+        """
+
+        if self.outstanding(backend):
+            return True
+
+        if self.sync is not None:
+            others = self.sync.outstanding(backend,
+                                           self.drain_generations[backend])
+            # not having heard from them counts as busy
+            return others is None or others > 0
+
+        return False
+
+    def apply_change(self, change):
+        """
+        Apply a configuration change described by a JSON object, as built by
+        change_state()
+        """
+
+        op = change['op']
+        backends = [Backend(entry['host'], entry['port'])
+                    for entry in change.get('backends', ())]
+
+        if op == 'set_backends':
+            self.set_backends(backends)
+
+        elif op == 'add_backends':
+            for backend in backends:
+                self.add_backend(backend)
+
+        elif op == 'remove_backends':
+            for backend in backends:
+                self.remove_backend(backend)
+
+        elif op == 'update_backends':
+            # a batch of registrations and deregistrations, which requests
+            # only ever see all of
+            now = tornado.ioloop.IOLoop.current().time()
+            drain = change.get('drain', 0)
+
+            for entry in change.get('remove', ()):
+                self.drain_backend(Backend(entry['host'], entry['port']),
+                                   drain)
+
+            for entry in change.get('add', ()):
+                backend = Backend(entry['host'], entry['port'])
+                self.add_backend(backend)
+                self.undrain(backend)
+                if entry.get('ttl'):
+                    self.leases.grant(backend, entry['ttl'], now)
+                else:
+                    self.leases.revoke(backend)
+
+        elif op == 'set_weights':
+            self.weights = change['weights']
+
+        elif op == 'set_limits':
+            self.set_limits(Limits.from_json(change['limits']))
+
+        elif op == 'reconfigure':
+            # any of the above at once. requests route from a RoutingTable
+            # with either none of it or all of it
+            limits = None
+            if 'limits' in change:
+                limits = Limits.from_json(change['limits'])
+
+            if 'backends' in change:
+                self.set_backends(backends)
+            if 'weights' in change:
+                self.weights = change['weights']
+            if limits is not None:
+                self.set_limits(limits)
+
+        else:
+            raise ValueError("unknown change %r" % (op,))
+
+    def to_json(self):
+        now = tornado.ioloop.IOLoop.current().time()
+
+        return {'backends': [{'host': backend.host,
+                              'port': backend.port,
+                              'healthy': state.healthy,
+                              'version': state.version,
+                              'lease': self.leases.remaining(backend, now),
+                              'draining': (max(0, self.draining[backend] - now)
+                                           if backend in self.draining
+                                           else None)}
+                             for (backend, state)
+                             in self.backends.iteritems()],
+                'weights': self.weights,
+                'limits': self.limits.to_json(),
+                'generation': self.generation}
+
+    def load_json(self, js):
+        """
+        Replace our backends (including their health) and weights with those
+        from another ServerState's to_json(). Requests don't see any of it
+        until all of it has been loaded
+        """
+
+        states = dict((Backend(entry['host'], entry['port']),
+                       BackendState(entry['healthy'], entry['version']))
+                      for entry in js['backends'])
+
+        self.set_backends(states.keys())
+        for backend, state in states.iteritems():
+            self.set_backend_state(backend, state)
+
+        now = tornado.ioloop.IOLoop.current().time()
+        for entry in js['backends']:
+            backend = Backend(entry['host'], entry['port'])
+            if entry.get('lease') is not None:
+                self.leases.grant(backend, entry['lease'], now)
+            else:
+                self.leases.revoke(backend)
+            if entry.get('draining') is not None:
+                self.drain_backend(backend, entry['draining'])
+            else:
+                self.undrain(backend)
+
+        self.weights = js['weights']
+
+        if 'limits' in js:
+            self.set_limits(Limits.from_json(js['limits']))
+
+        if 'generation' in js:
+            # so that every process calls the same state by the same number
+            self.generation = js['generation']
+
+    def restore_json(self, js, now, max_age, weights=True):
+        """
+        Add the backends from a to_json() that was saved to disk to the ones
+        that we were started with, and take its weights if `weights`. We also
+        take the health it saved, unless that's more than `max_age` seconds
+        old, so that we can route requests before the first round of health
+        checks
+        """
+
+        age = max(0, now - js.get('saved_at', 0))
+
+        # read all of it before we change anything, in case it's bad
+        restoring = []
+        for entry in js['backends']:
+            backend = Backend(entry['host'], entry['port'])
+
+            if entry.get('draining') is not None:
+                # it was on its way out
+                continue
+
+            state = None
+            if age <= max_age and entry.get('healthy') is not None:
+                state = BackendState(entry['healthy'], entry['version'])
+
+            lease = entry.get('lease')
+            if lease is not None:
+                lease -= age
+                if lease <= 0:
+                    # it would have been deregistered by now
+                    continue
+
+            restoring.append((backend, state, lease))
+
+        weights = js.get('weights') if weights else None
+        if weights is not None:
+            validate_weights_json(weights)
+
+        for backend, state, lease in restoring:
+            self.add_backend(backend)
+            if state is not None:
+                self.set_backend_state(backend, state)
+            if lease is not None:
+                self.leases.grant(backend, lease, now)
+
+        if weights is not None:
+            self.weights = weights
+
+        return len(restoring)
 
 
 # TODO need this global state to live somewhere. it's set in main()
 server_state = ServerState()
 
 
+def change_state(op, backends=None, weights=None, limits=None, add=None,
+                 remove=None, drain=None):
+    """
+    Change the backends or weights of this process and, if we're running
+    several, of the others too. `add` is a list of (backend, ttl) to register
+    and `remove` a list of backends to deregister, after up to `drain`
+    seconds of finishing their requests, for update_backends
+    """
+
+    change = {'op': op}
+    if backends is not None:
+        change['backends'] = [backend.to_json() for backend in backends]
+    if add is not None:
+        change['add'] = [dict(backend.to_json(), ttl=ttl)
+                         for (backend, ttl) in add]
+    if remove is not None:
+        change['remove'] = [backend.to_json() for backend in remove]
+    if drain:
+        change['drain'] = drain
+    if weights is not None:
+        change['weights'] = weights
+    if limits is not None:
+        change['limits'] = limits.to_json()
+
+    server_state.apply_change(change)
+
+    if server_state.sync is not None:
+        server_state.sync.forward(change)
+
+
+def expire_leases():
+    """
+    Deregister the backends that have stopped renewing their leases
+    """
+
+    now = tornado.ioloop.IOLoop.current().time()
+    expired = server_state.leases.expired(now)
+
+    if expired:
+        logger.warn("Deregistering %d backends whose leases ran out: %r",
+                    len(expired), expired)
+        change_state('update_backends', remove=expired)
+
+
+def finish_draining():
+    """
+    Remove the draining backends that have finished their requests
+    """
+
+    now = tornado.ioloop.IOLoop.current().time()
+    drained = server_state.drained(now)
+
+    if drained:
+        logger.info("Finished draining %r", drained)
+        change_state('update_backends', remove=drained)
+
+
+@tornado.gen.coroutine
+def shut_down(sockets=None):
+    """
+    Finish the requests in flight and stop, first handing `sockets` to a new
+    copy of ourselves if we're given them
+    """
+
+    if server_state.stopping:
+        return
+    server_state.stopping = True
+
+    if server_state.saver is not None:
+        # so that whoever starts next starts from where we are now
+        server_state.saver.save(force=True)
+
+    if sockets is not None:
+        state = server_state.to_json()
+        state['saved_at'] = time.time()
+        hand_off(sockets, 'exproxyment.server', state=state)
+
+    logger.info("Draining %d requests in flight",
+                server_state.in_flight.active)
+    drained = yield drain(server_state.server, server_state.in_flight,
+                          options.drain_timeout)
+    if not drained:
+        logger.warn("Stopping with %d requests still in flight",
+                    server_state.in_flight.active)
+
+    tornado.ioloop.IOLoop.current().stop()
+
+
+class CheckSchedule(object):
+
+    __slots__ = ('due', 'failures', 'changed_at', 'connects', 'etag',
+                 'parsed')
+
+    def __init__(self, now):
+        # when the next check is due, or None while one is running
+        self.due = now
+        # how many checks in a row have found it unhealthy
+        self.failures = 0
+        # when we last saw its state change
+        self.changed_at = now
+        # how many checks in a row have only connected to it
+        self.connects = 0
+        # the Etag of the last /health that it sent us, and what we made of
+        # that /health. an Etag only means anything to the backend that sent
+        # it, so these are kept per backend
+        self.etag = None
+        self.parsed = None
+
+
 class HealthDaemon(object):
 
     """
-    Every second, check on every backend that's never been seen before, as well
-    as one backend chosen at random
+    Check on every backend every `interval` seconds, give or take some jitter
+    so that they don't all line up. Backends that are new, have just changed
+    state or are failing are checked every `fast_interval` instead, backing off
+    exponentially up to `max_interval` for ones that stay down. At most
+    `concurrency` checks run at once
+
+    Checks ask for /health with the Etag of the last one from that backend, so
+    a backend that supports conditional requests can answer 304 rather than
+    sending it again, and we don't parse it again. Up to `connect_checks`
+    checks in a row on a healthy backend only connect to it
     """
 
-    def __init__(self, ioloop, periodicity=1000):
+    def __init__(self, ioloop, interval=5.0, fast_interval=1.0,
+                 max_interval=30.0, concurrency=20, timeout=0.5, jitter=0.1,
+                 tick=100, connect_checks=0):
         self.ioloop = ioloop
+        self.interval = interval
+        self.fast_interval = fast_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.connect_checks = connect_checks
+
         self.check_count = 0
-        self.periodic = PeriodicCallback(self.task, periodicity, self.ioloop)
+        self.slots = tornado.locks.Semaphore(concurrency)
+
+        # backend -> CheckSchedule, and a heap of (due, backend) so that each
+        # tick only has to look at the backends that are due
+        self.schedule = {}
+        self.due = []
+        # whether the set of backends may have changed since we last looked
+        self.dirty = True
+
+        server_state.change_listeners.append(self.changed)
+        self.periodic = PeriodicCallback(self.task, tick, self.ioloop)
 
     def start(self):
         self.periodic.start()
 
-    @staticmethod
-    def twofilter(pred, it):
-        falses, trues = [], []
-        for item in it:
-            if pred(item):
-                trues.append(item)
-            else:
-                falses.append(item)
+    def changed(self):
+        self.dirty = True
 
-        return falses, trues
+    def reconcile(self, now):
+        for backend in server_state.backends:
+            if backend not in self.schedule:
+                self.schedule[backend] = CheckSchedule(now)
+                heapq.heappush(self.due, (now, backend))
+
+        for backend in self.schedule.keys():
+            if backend not in server_state.backends:
+                # its entry in the heap is skipped when it comes up
+                del self.schedule[backend]
 
-    @tornado.gen.coroutine
     def task(self):
-        self.check_count += 1
+        now = self.ioloop.time()
+
+        if self.dirty:
+            self.dirty = False
+            self.reconcile(now)
+
+        while self.due and self.due[0][0] <= now:
+            due, backend = heapq.heappop(self.due)
+            schedule = self.schedule.get(backend)
+
+            if schedule is None or schedule.due != due:
+                # it was removed or rescheduled since this was pushed
+                continue
+
+            schedule.due = None
+            self.ioloop.spawn_callback(self.scheduled_check, backend)
+
+    def next_interval(self, schedule, now):
+        if schedule.failures:
+            return min(self.fast_interval * 2 ** (schedule.failures - 1),
+                       self.max_interval)
+
+        if now - schedule.changed_at < self.interval:
+            # keep a closer eye on backends that have just come up
+            return self.fast_interval
+
+        return self.interval
+
+    @tornado.gen.coroutine
+    def scheduled_check(self, backend):
+        yield self.slots.acquire()
+
+        try:
+            self.check_count += 1
+            oldstate = server_state.backends.get(backend)
+            yield self.health_check(backend, self.schedule.get(backend))
+
+        except Exception:
+            logger.exception("Error checking on %r", backend)
+
+        finally:
+            self.slots.release()
 
-        unseen, seen = self.twofilter(
-            lambda backend: server_state.backends[backend].healthy is not None,
-            server_state.backends)
+        schedule = self.schedule.get(backend)
+        newstate = server_state.backends.get(backend)
 
-        futs = {}
+        if schedule is None or newstate is None:
+            # it was removed while we were checking on it
+            return
+
+        now = self.ioloop.time()
 
-        for backend in unseen:
-            # if there's anyone we haven't ever seen before, fire off all of
-            # those checks at once
-            futs[backend] = self.health_check(backend)
+        if newstate != oldstate:
+            schedule.changed_at = now
 
-        if seen:
-            # also randomly check on the ones we've seen before
-            backend = random.choice(seen)
-            futs[backend] = self.health_check(backend)
+        if newstate.healthy:
+            schedule.failures = 0
+        else:
+            schedule.failures += 1
 
-        yield futs.values()
+        interval = self.next_interval(schedule, now)
+        schedule.due = now + interval * random.uniform(1 - self.jitter,
+                                                       1 + self.jitter)
+        heapq.heappush(self.due, (schedule.due, backend))
 
     @tornado.gen.coroutine
-    def health_check(self, backend):
+    def health_check(self, backend, schedule=None):
         oldstate = server_state.backends[backend]
+        started = self.ioloop.time()
+        size = 0
 
-        client = tornado.httpclient.AsyncHTTPClient()
-        url = 'http://%s:%d/health' % (backend.host, backend.port)
+        if (schedule is not None and oldstate.healthy
+                and schedule.connects < self.connect_checks):
+            kind = 'connect'
+            schedule.connects += 1
+            alive = yield self.connect(backend)
+            code = 200 if alive else 599
+            newstate = oldstate if alive else BackendState(False, None)
 
-        try:
-            response = yield client.fetch(url,
-                                          connect_timeout=500,
-                                          request_timeout=500)
-        except Exception as exc:
-            code = 599
-            if oldstate.healthy in (True, None):
-                logger.warn("Bad connection to %r (%s)", backend, exc)
-            else:
-                logger.debug("Bad connection to %r (%s)", backend, exc)
         else:
-            code = response.code
+            kind, code, newstate, size = yield self.fetch_health(backend,
+                                                                 schedule)
+            if schedule is not None:
+                schedule.connects = 0
 
         if backend not in server_state.backends:
             # a server was removed while were in the process of checking on it.
@@ -194,28 +1001,104 @@ class HealthDaemon(object):
                          backend)
             return
 
-        if code != 200:
-            server_state.backends[backend] = BackendState(healthy=False,
-                                                          version=None)
-        else:
-            body = json.loads(response.body)
+        server_state.metrics.health_check(backend, newstate.healthy,
+                                          error=code == 599, kind=kind,
+                                          seconds=self.ioloop.time() - started,
+                                          size=size)
+
+        server_state.set_backend_state(backend, newstate)
+
+        if oldstate != newstate:
+            logger.warn("%r: %r -> %r", backend, oldstate, newstate)
+
+    @tornado.gen.coroutine
+    def fetch_health(self, backend, schedule):
+        """
+        Ask `backend` for its /health. Returns (kind, code, BackendState,
+        bytes) where kind is as for HealthMetrics
+        """
+
+        oldstate = server_state.backends[backend]
+
+        headers = tornado.httputil.HTTPHeaders()
+        etag = None
+        if schedule is not None and schedule.parsed is not None:
+            etag = schedule.etag
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        try:
+            response = yield server_state.pools.fetch(
+                backend.host, backend.port,
+                'GET', '/health', headers,
+                connect_timeout=self.timeout,
+                request_timeout=self.timeout,
+                # a backend that's busy with requests isn't unhealthy
+                limited=False)
+        except Exception as exc:
+            if oldstate.healthy in (True, None):
+                logger.warn("Bad connection to %r (%s)", backend, exc)
+            else:
+                logger.debug("Bad connection to %r (%s)", backend, exc)
+            raise tornado.gen.Return(
+                ('full', 599, BackendState(healthy=False, version=None), 0))
+
+        size = len(response.body)
+
+        if response.code == 304 and etag is not None:
+            # nothing's changed since it last told us
+            raise tornado.gen.Return(('cached', 304, schedule.parsed, size))
+
+        if response.code != 200:
+            raise tornado.gen.Return(
+                ('full', response.code,
+                 BackendState(healthy=False, version=None), size))
+
+        new_etag = response.headers.get('Etag')
+        if new_etag is not None and new_etag == etag:
+            # it sent the whole thing anyway, but it's what we already have
+            raise tornado.gen.Return(('cached', 200, schedule.parsed, size))
+
+        state = self.parse_health(backend, response.body)
+        if schedule is not None:
+            schedule.etag = new_etag
+            schedule.parsed = state
+
+        raise tornado.gen.Return(('full', 200, state, size))
+
+    def parse_health(self, backend, body):
+        try:
+            body = json.loads(body)
             healthy = body.get('healthy', False)
             version = body.get('version', None)
-            if healthy is not True or not version:
-                logger.info("Unhealthy %r (%r:%r)", backend, healthy, version)
-                server_state.backends[backend] = BackendState(healthy=False,
-                                                              version=None)
-            else:
-                server_state.backends[backend] = BackendState(healthy=True,
-                                                              version=version)
+        except (ValueError, AttributeError):
+            healthy = version = None
 
-        if oldstate != server_state.backends[backend]:
-            logger.warn("%r: %r -> %r",
-                        backend, oldstate, server_state.backends[backend])
-        else:
-            logger.debug("%r: %r -> %r (%d)",
-                         backend, oldstate, server_state.backends[backend],
-                         code)
+        if healthy is not True or not version:
+            logger.info("Unhealthy %r (%r:%r)", backend, healthy, version)
+            return BackendState(healthy=False, version=None)
+
+        return BackendState(healthy=True, version=version)
+
+    @tornado.gen.coroutine
+    def connect(self, backend):
+        """
+        Whether we can connect to `backend` at all
+        """
+
+        connect = tornado.tcpclient.TCPClient().connect(backend.host,
+                                                        backend.port)
+
+        try:
+            stream = yield tornado.gen.with_timeout(
+                self.ioloop.time() + self.timeout, connect,
+                quiet_exceptions=(tornado.iostream.StreamClosedError,))
+        except Exception as exc:
+            logger.warn("Couldn't connect to %r (%s)", backend, exc)
+            raise tornado.gen.Return(False)
+
+        stream.close()
+        raise tornado.gen.Return(True)
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -238,6 +1121,34 @@ class BaseHandler(tornado.web.RequestHandler):
 
 class ProxyHandler(BaseHandler):
 
+    def initialize(self, sticky_sources=(), header_policy=None):
+        self.sticky_sources = sticky_sources
+        self.header_policy = header_policy or HeaderPolicy()
+        # the RoutingTable that this request routes from, including its
+        # retries, taken when it's first routed
+        self.routing = None
+
+    def sticky_key(self):
+        """
+        The key that we consistently hash this user onto a version and backend
+        with, or None if we aren't configured to or they don't have one
+        """
+
+        if not self.sticky_sources:
+            return None
+
+        parts = []
+        for source in self.sticky_sources:
+            if source == 'ip':
+                parts.append(self.request.remote_ip or '')
+            else:
+                parts.append(self.request.headers.get(source, ''))
+
+        if not any(parts):
+            return None
+
+        return '\0'.join(parts)
+
     def requested_version(self):
         """
         Determine what version the user has requested and how strongly they feel
@@ -263,125 +1174,168 @@ class ProxyHandler(BaseHandler):
         # cookie
         for required, cookiename in ((True, 'exproxyment_require_version'),
                                      (False, 'exproxyment_request_version')):
-            version = self.request.cookies.get(cookiename)
-            if version:
-                value = version.value
-                unquoted = urllib.unquote(value)
-                asjson = json.loads(unquoted)
-                version = asjson['version']
-                return required, version
+            cookie = self.request.cookies.get(cookiename)
+            if cookie:
+                # a malformed cookie is as good as none at all, and the user
+                # gets placed in a version and a fresh cookie
+                version = server_state.version_cookies.decode(cookie.value)
+                if version:
+                    return required, version
 
         return False, None
 
-    def place_user(self):
+    def place_user(self, routing, key=None):
         """
         the user either didn't ask for a particular version, or they nicely
         requested a version we couldn't give them. so we try to place them in
-        a version bucket
+        a version bucket. if they have a sticky key they're always placed in
+        the same bucket
         """
 
-        available_versions = server_state.available_versions()
-
-        if not server_state.weights:
+        if not routing.weights:
             # the administrator hasn't given us any direction as to where they
             # want users placed, so let's just pick the "highest" version
-            return max(available_versions)
+            return max(routing.versions)
 
-        # otherwise take the weights the administrator gave us. TODO do a proper
-        # random weighting, and try to find a way to make these stickier than
-        # just cookies. also ketama instead of this nonsense
-        choices = []
-        for version in available_versions:
-            choices.extend([version] * server_state.weights.get(version, 0))
+        # otherwise take the weights the administrator gave us
+        if key is not None:
+            return routing.hash_version(key)
 
-        if choices:
-            return random.choice(choices)
+        return routing.choose_version()
 
-        return None
+    def route(self, tries):
+        """
+        Pick the version and backend that this request should go to
+
+        returns a tuple of (version, backend), or None if we couldn't find one
+        (in which case the error has already been sent to the client)
+        """
 
-    @tornado.gen.coroutine
-    def proxy(self, path, tries=3):
         if tries <= 0:
             self.nope('too many tries')
-            return
+            return None
 
-        client = tornado.httpclient.AsyncHTTPClient()
+        # everything to do with this request has to agree on what the
+        # backends are, so it all comes from this one table even if a new one
+        # is published meanwhile
+        if self.routing is None:
+            self.routing = server_state.routing
+        routing = self.routing
 
-        if not server_state.healthy():
+        if not routing.healthy():
             self.nope('no backends available')
-            return
+            return None
 
         required, version = self.requested_version()
+        key = self.sticky_key()
 
         if version:
             logger.debug("User requested version %r (required:%r)",
                          version, required)
 
-        if required and version not in server_state.available_versions():
+        if required and version not in routing.versions:
             self.nope("no backend available for %s" % (version,))
-            return
+            return None
 
-        if version not in server_state.available_versions():
+        if version not in routing.versions:
             # otherwise rebucket them
-            version = self.place_user()
+            version = self.place_user(routing, key)
 
         if not version:
             self.nope("no valid versions")
-            return
+            return None
 
-        backend = server_state.backend_for(version)
+        backend = routing.backend_for(server_state.balancer, version, key)
 
         if not backend:
             self.nope('no backend for %r' % (version,))
-            return
+            return None
 
-        client = tornado.httpclient.AsyncHTTPClient()
-        uri = 'http://%s:%d/%s' % (backend.host, backend.port, path)
-        method = self.request.method
+        return version, backend
 
-        headers = tornado.httputil.HTTPHeaders()
+    @tornado.gen.coroutine
+    def prepare(self):
+        now = tornado.ioloop.IOLoop.current().time()
+        server_state.retry_budget.request(now)
+
+        self.admitted = yield server_state.in_flight.acquire(
+            server_state.limits.queue_timeout)
+
+        if not self.admitted:
+            self.nope('too many requests in flight', code=503)
+            self.finish()
+
+    def on_finish(self):
+        self.release()
+        server_state.metrics.request(self.get_status())
+
+    def on_connection_close(self):
+        # the request keeps its slot until we're done with the backend, which
+        # isn't any sooner for the client having given up on it
+        super(ProxyHandler, self).on_connection_close()
+
+    def release(self):
+        if getattr(self, 'admitted', False):
+            self.admitted = False
+            server_state.in_flight.release()
+
+    def fetch_upstream(self, backend, headers, **kwargs):
+        connect_timeout, first_byte_timeout, total_timeout = \
+            server_state.limits.timeouts_for(self.request.path)
+
+        return server_state.pools.fetch(backend.host, backend.port,
+                                        self.request.method, self.request.uri,
+                                        headers,
+                                        connect_timeout=connect_timeout,
+                                        first_byte_timeout=first_byte_timeout,
+                                        request_timeout=total_timeout,
+                                        **kwargs)
+
+    def retry_backend(self, version, tried):
+        """
+        After failing to get a response from the backends in `tried`, pick
+        another one to try, or None if we shouldn't
+        """
 
-        for header, value in self.request.headers.iteritems():
-            headers.add(header, value)
+        if self.request.method not in IDEMPOTENT_METHODS:
+            return None
 
-        headers.add('X-Exproxyment-Version', version)
+        if len(tried) > options.max_retries:
+            return None
 
-        body = None
-        if method != 'GET':
-            body = self.request.body
+        backend = self.routing.backend_for(server_state.balancer, version,
+                                           exclude=tried)
+        if backend is None:
+            return None
 
-        active_request = ActiveRequest(source_host=self.request.remote_ip,
-                                       uri=uri, backend=backend)
-        server_state.requests.add(active_request)
+        now = tornado.ioloop.IOLoop.current().time()
+        if not server_state.retry_budget.retry(now):
+            logger.warn("Out of retry budget, not retrying %s %s",
+                        self.request.method, self.request.uri)
+            return None
 
-        try:
-            response = yield client.fetch(uri,
-                                          method=method,
-                                          headers=headers,
-                                          body=body)
-
-        except Exception as e:
-            # TODO we can allow the client to specify whether
-            # connection-refused type errors are retryable
-            self.nope("bad connection to %r (%r)" % (backend, e))
-            return
+        return backend
 
-        finally:
-            server_state.requests.remove(active_request)
+    def compute_etag(self):
+        # the backend's Etag (if any) is the one that counts, and conditional
+        # requests are passed through for the backend to answer
+        return None
 
-        if (response.code == 406
-                and response.headers.get('X-Exproxyment-Wrong-Version')):
-            # they're telling us that they can't service this version, so they
-            # want us to hit someone else
-            ret = yield self.proxy(path, tries=tries - 1)
-            raise tornado.gen.Return(ret)
+    def upstream_headers(self, version):
+        """
+        Build the headers that we send to the backend
+        """
 
-        self.set_status(response.code)
+        return self.header_policy.request_headers(self.request, version)
 
-        # copy all of the headers
-        for header, value in response.headers.iteritems():
-            self.set_header(header, value)
+    def copy_response_headers(self, headers):
+        # the backend's headers replace tornado's defaults (Content-Type,
+        # Server, Date) rather than being sent alongside them. the connection
+        # to the client is framed by tornado, not by whatever the backend was
+        # doing, so its hop-by-hop headers aren't copied
+        self.header_policy.response_headers(headers, self._headers)
 
+    def set_exproxyment_headers(self, version, backend):
         # set our own headers
         self.set_header('X-Exproxyment-Version', version)
         self.set_header('X-Exproxyment-Backend',
@@ -392,12 +1346,586 @@ class ProxyHandler(BaseHandler):
             cookie_name = ('exproxyment_request_version'
                            if options.soft_sticky
                            else 'exproxyment_require_version')
-            cookie_value = urllib.quote(json.dumps({'version': version}))
+            cookie_value = server_state.version_cookies.encode(version)
             self.set_cookie(cookie_name,
                             cookie_value,
                             options.cookie_domain or None)
 
-        self.write(response.body)
+    @tornado.gen.coroutine
+    def proxy(self, path, tries=3):
+        route = self.route(tries)
+
+        if route is None:
+            return
+
+        version, backend = route
+
+        cache = server_state.cache
+        flights = server_state.flights
+        prefix = flights.prefix_for(self.request) if flights else None
+
+        if cache is not None and cache.cacheable_request(self.request):
+            result = yield self.fetch_cached(cache, version, backend)
+        elif prefix is not None:
+            result = yield self.fetch_shared(flights, prefix, version, backend)
+        else:
+            result = yield self.fetch(version, backend)
+
+        if result is None:
+            return
+
+        backend, response = result
+
+        if (response.code == 406
+                and response.headers.get('X-Exproxyment-Wrong-Version')):
+            # they're telling us that they can't service this version, so they
+            # want us to hit someone else
+            ret = yield self.proxy(path, tries=tries - 1)
+            raise tornado.gen.Return(ret)
+
+        body = response.body
+
+        compressor = server_state.compressor
+        compressible = (compressor is not None
+                        and compressor.compressible(response))
+        encoding = None
+        if compressible:
+            encoding = compressor.encoding_for(self.request, response)
+            if encoding is not None:
+                body = yield compressor.compress(body, encoding)
+
+        self.set_status(response.code, response.reason)
+        self.copy_response_headers(response.headers)
+        self.set_exproxyment_headers(version, backend)
+
+        if compressible:
+            # whether it's compressed depends on who's asking
+            vary = self._headers.get('Vary')
+            self.set_header('Vary', ('%s, Accept-Encoding' % (vary,)
+                                     if vary else 'Accept-Encoding'))
+
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+            self.set_header('Content-Length', len(body))
+
+            # the compressed bytes aren't the ones the backend's Etag vouches
+            # for, but they're equivalent
+            etag = self._headers.get('Etag')
+            if etag and not etag.startswith('W/'):
+                self.set_header('Etag', 'W/' + etag)
+
+        self.write(body)
+
+    @tornado.gen.coroutine
+    def fetch(self, version, backend):
+        """
+        Get a response from `backend`, retrying on others if we can't. Returns
+        the (backend, response) that we got, or None if we gave up (in which
+        case the error has already been sent to the client)
+        """
+
+        method = self.request.method
+
+        # any method can have a body, and the client's Content-Length is
+        # passed on, so whatever body they sent has to go with it
+        body = None
+        if method != 'GET' or self.request.body:
+            body = self.request.body
+
+        tried = set()
+
+        while True:
+            tried.add(backend)
+            headers = self.upstream_headers(version)
+
+            limiter = server_state.backend_limiter(backend)
+            admitted = yield limiter.acquire(server_state.limits.queue_timeout)
+            if not admitted:
+                self.nope('too many requests in flight to %r' % (backend,),
+                          code=503)
+                return
+
+            started = tornado.ioloop.IOLoop.current().time()
+            in_flight = server_state.requests.add(self.request.remote_ip,
+                                                  self.request.method,
+                                                  self.request.uri,
+                                                  version, backend, started)
+
+            try:
+                response = yield self.fetch_upstream(backend, headers,
+                                                     body=body)
+
+            except Exception as e:
+                server_state.outliers.record(backend, False)
+                server_state.metrics.error(version, backend,
+                                           bytes_in=len(body or ''))
+                error = e
+
+            else:
+                error = None
+
+            finally:
+                server_state.requests.remove(in_flight)
+                limiter.release()
+
+            if error is None:
+                latency = tornado.ioloop.IOLoop.current().time() - started
+                server_state.balancer.record(backend, latency)
+                server_state.metrics.response(version, backend, response.code,
+                                              latency,
+                                              bytes_in=len(body or ''),
+                                              bytes_out=len(response.body))
+                break
+
+            retry = self.retry_backend(version, tried)
+            if retry is None:
+                self.nope("bad connection to %r (%r)" % (backend, error))
+                return
+
+            server_state.metrics.retry(version, backend)
+
+            logger.info("Retrying on %r after bad connection to %r (%r)",
+                        retry, backend, error)
+            backend = retry
+
+        server_state.outliers.record(backend, response.code < 500)
+
+        raise tornado.gen.Return((backend, response))
+
+    @tornado.gen.coroutine
+    def fetch_cached(self, cache, version, backend):
+        """
+        Like fetch, but from the cache if we can
+        """
+
+        ioloop = tornado.ioloop.IOLoop.current()
+        now = ioloop.time()
+        uri = self.request.uri
+        key = cache.key(version, uri, self.request.headers)
+
+        entry = cache.get(key)
+        if entry is not None and entry.fresh(now):
+            cache.hits += 1
+            raise tornado.gen.Return(self.cached(entry, 'HIT', now))
+
+        if entry is not None and entry.usable_stale(now):
+            cache.stale_hits += 1
+            if cache.wait(key) is None:
+                # the refresh runs on its own, since this request (and its
+                # handler) will be long gone by the time it's done
+                cache.start(key)
+                ioloop.spawn_callback(revalidate, cache, key, version, uri,
+                                      self.upstream_headers(version),
+                                      self.request.headers)
+            raise tornado.gen.Return(self.cached(entry, 'STALE', now))
+
+        pending = cache.wait(key)
+        if pending is not None:
+            cache.coalesced += 1
+            entry = yield pending
+            # we started waiting before we knew what the response varies on,
+            # so it's only ours if we'd have looked it up under the same key
+            if (entry is not None
+                    and cache.key(version, uri,
+                                  self.request.headers) == entry.key):
+                raise tornado.gen.Return(self.cached(entry, 'HIT', now))
+
+            # whatever they got can't be shared with us, so get our own
+            self.set_header('X-Exproxyment-Cache', 'MISS')
+            result = yield self.fetch(version, backend)
+            raise tornado.gen.Return(result)
+
+        cache.misses += 1
+        self.set_header('X-Exproxyment-Cache', 'MISS')
+
+        cache.start(key)
+        entry = None
+        try:
+            result = yield self.fetch(version, backend)
+            if result is not None:
+                entry = cache.store(version, uri, self.request.headers,
+                                    result[0], result[1], ioloop.time())
+        finally:
+            cache.finish(key, entry)
+
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def fetch_shared(self, flights, prefix, version, backend):
+        """
+        Like fetch, but sharing the fetch with any identical requests that are
+        going on at the same time
+        """
+
+        key = (version, self.request.method, self.request.uri)
+        counts = flights.counts[prefix]
+
+        pending = flights.wait(key)
+        if pending is not None:
+            result, headers = yield pending
+            if (result is not None
+                    and flights.shareable(result[1], headers,
+                                          self.request.headers)):
+                counts.merged += 1
+                raise tornado.gen.Return(result)
+
+            # they already got an error for it, which we might have better
+            # luck with, or a response that was only for them
+            counts.fallbacks += 1
+            result = yield self.fetch(version, backend)
+            raise tornado.gen.Return(result)
+
+        counts.flights += 1
+
+        flights.start(key)
+        result = None
+        try:
+            result = yield self.fetch(version, backend)
+        finally:
+            flights.finish(key, result, self.request.headers)
+
+        raise tornado.gen.Return(result)
+
+    def cached(self, entry, status, now):
+        self.set_header('X-Exproxyment-Cache', status)
+        self.set_header('Age', str(int(now - entry.stored)))
+        return entry.backend, entry.response
+
+    get = proxy
+    post = proxy
+    head = proxy
+    put = proxy
+    delete = proxy
+
+
+@tornado.gen.coroutine
+def revalidate(cache, key, version, uri, headers, request_headers):
+    """
+    Refresh a stale cache entry in the background
+    """
+
+    entry = None
+
+    try:
+        backend = server_state.backend_for(version)
+        if backend is None:
+            return
+
+        connect_timeout, first_byte_timeout, total_timeout = \
+            server_state.limits.timeouts_for(uri)
+
+        # the request that this is on behalf of may have had a body, but this
+        # doesn't send one
+        headers.pop('Content-Length', None)
+
+        response = yield server_state.pools.fetch(
+            backend.host, backend.port, 'GET', uri, headers,
+            connect_timeout=connect_timeout,
+            first_byte_timeout=first_byte_timeout,
+            request_timeout=total_timeout)
+
+        server_state.outliers.record(backend, response.code < 500)
+
+        entry = cache.store(version, uri, request_headers, backend, response,
+                            tornado.ioloop.IOLoop.current().time())
+
+    except Exception as e:
+        logger.info("Couldn't refresh %s for %s (%r)", uri, version, e)
+
+    finally:
+        cache.finish(key, entry)
+
+
+class StreamedResponse(object):
+
+    """
+    Receives a backend's response through the header_callback and
+    streaming_callback of a fetch and relays it to the client as it arrives,
+    rather than waiting for the whole body
+    """
+
+    def __init__(self, handler, version, backend):
+        self.handler = handler
+        self.version = version
+        self.backend = backend
+
+        self.code = None
+        # when the backend's response started arriving
+        self.first_byte = None
+        self.bytes_out = 0
+        # whether we've started sending this response to the client
+        self.started = False
+        # whether the backend told us to go somewhere else
+        self.wrong_version = False
+
+    def on_headers(self, start_line, headers):
+        self.code = start_line.code
+        self.first_byte = tornado.ioloop.IOLoop.current().time()
+
+        if (start_line.code == 406
+                and headers.get('X-Exproxyment-Wrong-Version')):
+            self.wrong_version = True
+            return
+
+        handler = self.handler
+        handler.set_status(start_line.code, start_line.reason)
+        handler.copy_response_headers(headers)
+        handler.set_exproxyment_headers(self.version, self.backend)
+
+        self.started = True
+
+    def on_chunk(self, chunk):
+        if self.wrong_version:
+            return None
+
+        self.bytes_out += len(chunk)
+        self.handler.write(chunk)
+
+        # the backend connection waits for this before reading any more, so a
+        # slow client slows down the backend instead of filling our memory
+        return self.handler.flush()
+
+
+@tornado.web.stream_request_body
+class StreamingProxyHandler(ProxyHandler):
+
+    """
+    Like ProxyHandler but request and response bodies are passed through in
+    chunks as they arrive instead of being read fully into memory first. The
+    request body is passed through a small bounded queue and the response is
+    only read from the backend as fast as the client takes it, so a slow
+    backend or a slow client pushes back on the other side
+    """
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        self.body_queue = None
+        self.upstream = None
+        self.bytes_in = 0
+        # whether the client has hung up on us
+        self.client_gone = False
+
+        yield super(StreamingProxyHandler, self).prepare()
+
+        if self._finished:
+            return
+
+        if self.client_gone:
+            # they hung up while they were waiting to be admitted. tornado
+            # won't go on to finish a request without its body
+            self.release()
+            return
+
+        if self.has_body():
+            # we have to start talking to the backend now because the body is
+            # going to start arriving before our method is called
+            self.body_queue = tornado.queues.Queue(
+                maxsize=options.stream_queue_chunks)
+            self.upstream = self.stream(self.path_args[0],
+                                        body_queue=self.body_queue)
+            self.upstream.add_done_callback(self.discard_body)
+
+    def on_connection_close(self):
+        super(StreamingProxyHandler, self).on_connection_close()
+        self.client_gone = True
+
+        body_queue = self.body_queue
+        if body_queue is not None:
+            # the backend is still waiting for the rest of the body. make room
+            # for telling it that there isn't going to be any
+            self.discard_body()
+            body_queue.put_nowait(BODY_ABORTED)
+
+            # and since tornado won't finish a request without its body, the
+            # slot is given back once the backend's done with it instead
+            self.upstream.add_done_callback(lambda future: self.release())
+
+    def has_body(self):
+        """
+        Whether the client is sending us a body. Any method can have one, so
+        this goes by the headers that frame it rather than by the method
+        """
+
+        headers = self.request.headers
+
+        if 'Transfer-Encoding' in headers:
+            return True
+
+        # tornado has already turned away anything that isn't a number
+        return int(headers.get('Content-Length', 0)) > 0
+
+    def data_received(self, chunk):
+        self.bytes_in += len(chunk)
+
+        if self.body_queue is None:
+            return None
+
+        return self.body_queue.put(chunk)
+
+    def discard_body(self, future=None):
+        # if the backend went away before reading the whole body, make sure
+        # the client isn't left blocked on a full queue
+        body_queue, self.body_queue = self.body_queue, None
+
+        while body_queue is not None and not body_queue.empty():
+            body_queue.get_nowait()
+
+    @staticmethod
+    def body_producer(body_queue, chunked=False):
+        """
+        Pass the body through from `body_queue`, framing it in chunks
+        ourselves if `chunked`
+        """
+
+        @tornado.gen.coroutine
+        def produce(write):
+            while True:
+                chunk = yield body_queue.get()
+                if chunk is None:
+                    break
+                if chunk is BODY_ABORTED:
+                    # fail the fetch rather than finishing a body that's
+                    # missing its end
+                    raise tornado.iostream.StreamClosedError()
+                if chunked:
+                    if not chunk:
+                        # an empty chunk would end the body
+                        continue
+                    chunk = b'%x\r\n%s\r\n' % (len(chunk), chunk)
+                yield write(chunk)
+
+            if chunked:
+                yield write(b'0\r\n\r\n')
+
+        return produce
+
+    @tornado.gen.coroutine
+    def stream(self, path, tries=3, body_queue=None):
+        route = self.route(tries)
+
+        if route is None:
+            return
+
+        version, backend = route
+
+        body_producer = None
+        chunked = False
+        if body_queue is not None:
+            # without a Content-Length the body has to be chunked, which
+            # tornado only does for some methods
+            chunked = ('Content-Length' not in self.request.headers
+                       and self.request.method not in CHUNKED_METHODS)
+            body_producer = self.body_producer(body_queue, chunked)
+
+        tried = set()
+
+        while True:
+            tried.add(backend)
+            headers = self.upstream_headers(version)
+            if body_producer is None:
+                # we aren't sending the client's body, so don't promise one
+                headers.pop('Content-Length', None)
+            elif chunked:
+                headers['Transfer-Encoding'] = 'chunked'
+            streamed = StreamedResponse(self, version, backend)
+
+            limiter = server_state.backend_limiter(backend)
+            admitted = yield limiter.acquire(server_state.limits.queue_timeout)
+            if not admitted:
+                self.nope('too many requests in flight to %r' % (backend,),
+                          code=503)
+                return
+
+            started = tornado.ioloop.IOLoop.current().time()
+            in_flight = server_state.requests.add(self.request.remote_ip,
+                                                  self.request.method,
+                                                  self.request.uri,
+                                                  version, backend, started)
+
+            error = None
+
+            try:
+                yield self.fetch_upstream(backend, headers,
+                                          body_producer=body_producer,
+                                          header_callback=streamed.on_headers,
+                                          streaming_callback=streamed.on_chunk)
+
+            except Exception as e:
+                error = e
+
+            finally:
+                server_state.requests.remove(in_flight)
+                limiter.release()
+
+            if not self.client_gone:
+                # otherwise it wasn't necessarily the backend's fault
+                server_state.outliers.record(
+                    backend,
+                    error is None and streamed.code < 500)
+
+            if streamed.first_byte is not None:
+                # how long the rest takes depends on the client as much as on
+                # the backend, so only count the wait for the response to start
+                latency = streamed.first_byte - started
+                server_state.balancer.record(backend, latency)
+                server_state.metrics.response(version, backend, streamed.code,
+                                              latency,
+                                              bytes_in=self.bytes_in,
+                                              bytes_out=streamed.bytes_out)
+            else:
+                server_state.metrics.error(version, backend,
+                                           bytes_in=self.bytes_in)
+
+            if error is None or streamed.code is not None:
+                break
+
+            if body_queue is not None:
+                # some of the body may already be gone
+                break
+
+            retry = self.retry_backend(version, tried)
+            if retry is None:
+                break
+
+            server_state.metrics.retry(version, backend)
+
+            logger.info("Retrying on %r after bad connection to %r (%r)",
+                        retry, backend, error)
+            backend = retry
+
+        if streamed.wrong_version:
+            if body_queue is not None:
+                # the body has already been sent, we can't send it again
+                self.nope("wrong version from %r" % (backend,))
+                return
+
+            ret = yield self.stream(path, tries=tries - 1)
+            raise tornado.gen.Return(ret)
+
+        if error is not None and not streamed.started:
+            self.nope("bad connection to %r (%r)" % (backend, error))
+            return
+
+        if error is not None:
+            # we've already sent part of the response so all we can do is hang
+            # up on them
+            logger.warn("Lost connection to %r mid-response (%r)",
+                        backend, error)
+            self.request.connection.close()
+
+    @tornado.gen.coroutine
+    def proxy(self, path):
+        if self.upstream is None:
+            yield self.stream(path)
+            return
+
+        if self.body_queue is not None:
+            # let the backend know that the body is done. after that there's
+            # nothing for a client that hangs up to cut short
+            yield self.body_queue.put(None)
+            self.body_queue = None
+
+        yield self.upstream
 
     get = proxy
     post = proxy
@@ -417,16 +1945,24 @@ class MyHealth(BaseHandler):
     def get(self):
         for_version = self.get_argument('for_version', None)
 
-        healthy = server_state.healthy(for_version)
+        routing = server_state.routing
+        # so that anything balancing across several of us stops sending us
+        # requests while we finish the ones we have
+        healthy = routing.healthy(for_version) and not server_state.stopping
 
         if not healthy:
             self.set_status(500)
 
+        now = tornado.ioloop.IOLoop.current().time()
+
         backends = []
-        for backend, state in server_state.backends.iteritems():
+        for backend, state in routing.backends.iteritems():
             js = {}
             js.update(backend.to_json())
             js.update(state.to_json())
+            js['ejected'] = backend in server_state.ejected
+            js['draining'] = backend in server_state.draining
+            js['lease'] = server_state.leases.remaining(backend, now)
             backends.append(js)
         backends = sorted(backends,
                           key=lambda x: (x['host'],
@@ -434,9 +1970,15 @@ class MyHealth(BaseHandler):
 
         ret = {
             'healthy': healthy,
-            'versions': sorted(list(server_state.available_versions())),
-            'weights': server_state.weights, # already jsonnable
+            'versions': sorted(list(routing.versions)),
+            'weights': routing.weights, # already jsonnable
             'backends': backends,
+            'balancing': server_state.balancer.to_json(),
+            'generation': routing.generation,
+            'leases': server_state.leases.to_json(),
+            'stopping': server_state.stopping,
+            'sync': (server_state.sync.to_json()
+                     if server_state.sync is not None else None),
         }
 
         self.write_json(ret)
@@ -449,38 +1991,44 @@ class ExproxymentConfigure(BaseHandler):
     """
 
     def get(self):
-        self.write_json({'backends': [{'host': backend.host,
-                                       'port': backend.port,
-                                       'healthy': state.healthy,
-                                       'version': state.version}
-                                      for (backend, state)
-                                      in server_state.backends.iteritems()],
-                         'weights': server_state.weights})
+        self.write_json(server_state.to_json())
 
     def post(self):
         body = json.loads(self.request.body)
 
+        # check all of it before we change any of it, and then change all of
+        # it at once
+        new_backends = weights = limits = None
+
         if 'backends' in body:
             try:
                 new_backends = validate_backend_json(body['backends'])
             except ValueError:
                 return self.nope({'error': 'bad format: backends'}, code=400)
 
-            logger.info("Reconfiguring backends: %r", new_backends)
-            server_state.set_backends(new_backends)
-
         if 'weights' in body:
-            weights = body['weights']
-
-            # validate the format of the new weights
-            if not (isinstance(weights, dict)
-                    and (isinstance(k, basestring)
-                         and isinstance(v, (int, long))
-                         for (k, v) in weights.items())):
+            try:
+                weights = validate_weights_json(body['weights'])
+            except ValueError:
                 return self.nope('bad format: weights', code=400)
 
+        if 'limits' in body:
+            try:
+                # only the ones that they gave us change
+                limits = server_state.limits.updated(body['limits'])
+            except (TypeError, ValueError):
+                return self.nope('bad format: limits', code=400)
+
+        if new_backends is not None:
+            logger.info("Reconfiguring backends: %r", new_backends)
+        if weights is not None:
             logger.info("Reconfiguring weights: %r", weights)
-            server_state.weights = weights
+        if limits is not None:
+            logger.info("Reconfiguring limits: %r", limits.to_json())
+
+        if not (new_backends is None and weights is None and limits is None):
+            change_state('reconfigure', backends=new_backends,
+                         weights=weights, limits=limits)
 
         return self.get()
 
@@ -488,20 +2036,22 @@ class ExproxymentConfigure(BaseHandler):
 class RegisterSelfHandler(BaseHandler):
 
     """
-    Like ExproxymentConfigure but takes a list of *new* backends to register
+    Like ExproxymentConfigure but takes a list of *new* backends to register.
+    Backends with a "ttl" (or all of them, given a "ttl" alongside the list)
+    are deregistered after that many seconds unless they register again
     """
 
     def post(self):
         body = json.loads(self.request.body)
 
         try:
-            backends = validate_backend_json(body['backends'])
-        except (KeyError, ValueError):
-            return self.nope('bad format: backends', code=400)
+            backends = validate_backend_json(body['backends'], leases=True,
+                                             default_ttl=body.get('ttl'))
+        except (KeyError, TypeError, ValueError) as e:
+            return self.nope('bad format: backends (%s)' % (e,), code=400)
 
-        for backend in backends:
-            logger.info("Registering backend %r", backend)
-            server_state.add_backend(backend)
+        logger.info("Registering %d backends: %r", len(backends), backends)
+        change_state('update_backends', add=backends)
 
         self.write_json({'status': 'ok'})
 
@@ -509,7 +2059,9 @@ class RegisterSelfHandler(BaseHandler):
 class DeregisterSelfHandler(BaseHandler):
 
     """
-    Like RegisterSelfHandler but takes a list of backends to deregister
+    Like RegisterSelfHandler but takes a list of backends to deregister. They
+    get no new requests, and are removed once the ones they have are done or
+    after "drain" seconds (--backend_drain_timeout by default)
     """
 
     def post(self):
@@ -517,25 +2069,131 @@ class DeregisterSelfHandler(BaseHandler):
 
         try:
             backends = validate_backend_json(body['backends'])
-        except (KeyError, ValueError):
-            return self.nope('bad format: backends', code=400)
+            drain = validate_drain(body.get('drain',
+                                            options.backend_drain_timeout))
+        except (KeyError, TypeError, ValueError) as e:
+            return self.nope('bad format: backends (%s)' % (e,), code=400)
 
-        for backend in backends:
-            logger.info("Deregistering backend %r", backend)
-            server_state.remove_backend(backend)
+        logger.info("Deregistering %d backends: %r", len(backends), backends)
+        change_state('update_backends', remove=backends, drain=drain)
 
         self.write_json({'status': 'ok'})
 
 
+class ExproxymentBackends(BaseHandler):
+
+    """
+    Register and deregister any number of backends at once:
+
+        {"add": [{"host": "a", "port": 80, "ttl": 30}, ...],
+         "remove": [{"host": "b", "port": 80}, ...],
+         "ttl": 30,
+         "drain": 10}
+
+    where "ttl" on its own is the default for the adds that don't have one,
+    and "drain" is how long the removed backends get to finish their requests
+    (see DeregisterSelfHandler).
+    Nothing is changed unless all of it is valid, and requests see either
+    none of it or all of it
+    """
+
+    def post(self):
+        body = json.loads(self.request.body)
+
+        try:
+            if not isinstance(body, dict):
+                raise ValueError("expected an object")
+            add = validate_backend_json(body.get('add', []), leases=True,
+                                        default_ttl=body.get('ttl'))
+            remove = validate_backend_json(body.get('remove', []))
+            drain = validate_drain(body.get('drain',
+                                            options.backend_drain_timeout))
+        except (TypeError, ValueError) as e:
+            return self.nope('bad format: backends (%s)' % (e,), code=400)
+
+        both = set(backend for (backend, ttl) in add) & set(remove)
+        if both:
+            return self.nope('bad format: backends (both added and removed:'
+                             ' %r)' % (sorted(both),), code=400)
+
+        if add or remove:
+            logger.info("Registering %d backends and deregistering %d",
+                        len(add), len(remove))
+            change_state('update_backends', add=add, remove=remove,
+                         drain=drain)
+
+        self.write_json({'status': 'ok',
+                         'added': len(add),
+                         'removed': len(remove),
+                         'generation': server_state.generation})
+
+
 class ExproxymentActivity(BaseHandler):
 
+    """
+    The requests we're waiting on backends for, a page at a time (from
+    ?offset=, which each page gives the next value of) or a random ?sample= of
+    them, plus counts of all of them by backend and version
+    """
+
     def get(self):
-        activity = []
+        requests = server_state.requests
+
+        try:
+            offset = int(self.get_argument('offset', 0))
+            limit = int(self.get_argument('limit', 100))
+            sample = int(self.get_argument('sample', 0))
+        except ValueError:
+            return self.nope('bad format: offset, limit and sample must be'
+                             ' numbers', code=400)
+
+        if sample:
+            page, next_offset = requests.sample(sample), None
+        else:
+            page, next_offset = requests.page(offset, limit)
+
+        self.write_json({
+            'activity': [request.to_json() for request in page],
+            'next_offset': next_offset,
+            'total': len(requests),
+            'by_backend': dict(('%s:%d' % backend, count)
+                               for (backend, count)
+                               in requests.by_backend.iteritems()),
+            'by_version': requests.by_version,
+            'in_flight': server_state.in_flight.to_json(),
+            'connections': (server_state.server.to_json()
+                            if server_state.server is not None else None),
+            'cache': (server_state.cache.to_json()
+                      if server_state.cache is not None else None),
+            'singleflight': (server_state.flights.to_json()
+                             if server_state.flights is not None else None),
+            'compression': (server_state.compressor.to_json()
+                            if server_state.compressor is not None else None),
+            'pools': server_state.pools.to_json(),
+        })
+
+
+class ExproxymentMetrics(BaseHandler):
 
-        for active_request in server_state.requests:
-            activity.append(active_request.to_json())
+    """
+    Counters and latency histograms in the Prometheus text format. Like
+    activity, with --num_processes each process only reports its own requests
+    """
 
-        self.write_json({'activity': activity})
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(server_state.metrics.render())
+
+        if server_state.cache is not None:
+            self.write(render_counters(
+                'exproxyment_cache_%s_total',
+                'Response cache %s',
+                [(name, count) for (name, count)
+                 in sorted(server_state.cache.to_json().iteritems())
+                 if name not in ('entries', 'bytes')]))
+
+        if server_state.flights is not None:
+            self.write(server_state.flights.render())
 
 
 class FourOhFour(BaseHandler):
@@ -544,39 +2202,107 @@ class FourOhFour(BaseHandler):
         self.set_status(404)
 
 
-def validate_backend_json(backends):
-    # validate the format of the servers TODO duplicated with above
-    if not (isinstance(backends, list)
-            and (isinstance(k, basestring)
-                 and isinstance(v, basestring)
-                 for (k, v)
-                 in backends)):
-        raise ValueError
+def validate_ttl(ttl):
+    if ttl is None:
+        return None
+
+    if (isinstance(ttl, bool) or not isinstance(ttl, (int, long, float))
+            or not ttl > 0):
+        raise ValueError("ttl must be a positive number of seconds")
+
+    return ttl
+
+
+def validate_drain(drain):
+    if (isinstance(drain, bool) or not isinstance(drain, (int, long, float))
+            or drain < 0):
+        raise ValueError("drain must be a number of seconds")
 
+    return drain
+
+
+def validate_backend_json(backends, leases=False, default_ttl=None):
+    """
+    Check a JSON list of backends, raising ValueError about the first thing
+    wrong with it. Returns a list of Backends or, with `leases`, of
+    (Backend, ttl) where a ttl of None means that it stays until it's removed
+    """
+
+    if not isinstance(backends, list):
+        raise ValueError("backends must be a list")
+
+    default_ttl = validate_ttl(default_ttl)
     ret = []
 
     for entry in backends:
-        ret.append(Backend(entry['host'], entry['port']))
+        if not isinstance(entry, dict):
+            raise ValueError("%r isn't an object" % (entry,))
+
+        host = entry.get('host')
+        port = entry.get('port')
+
+        if not (isinstance(host, basestring) and host):
+            raise ValueError("%r has no host" % (entry,))
+        if (isinstance(port, bool) or not isinstance(port, (int, long))
+                or not 0 < port < 65536):
+            raise ValueError("%r has no valid port" % (entry,))
+
+        backend = Backend(host, port)
+
+        if leases:
+            ret.append((backend, validate_ttl(entry.get('ttl', default_ttl))))
+        elif 'ttl' in entry:
+            raise ValueError("%r can't have a ttl here" % (entry,))
+        else:
+            ret.append(backend)
 
     return ret
 
 
+def validate_weights_json(weights):
+    if not isinstance(weights, dict):
+        raise ValueError("weights must be an object")
+
+    for version, weight in weights.iteritems():
+        if (not isinstance(version, basestring) or isinstance(weight, bool)
+                or not isinstance(weight, (int, long)) or weight < 0):
+            raise ValueError("bad weight %r for %r" % (weight, version))
+
+    return weights
+
+
 class ExproxymentApplication(tornado.web.Application):
 
     def __init__(self):
+        proxy_handler = (StreamingProxyHandler
+                         if options.streaming
+                         else ProxyHandler)
+        sticky_sources = [source.strip()
+                          for source in options.hash_sticky.split(',')
+                          if source.strip()]
+        header_policy = HeaderPolicy(
+            remove_request=parse_header_names(options.remove_request_headers),
+            add_request=parse_header_values(options.add_request_headers),
+            remove_response=parse_header_names(options.remove_response_headers),
+            add_response=parse_header_values(options.add_response_headers),
+            forwarded=options.forwarded_headers)
+
         super(ExproxymentApplication, self).__init__([
             (r"/exproxyment/configure", ExproxymentConfigure),
             (r"/exproxyment/register", RegisterSelfHandler),
             (r"/exproxyment/deregister", DeregisterSelfHandler),
+            (r"/exproxyment/backends", ExproxymentBackends),
 
             (r"/exproxyment/activity", ExproxymentActivity),
+            (r"/exproxyment/metrics", ExproxymentMetrics),
 
             # reserve the rest of this namespace for ourselves
             (r"/exproxyment.+", FourOhFour),
 
             (r"/health", MyHealth),
             (r"/health.+", FourOhFour),
-            (r"/(.*)", ProxyHandler),
+            (r"/(.*)", proxy_handler, {'sticky_sources': sticky_sources,
+                                       'header_policy': header_policy}),
         ])
 
 
@@ -585,13 +2311,21 @@ def main():
 
     parse_command_line()
 
-    ioloop = tornado.ioloop.IOLoop.instance()
-
-    application = ExproxymentApplication()
-
     if options.soft_sticky and options.hard_sticky:
         raise Exception("can't be both soft_sticky and hard_sticky")
 
+    if options.streaming and options.cache_size:
+        raise Exception("can't cache responses while streaming them")
+
+    if options.streaming and options.singleflight_prefixes:
+        raise Exception("can't share responses while streaming them")
+
+    if options.streaming and options.compress:
+        raise Exception("can't compress responses while streaming them")
+
+    if options.balancing not in BALANCERS:
+        raise Exception("unknown balancing %r" % (options.balancing,))
+
     if options.backends:
         backends = parse_backends(options.backends)
         backends = [Backend(host['host'], host['port'])
@@ -602,8 +2336,176 @@ def main():
         weights = parse_weights(options.weights)
         server_state.weights = weights
 
-    HealthDaemon(ioloop).start()
-    application.listen(options.port)
+    # the ones we were handed if we're taking over from a proxy that's
+    # restarting (see drain.py)
+    sockets = inherited_sockets()
+
+    # what a proxy that we're taking over from handed us is fresher than
+    # anything in the state file
+    saved, source = inherited_state(), 'the previous proxy'
+    if saved is None and options.state_file:
+        saved, source = read_state(options.state_file), options.state_file
+    if saved is not None:
+        # --weights is what whoever started us wants now, unless we're taking
+        # over from a proxy that was started with the same arguments, in which
+        # case its weights are at least as new
+        take_weights = sockets is not None or not options.weights
+        try:
+            restored = server_state.restore_json(saved, time.time(),
+                                                 options.state_max_age,
+                                                 weights=take_weights)
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warn("Couldn't restore our state from %s (%r)", source, e)
+        else:
+            logger.info("Restored %d backends from %s", restored, source)
+
+            saved_weights = saved.get('weights')
+            if (options.weights and saved_weights is not None
+                    and saved_weights != parse_weights(options.weights)):
+                if take_weights:
+                    logger.warn("Using the weights from %s (%r), which were"
+                                " changed since --weights=%s",
+                                source, saved_weights, options.weights)
+                else:
+                    logger.warn("Using --weights=%s rather than the weights"
+                                " saved in %s (%r)", options.weights, source,
+                                saved_weights)
+
+    server_state.pools = ConnectionPools(
+        max_idle=options.pool_max_idle,
+        max_total=options.pool_max_total,
+        idle_timeout=options.pool_idle_timeout)
+
+    server_state.outliers = OutlierDetector(
+        server_state.eject,
+        consecutive_errors=options.outlier_consecutive_errors,
+        error_rate=options.outlier_error_rate,
+        min_requests=options.outlier_min_requests,
+        window=options.outlier_window,
+        ejection_time=options.outlier_ejection_time)
+    server_state.max_ejected = options.outlier_max_ejected
+    server_state.version_cookies = VersionCookies(
+        compact=options.compact_cookies)
+    singleflight_prefixes = [prefix.strip() for prefix
+                             in options.singleflight_prefixes.split(',')
+                             if prefix.strip()]
+    if singleflight_prefixes:
+        server_state.flights = SingleFlight(singleflight_prefixes)
+    if options.compress:
+        server_state.compressor = Compressor(
+            level=options.compress_level,
+            min_length=options.compress_min_length,
+            threads=options.compress_threads)
+    if options.cache_size:
+        server_state.cache = ResponseCache(
+            options.cache_size,
+            max_object=options.cache_max_object,
+            stale_while_revalidate=options.cache_stale_while_revalidate)
+    if options.balancing == 'ewma':
+        server_state.balancer = BALANCERS['ewma'](server_state.outstanding,
+                                                  decay=options.balancing_decay)
+    else:
+        server_state.balancer = BALANCERS[options.balancing](
+            server_state.outstanding)
+    server_state.set_limits(Limits(
+        connect_timeout=options.connect_timeout or None,
+        first_byte_timeout=options.first_byte_timeout or None,
+        total_timeout=options.total_timeout or None,
+        max_in_flight=options.max_in_flight or None,
+        max_in_flight_per_backend=options.max_in_flight_per_backend or None,
+        queue_timeout=options.queue_timeout))
+    server_state.retry_budget = RetryBudget(
+        ratio=options.retry_budget_ratio,
+        min_per_second=options.retry_budget_min)
+
+    raise_file_limit(files_needed(options.max_client_connections,
+                                  len(server_state.backends),
+                                  options.pool_max_total))
+
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(options.port,
+                                               backlog=options.backlog,
+                                               reuse_port=options.reuse_port)
+        tune_listening_sockets(sockets, fastopen=options.tcp_fastopen)
+    else:
+        logger.info("Took over %d listening sockets", len(sockets))
+
+    task_id = None
+    if options.num_processes != 1:
+        # the workers share the listening socket, and the non-leaders find the
+        # leader through this one
+        sync_dir = tempfile.mkdtemp(prefix='exproxyment-')
+        sync_path = os.path.join(sync_dir, 'sync.sock')
+        sync_socket = tornado.netutil.bind_unix_socket(sync_path)
+
+        # the children inherit this, so make sure that only the parent cleans
+        # up after everyone has exited
+        parent_pid = os.getpid()
+        atexit.register(lambda: (os.getpid() == parent_pid
+                                 and shutil.rmtree(sync_dir, True)))
+
+        def stop_workers(signum, frame):
+            # only the workers have anything to drain. we exit once they all
+            # have
+            workers = child_pids(parent_pid)
+            if signum == signal.SIGHUP:
+                hand_off(sockets, 'exproxyment.server')
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop_workers)
+        signal.signal(signal.SIGHUP, stop_workers)
+
+        # fork_processes only returns in the children
+        task_id = tornado.process.fork_processes(options.num_processes)
+
+    # the IOLoop has to be created after we fork
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    if task_id == 0:
+        server_state.sync = SyncLeader(server_state, sync_socket)
+
+    if not task_id:
+        HealthDaemon(ioloop,
+                     interval=options.health_interval,
+                     fast_interval=options.health_fast_interval,
+                     max_interval=options.health_max_interval,
+                     concurrency=options.health_concurrency,
+                     timeout=options.health_timeout,
+                     connect_checks=options.health_connect_checks).start()
+        PeriodicCallback(expire_leases, options.lease_check_interval * 1000,
+                         ioloop).start()
+        PeriodicCallback(finish_draining, DRAIN_CHECK_INTERVAL * 1000,
+                         ioloop).start()
+        if options.state_file:
+            server_state.saver = StateSaver(
+                server_state, options.state_file,
+                interval=options.state_save_interval, ioloop=ioloop)
+            server_state.saver.start()
+
+    if task_id:
+        server_state.sync = SyncFollower(server_state, sync_path,
+                                         report_interval=DRAIN_CHECK_INTERVAL)
+        server_state.sync.start()
+
+    application = ExproxymentApplication()
+    server = TunedHTTPServer(
+        application,
+        max_connections=options.max_client_connections or None,
+        nodelay=options.client_nodelay,
+        idle_connection_timeout=options.client_idle_timeout)
+    server.add_sockets(sockets)
+    server_state.server = server
+
+    def on_signal(signum, frame):
+        handing_off = signum == signal.SIGHUP
+        ioloop.add_callback_from_signal(shut_down,
+                                        sockets if handing_off else None)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    # with several processes, restarting is up to the one that started us
+    signal.signal(signal.SIGHUP,
+                  on_signal if task_id is None else signal.SIG_IGN)
 
     logger.info("Starting on :%d", options.port)
     ioloop.start()
@@ -3,6 +3,7 @@
 import sys
 import logging
 import json
+import random
 
 import tornado.ioloop
 import tornado.httpclient
@@ -16,13 +17,32 @@ define('port', default=8080)
 define('version', default='1')
 define('insistent', type=bool, default=False)
 
+# for pretending to be a real backend when benchmarking
+define('latency', type=float, default=0,
+       help="seconds to take over each request to /")
+define('payload_size', type=int, default=0,
+       help="bytes of padding to add to each response from /")
+define('error_rate', type=float, default=0,
+       help="fraction of requests to / to fail with a 500")
+
 define('register_from', type=str, default=None)
 define('register_to', type=str, default=None)
+define('register_ttl', type=float, default=None,
+       help="register with a lease of this many seconds, and keep renewing"
+            " it for as long as we're running")
 
 
 class MainHandler(tornado.web.RequestHandler):
 
+    @tornado.gen.coroutine
     def get(self):
+        if options.latency:
+            yield tornado.gen.sleep(options.latency)
+
+        if options.error_rate and random.random() < options.error_rate:
+            self.set_status(500)
+            return
+
         requested_version = self.request.headers.get('X-Exproxyment-Version')
 
         if (options.insistent
@@ -35,10 +55,14 @@ class MainHandler(tornado.web.RequestHandler):
                          options.version)
             return
 
-        self.write(json.dumps({
+        response = {
             'port': options.port,
             'version': options.version,
-        }))
+        }
+        if options.payload_size:
+            response['payload'] = 'x' * options.payload_size
+
+        self.write(json.dumps(response))
         self.write('\n')
 
 
@@ -62,6 +86,44 @@ class SlowHandler(tornado.web.RequestHandler):
         self.write('\n')
 
 
+class CachedHandler(tornado.web.RequestHandler):
+
+    @tornado.gen.coroutine
+    def get(self):
+        delay = float(self.get_argument('delay', 0))
+        if delay:
+            # so that requests can arrive while we're working on this one
+            yield tornado.gen.sleep(delay)
+
+        # says who answered it, so that you can tell when it comes from a cache
+        self.set_header('Cache-Control',
+                        'public, max-age=%d' % int(self.get_argument('max_age',
+                                                                     60)))
+        response = {
+            'port': options.port,
+            'version': options.version,
+        }
+
+        # ?vary=Some-Header answers differently depending on that header
+        vary = self.get_argument('vary', None)
+        if vary:
+            self.set_header('Vary', vary)
+            response['vary'] = self.request.headers.get(vary)
+
+        self.write(json.dumps(response))
+        self.write('\n')
+
+
+class EchoHandler(tornado.web.RequestHandler):
+
+    def post(self):
+        self.write(self.request.body)
+
+    get = post
+    put = post
+    delete = post
+
+
 def split_host(s):
     host, port = s.split(':')
     port = int(port)
@@ -84,6 +146,15 @@ def register_self():
         # if we fail to register ourselves, we want to kill the server
         die(repr(e))
 
+    while options.register_ttl:
+        # a few chances to renew before the lease runs out
+        yield tornado.gen.sleep(options.register_ttl / 3.0)
+
+        try:
+            yield _register_self()
+        except Exception as e:
+            logger.warn("Couldn't renew our registration (%r)", e)
+
 
 @tornado.gen.coroutine
 def _register_self():
@@ -91,8 +162,10 @@ def _register_self():
     tohost, toport = split_host(options.register_to)
 
     url = 'http://%s:%d/exproxyment/register' % (tohost, toport)
-    body = json.dumps({'backends': [
-                        {'host': fromhost, 'port': fromport}]})
+    backend = {'host': fromhost, 'port': fromport}
+    if options.register_ttl:
+        backend['ttl'] = options.register_ttl
+    body = json.dumps({'backends': [backend]})
     headers = {'Content-Type': 'application/json'}
 
     client = tornado.httpclient.AsyncHTTPClient()
@@ -112,6 +185,8 @@ def main():
         (r"/", MainHandler),
         (r"/health", HealthHandler),
         (r"/slow", SlowHandler),
+        (r"/echo", EchoHandler),
+        (r"/cached", CachedHandler),
     ])
 
     ioloop = tornado.ioloop.IOLoop.instance()
@@ -0,0 +1,130 @@
+"""
+Sharing one backend fetch between identical concurrent requests
+
+After a deploy, or when something popular expires from a client-side cache,
+lots of clients can ask for the same thing at once, and every one of them used
+to become its own request to the backends. For the path prefixes that it's
+turned on for, concurrent GETs and HEADs for the same version and URI share a
+single fetch, and every waiter is sent the same response.
+
+A waiter only gets someone else's response if a shared cache could have given
+it to them: it doesn't set a cookie, isn't private or no-store, and the waiter
+sent the same values of whatever it varies on. Otherwise the waiter makes a
+fetch of its own. Requests with an Authorization header never share
+"""
+
+import tornado.concurrent
+
+from .cache import parse_cache_control
+from .headers import normalize
+from .metrics import escape
+
+# the only methods that are safe to answer with someone else's response
+SHARED_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class FlightCounts(object):
+
+    __slots__ = ('flights', 'merged', 'fallbacks')
+
+    def __init__(self):
+        # fetches that we made on behalf of a flight
+        self.flights = 0
+        # requests that were answered by someone else's fetch
+        self.merged = 0
+        # requests that waited on a fetch that failed, or whose response
+        # wasn't theirs to have, and so made their own
+        self.fallbacks = 0
+
+
+class SingleFlight(object):
+
+    def __init__(self, prefixes):
+        # longest first, so that the most specific prefix gets the counts
+        self.prefixes = sorted(set(prefixes), key=len, reverse=True)
+        self.counts = dict((prefix, FlightCounts())
+                           for prefix in self.prefixes)
+
+        # key -> Future resolving to what the fetch for that key returned and
+        # the headers of the request that it was for
+        self.pending = {}
+
+    def prefix_for(self, request):
+        """
+        The prefix that `request` shares fetches under, or None if it doesn't
+        """
+
+        if (request.method not in SHARED_METHODS
+                or 'Authorization' in request.headers):
+            return None
+
+        path = request.path
+        for prefix in self.prefixes:
+            if path.startswith(prefix):
+                return prefix
+
+        return None
+
+    def wait(self, key):
+        return self.pending.get(key)
+
+    def start(self, key):
+        self.pending[key] = tornado.concurrent.Future()
+
+    def finish(self, key, result, headers):
+        future = self.pending.pop(key, None)
+        if future is not None:
+            future.set_result((result, headers))
+
+    @staticmethod
+    def shareable(response, headers, waiter_headers):
+        """
+        Whether `response`, fetched for a request with `headers`, can also
+        answer a request with `waiter_headers`
+        """
+
+        response_headers = response.headers
+        if 'Set-Cookie' in response_headers:
+            return False
+
+        directives = parse_cache_control(response_headers.get('Cache-Control'))
+        if 'private' in directives or 'no-store' in directives:
+            return False
+
+        for name in response_headers.get('Vary', '').split(','):
+            name = normalize(name)
+            if not name:
+                continue
+            if (name == '*'
+                    or headers.get(name) != waiter_headers.get(name)):
+                return False
+
+        return True
+
+    def to_json(self):
+        return dict((prefix, {'flights': counts.flights,
+                              'merged': counts.merged,
+                              'fallbacks': counts.fallbacks})
+                    for (prefix, counts) in self.counts.iteritems())
+
+    def render(self):
+        """
+        Our counts in the Prometheus text format
+        """
+
+        lines = []
+
+        for name, description in (
+                ('flights', 'Fetches shared between identical requests'),
+                ('merged', 'Requests answered by a shared fetch'),
+                ('fallbacks', 'Requests whose shared fetch failed or'
+                              ' answered someone else')):
+            metric = 'exproxyment_singleflight_%s_total' % (name,)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % (metric,))
+            for prefix in sorted(self.counts):
+                lines.append('%s{prefix="%s"} %d'
+                             % (metric, escape(prefix),
+                                getattr(self.counts[prefix], name)))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,215 @@
+"""
+Keeps the backend state of several worker processes in agreement
+
+When we run with more than one process, one of them (the leader) runs the
+health checks and is the authority on what the backends and weights are. The
+others (followers) connect to it over a unix socket. The leader sends every
+follower a snapshot of its state whenever it changes, and followers pass any
+configuration changes that they receive to the leader so that it can pass them
+on to everyone else.
+
+Snapshots carry the leader's generation, which goes up with every change, so
+followers can ignore any that are older than what they already have, and
+/health on each process says which of the leader's generations it has.
+
+While backends are draining, followers also report how many requests they
+have in flight to them, and which generation they'd seen when they counted,
+so that the leader only removes a draining backend once none of us are using
+it.
+
+Messages in both directions are JSON objects, one per line
+"""
+
+import json
+import logging
+import socket
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+from tornado.ioloop import PeriodicCallback
+
+logger = logging.getLogger(__name__)
+
+
+class SyncLeader(object):
+
+    def __init__(self, state, sock):
+        self.state = state
+        self.followers = set()
+        self.broadcast_pending = False
+        # follower -> (generation, {backend: requests in flight}), from the
+        # last time that it reported on the backends that are draining
+        self.reports = {}
+
+        state.change_listeners.append(self.changed)
+        tornado.netutil.add_accept_handler(sock, self.accept)
+
+    def accept(self, connection, address):
+        stream = tornado.iostream.IOStream(connection)
+        self.followers.add(stream)
+        stream.set_close_callback(lambda: self.lost(stream))
+
+        self.send(stream, json.dumps(self.state.to_json()) + '\n')
+        tornado.ioloop.IOLoop.current().spawn_callback(self.read, stream)
+
+    @tornado.gen.coroutine
+    def read(self, stream):
+        try:
+            while True:
+                line = yield stream.read_until('\n')
+                change = json.loads(line)
+
+                if change['op'] == 'report':
+                    self.reports[stream] = (
+                        change['generation'],
+                        dict(((host, port), count)
+                             for (host, port, count) in change['outstanding']))
+                    continue
+
+                logger.debug("Applying forwarded change %r", change)
+                self.state.apply_change(change)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def lost(self, stream):
+        self.followers.discard(stream)
+        self.reports.pop(stream, None)
+
+    def outstanding(self, backend, since):
+        """
+        How many requests the followers have in flight to `backend`, from
+        reports made since they saw generation `since`, or None if some of
+        them haven't reported since then
+        """
+
+        total = 0
+
+        for stream in self.followers:
+            report = self.reports.get(stream)
+            if report is None or report[0] < since:
+                return None
+            total += report[1].get(backend, 0)
+
+        return total
+
+    def changed(self):
+        # a round of health checks can change a lot of backends at once, so
+        # send one snapshot after they're all done rather than one per change
+        if not self.broadcast_pending:
+            self.broadcast_pending = True
+            tornado.ioloop.IOLoop.current().add_callback(self.broadcast)
+
+    def broadcast(self):
+        self.broadcast_pending = False
+
+        message = json.dumps(self.state.to_json()) + '\n'
+        for stream in list(self.followers):
+            self.send(stream, message)
+
+    def send(self, stream, message):
+        try:
+            stream.write(message)
+        except tornado.iostream.StreamClosedError:
+            self.lost(stream)
+
+    def to_json(self):
+        return {'role': 'leader',
+                'followers': len(self.followers),
+                'generation': self.state.generation}
+
+    def forward(self, change):
+        # we already applied it, and the followers hear about it through
+        # changed()
+        pass
+
+
+class SyncFollower(object):
+
+    def __init__(self, state, path, retry_delay=1.0, report_interval=0.25):
+        self.state = state
+        self.path = path
+        self.retry_delay = retry_delay
+        self.stream = None
+        # the generation of the last snapshot that we loaded from the leader
+        self.generation = None
+
+        self.reporter = PeriodicCallback(self.report, report_interval * 1000)
+
+    def to_json(self):
+        return {'role': 'follower',
+                'connected': self.stream is not None,
+                'generation': self.generation}
+
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+        self.reporter.start()
+
+    def report(self):
+        """
+        Tell the leader how many requests we have in flight to the backends
+        that are draining
+        """
+
+        if (self.stream is None or self.generation is None
+                or not self.state.draining):
+            return
+
+        outstanding = [[backend.host, backend.port,
+                        self.state.outstanding(backend)]
+                       for backend in self.state.draining]
+
+        try:
+            self.stream.write(json.dumps({'op': 'report',
+                                          'generation': self.generation,
+                                          'outstanding': outstanding})
+                              + '\n')
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def outstanding(self, backend, since):
+        # only the leader decides when a backend is drained
+        return 0
+
+    @tornado.gen.coroutine
+    def run(self):
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                stream = tornado.iostream.IOStream(sock)
+                yield stream.connect(self.path)
+                self.stream = stream
+                # a leader that's restarted starts counting again
+                self.generation = None
+
+                while True:
+                    line = yield stream.read_until('\n')
+                    js = json.loads(line)
+
+                    generation = js.get('generation')
+                    if (generation is not None and self.generation is not None
+                            and generation <= self.generation):
+                        continue
+
+                    self.state.load_json(js)
+                    self.generation = generation
+
+                    # so that the leader hears about a new drain right away
+                    self.report()
+
+            except tornado.iostream.StreamClosedError:
+                # the leader went away. we keep serving from what we last
+                # heard until it comes back
+                logger.warn("Lost connection to the leader at %s", self.path)
+                self.stream = None
+
+            yield tornado.gen.sleep(self.retry_delay)
+
+    def forward(self, change):
+        if self.stream is None:
+            logger.warn("Not connected to the leader, %r only applies to this"
+                        " process", change)
+            return
+
+        self.stream.write(json.dumps(change) + '\n')
@@ -0,0 +1,132 @@
+"""
+Making sure we can hold as many sockets as we've been told to, and tuning them
+
+Every client connection and every pooled backend connection is a file
+descriptor, and the default limit on those is often only 1024. Going over it
+doesn't fail politely, it just makes accept() and connect() start failing with
+EMFILE in the middle of a burst. So at startup we work out how many we might
+need, raise our limit if we're allowed to, and complain loudly if that still
+isn't enough
+"""
+
+import logging
+import resource
+import socket
+import sys
+
+import tornado.httpserver
+
+logger = logging.getLogger(__name__)
+
+# plenty for the log files, the sync socket, health checks and so on
+SPARE_FILES = 64
+
+# Linux's value, which the socket module of this python doesn't know about
+TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN',
+                       23 if sys.platform.startswith('linux') else None)
+
+
+def files_needed(max_client_connections, backends, pool_max_total):
+    """
+    How many file descriptors one process might have open at once. Without a
+    limit on client connections we can only guess, so we assume the pools
+    are the bigger part of it
+    """
+
+    clients = max_client_connections or pool_max_total * max(1, backends)
+    return clients + pool_max_total * max(1, backends) + SPARE_FILES
+
+
+def raise_file_limit(needed):
+    """
+    Raise our soft limit on open files towards `needed`, as far as the hard
+    limit lets us. Returns the limit that we ended up with
+    """
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        target = needed
+        if hard != resource.RLIM_INFINITY:
+            target = min(needed, hard)
+
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, resource.error) as e:
+            logger.warn("Couldn't raise our open file limit to %d (%s)",
+                        target, e)
+        else:
+            logger.info("Raised our open file limit from %d to %d",
+                        soft, target)
+            soft = target
+
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        logger.warn("We can only have %d files open but may need %d. Under"
+                    " load we'll start refusing connections (EMFILE). Raise"
+                    " the limit with ulimit -n, or lower --pool_max_total and"
+                    " --max_client_connections", soft, needed)
+
+    return soft
+
+
+def tune_listening_sockets(sockets, fastopen=0):
+    """
+    Turn on TCP Fast Open with a queue of `fastopen` pending connections,
+    where the platform has it
+    """
+
+    if not fastopen:
+        return
+
+    if TCP_FASTOPEN is None:
+        logger.warn("TCP Fast Open isn't available here")
+        return
+
+    for sock in sockets:
+        if sock.family not in (socket.AF_INET, socket.AF_INET6):
+            continue
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, fastopen)
+        except socket.error as e:
+            logger.warn("Couldn't turn on TCP Fast Open (%s)", e)
+            return
+
+
+class TunedHTTPServer(tornado.httpserver.HTTPServer):
+
+    """
+    An HTTPServer that can refuse client connections over
+    `max_connections` rather than running out of files, and can turn off
+    Nagle's algorithm on the ones it accepts
+    """
+
+    def initialize(self, *args, **kwargs):
+        self.max_connections = kwargs.pop('max_connections', None)
+        self.nodelay = kwargs.pop('nodelay', False)
+
+        super(TunedHTTPServer, self).initialize(*args, **kwargs)
+
+        self.open_connections = 0
+        self.refused = 0
+
+    def handle_stream(self, stream, address):
+        if (self.max_connections
+                and self.open_connections >= self.max_connections):
+            self.refused += 1
+            stream.close()
+            return
+
+        if self.nodelay:
+            stream.set_nodelay(True)
+
+        self.open_connections += 1
+        super(TunedHTTPServer, self).handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        self.open_connections -= 1
+        super(TunedHTTPServer, self).on_close(server_conn)
+
+    def to_json(self):
+        return {'open': self.open_connections,
+                'max': self.max_connections,
+                'refused': self.refused}
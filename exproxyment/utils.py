@@ -1,3 +1,12 @@
+from collections import OrderedDict
+import bisect
+import hashlib
+import json
+import random
+import struct
+import urllib
+
+
 def parse_backends(b_str):
     backends = b_str.split(',')
     backends = map(lambda s: s.split(':'), backends)
@@ -25,3 +34,310 @@ def unparse_weights(w_json):
     return ','.join('%s:%d' % (version, weight)
                     for version, weight
                     in w_json.items())
+
+
+class WeightedChoice(object):
+
+    """
+    Picks from a set of items with probability proportional to their weights.
+    The cumulative weights are computed once up front so that each pick is a
+    binary search, no matter how large the weights are
+    """
+
+    def __init__(self, weighted):
+        self.items = []
+        self.totals = []
+        self.total = 0
+
+        for item, weight in weighted:
+            if weight > 0:
+                self.total += weight
+                self.items.append(item)
+                self.totals.append(self.total)
+
+    def __len__(self):
+        return len(self.items)
+
+    def choose(self, point=None):
+        """
+        Pick an item. `point` is a number in [0, 1) to pick with, defaulting to
+        a random one
+        """
+
+        if not self.items:
+            return None
+
+        if point is None:
+            point = random.random()
+
+        position = bisect.bisect_right(self.totals, point * self.total)
+        return self.items[min(position, len(self.items) - 1)]
+
+
+def hash_point(key):
+    """
+    Hash a string onto the 32-bit space that HashRing uses
+    """
+
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+
+    return struct.unpack_from('<I', hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+
+    """
+    A ketama-style consistent hash ring. Each item gets a number of points on
+    the ring proportional to its weight, and a key belongs to the first item
+    point at or after the key's own hash. Adding or removing an item only moves
+    the keys that land near that item's points
+
+    `points` is how many points an item of average weight gets
+    """
+
+    def __init__(self, weighted, points=160):
+        weighted = [(item, weight) for (item, weight) in weighted
+                    if weight > 0]
+
+        ring = []
+
+        if weighted:
+            total = float(sum(weight for (item, weight) in weighted))
+            average = total / len(weighted)
+
+            for item, weight in weighted:
+                count = max(1, int(round(points * weight / average)))
+                ring.extend((point, item)
+                            for point in self.item_points(item, count))
+
+        ring.sort()
+        self.points = [point for (point, item) in ring]
+        self.items = [item for (point, item) in ring]
+
+    @staticmethod
+    def item_points(item, count):
+        if isinstance(item, unicode):
+            # versions that came to us as JSON. ascii ones hash the same
+            # either way
+            item = item.encode('utf-8')
+
+        # four points out of each md5, the same way ketama does it
+        for i in xrange((count + 3) // 4):
+            digest = hashlib.md5('%s-%d' % (item, i)).digest()
+            for point in struct.unpack('<IIII', digest)[:count - i * 4]:
+                yield point
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        if not self.items:
+            return None
+
+        position = bisect.bisect_left(self.points, hash_point(key))
+        if position == len(self.points):
+            position = 0
+
+        return self.items[position]
+
+
+class SlidingCounts(object):
+
+    """
+    Approximate counts of a few kinds of events over the last `window` seconds.
+    Rather than remember every event we keep counts for the current and the
+    previous window and weight the previous one by how much of it still
+    overlaps the sliding window, so counting is constant time and memory
+    """
+
+    __slots__ = ('window', 'start', 'current', 'previous')
+
+    def __init__(self, window, now, kinds=2):
+        self.window = window
+        self.start = now
+        self.current = [0] * kinds
+        self.previous = [0] * kinds
+
+    def roll(self, now):
+        elapsed = now - self.start
+
+        if elapsed < self.window:
+            return
+
+        if elapsed < 2 * self.window:
+            self.previous = self.current
+            self.start += self.window
+        else:
+            # nothing at all happened in the last window
+            self.previous = [0] * len(self.current)
+            self.start = now
+
+        self.current = [0] * len(self.current)
+
+    def add(self, now, kind, count=1):
+        self.roll(now)
+        self.current[kind] += count
+
+    def totals(self, now):
+        self.roll(now)
+        overlap = max(0.0, 1.0 - (now - self.start) / self.window)
+        return [current + previous * overlap
+                for (current, previous) in zip(self.current, self.previous)]
+
+
+class RetryBudget(object):
+
+    """
+    Limits retries to `ratio` of the requests seen over the last `window`
+    seconds, plus `min_per_second` so that a quiet proxy can still retry. When
+    a whole version is failing this stops every request from turning into
+    several and piling even more load onto whatever is left
+    """
+
+    REQUESTS, RETRIES = 0, 1
+
+    def __init__(self, ratio=0.1, min_per_second=10.0, window=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.counts = SlidingCounts(window, 0)
+
+    def request(self, now):
+        self.counts.add(now, self.REQUESTS)
+
+    def retry(self, now):
+        """
+        Spend a retry if there's any budget left. Returns whether there was
+        """
+
+        requests, retries = self.counts.totals(now)
+        allowed = (self.ratio * requests
+                   + self.min_per_second * self.counts.window)
+
+        if retries + 1 > allowed:
+            return False
+
+        self.counts.add(now, self.RETRIES)
+        return True
+
+
+class LRUCache(object):
+
+    """
+    A dict that holds at most `size` items, forgetting the least recently used
+    ones to make room. If `weigh` is given then it's the total of weigh(value)
+    over the items that's held to `size` instead of how many there are
+    """
+
+    def __init__(self, size, weigh=None):
+        self.size = size
+        self.weigh = weigh
+        self.items = OrderedDict()
+
+        self.weight = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+
+        # move it to the most recently used end
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.pop(key)
+
+        self.items[key] = value
+        self.weight += self.weigh(value) if self.weigh else 1
+
+        while self.weight > self.size and self.items:
+            self.pop(next(iter(self.items)))
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+
+        self.weight -= self.weigh(value) if self.weigh else 1
+        return value
+
+
+class VersionCookies(object):
+
+    """
+    Reads and writes the cookies that remember which version a user asked for.
+    The original format is URL-quoted JSON like {"version": "present"}, and the
+    compact format is just v1:present. We read either, and write the compact
+    one if `compact` is set.
+
+    Users send the same handful of cookie values over and over, so what each
+    one decodes to is remembered, including that it's malformed (None). Values
+    longer than `max_length` aren't worth remembering and are never valid
+    """
+
+    COMPACT_PREFIX = 'v1:'
+
+    def __init__(self, compact=False, size=1024, max_length=256):
+        self.compact = compact
+        self.max_length = max_length
+
+        self.decoded = LRUCache(size)
+        self.encoded = LRUCache(size)
+
+    def decode(self, value):
+        """
+        The version in a cookie value, or None if it's malformed
+        """
+
+        if len(value) > self.max_length:
+            return None
+
+        version = self.decoded.get(value, self)
+        if version is self:
+            version = self.parse(value)
+            self.decoded.put(value, version)
+
+        return version
+
+    def parse(self, value):
+        if value.startswith(self.COMPACT_PREFIX):
+            # quoted UTF-8, so that it comes out as the same unicode that the
+            # backends' JSON gives us for their versions
+            try:
+                version = urllib.unquote(
+                    value[len(self.COMPACT_PREFIX):]).decode('utf-8')
+            except UnicodeError:
+                return None
+        else:
+            try:
+                version = json.loads(urllib.unquote(value))['version']
+            except (ValueError, TypeError, KeyError):
+                return None
+
+        if not isinstance(version, basestring) or not version:
+            return None
+
+        return version
+
+    def encode(self, version):
+        value = self.encoded.get(version)
+
+        if value is None:
+            if self.compact:
+                # quote() only takes bytes
+                value = self.COMPACT_PREFIX + urllib.quote(
+                    version.encode('utf-8')
+                    if isinstance(version, unicode) else version)
+            else:
+                value = urllib.quote(json.dumps({'version': version}))
+            self.encoded.put(version, value)
+
+        return value
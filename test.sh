@@ -6,6 +6,11 @@
 # 1. In one window, launch test.sh
 # 2. In another window, launch test2.sh
 # 3. Watch for exceptions in either window
+# Any arguments are passed on to the proxy, so e.g. `./test.sh --streaming`
+# runs the same tests against the streaming proxy. test2.sh also runs the unit
+# tests in tests/, which don't need any of this
+# (with --num_processes the --activity checks will only see the requests of
+# whichever worker answers them)
 
 set -e
 
@@ -14,6 +14,49 @@ set -v
 # 7008: past --register_from=localhost:7008 --register_to=localhost:7000 \
 # 7009: future --register_from=localhost:7009 --register_to=localhost:7000 \
 
+# the parts that don't need any servers
+python -m unittest discover -s tests
+
+# some of the tests below need proxies of their own with different options.
+# start_proxy PORT OPTIONS... starts one in front of 7001 and 7002 (unless the
+# options say otherwise) and waits for it to be ready, and start_backend PORT
+# OPTIONS... does the same for a backend that we can stop. they're all stopped
+# when we exit
+PIDS=
+trap 'kill $PIDS 2>/dev/null || true' EXIT
+wait_for() {
+    for i in $(seq 50); do
+        curl -sf http://localhost:$1/health >/dev/null && break
+        sleep 0.2
+    done
+    curl -sf http://localhost:$1/health >/dev/null
+}
+start_proxy() {
+    port=$1
+    shift
+    python -m exproxyment.server --logging=warn --port=$port \
+        --backends=localhost:7001,localhost:7002 "$@" &
+    PROXY=$!
+    PIDS="$PIDS $PROXY"
+    wait_for $port
+}
+start_backend() {
+    port=$1
+    shift
+    python -m exproxyment.simpleserver --logging=warn --port=$port "$@" &
+    BACKEND=$!
+    PIDS="$PIDS $BACKEND"
+    wait_for $port
+}
+# the fields of one backend in a proxy's /health
+backend_health() {
+    curl -s http://localhost:$1/health | python -c '
+import json, sys
+for backend in json.load(sys.stdin)["backends"]:
+    if backend["port"] == int(sys.argv[1]):
+        print json.dumps(backend, sort_keys=True)' $2
+}
+
 # test that --server works so we can use the default from now on
 python -m exproxyment.config --server=$(hostname):7000 --health
 ! python -m exproxyment.config --server=$(hostname):7999 --health >/dev/null 2>&1
@@ -41,6 +84,19 @@ curl http://localhost:7001/health
 # basic operation
 curl http://localhost:7000 | grep version
 
+# request bodies make it through and back
+head -c 1048576 /dev/urandom > upload.bin
+curl -s --data-binary @upload.bin http://localhost:7000/echo | cmp - upload.bin
+rm upload.bin
+
+# whatever the method, and however the body is framed
+echo 'not just for POSTs' > upload.txt
+curl -s -X DELETE --data-binary @upload.txt http://localhost:7000/echo | cmp - upload.txt
+curl -s -X DELETE -H 'Transfer-Encoding: chunked' --data-binary @upload.txt http://localhost:7000/echo | cmp - upload.txt
+curl -s -X PUT -H 'Transfer-Encoding: chunked' --data-binary @upload.txt http://localhost:7000/echo | cmp - upload.txt
+curl -s -X GET --data-binary @upload.txt http://localhost:7000/echo | cmp - upload.txt
+rm upload.txt
+
 # test activity
 curl http://localhost:7000/slow &
 python -m exproxyment.config --activity | grep 127
@@ -71,6 +127,12 @@ curl -v http://localhost:7000 -b 'exproxyment_request_version='%7B%22version%22%
 curl -v http://localhost:7000 -b 'exproxyment_request_version='%7B%22version%22%3A%20%22future%22%7D'' 2>&1 | grep -E 'X-Exproxyment-Version: future'
 curl -v http://localhost:7000 -b 'exproxyment_request_version='%7B%22version%22%3A%20%22never%22%7D'' 2>&1 | grep -E 'X-Exproxyment-Version: (past|present)'
 
+# compact cookies, and malformed ones that should just be ignored
+curl -v http://localhost:7000 -b 'exproxyment_request_version=v1:past' 2>&1 | grep -E 'X-Exproxyment-Version: past'
+curl -v http://localhost:7000 -b 'exproxyment_require_version=v1:future' 2>&1 | grep -E 'X-Exproxyment-Version: future'
+curl -v http://localhost:7000 -b 'exproxyment_request_version=%7Bnope' 2>&1 | grep -E 'X-Exproxyment-Version: (past|present)'
+curl -v http://localhost:7000 -b 'exproxyment_require_version=%5B%5D' 2>&1 | grep -E 'X-Exproxyment-Version: (past|present)'
+
 # cookie round trip
 rm -fv cookie.jar
 v1=`curl -v -b cookie.jar -c cookie.jar http://127.0.0.1:7000/ 2>&1 | awk '/X-Exproxyment-Version/ {print $3}'`
@@ -85,4 +147,241 @@ echo "request for $v1 got $v2"
 
 rm cookie.jar
 
+# metrics
+curl -s http://localhost:7000/exproxyment/metrics | grep -E '^exproxyment_upstream_responses_total\{version="(past|present)",.*,code="200"\}'
+curl -s http://localhost:7000/exproxyment/metrics | grep -E '^exproxyment_upstream_latency_seconds_count\{version="(past|present)"'
+
+# changing some of the limits leaves the rest alone, and bad ones are refused
+python -m exproxyment.config --limits='{"queue_timeout": 0.5}'
+python -m exproxyment.config --limits='{"max_in_flight": 1000}'
+curl -s http://localhost:7000/exproxyment/configure | grep '"queue_timeout": 0.5'
+curl -s http://localhost:7000/exproxyment/configure | grep '"max_in_flight": 1000'
+! curl -sf -X POST http://localhost:7000/exproxyment/configure -d '{"limits": {"max_in_flight": -5}}'
+! curl -sf -X POST http://localhost:7000/exproxyment/configure -d '{"limits": {"queue_timeout": true}}'
+# 0 in flight means no limit, as it does on the command line
+python -m exproxyment.config --limits='{"max_in_flight": 0}'
+curl -s http://localhost:7000 | grep version
+python -m exproxyment.config --limits='{"queue_timeout": 0.1, "max_in_flight": null}'
+curl -s http://localhost:7000 | grep version
+
+# response caching
+start_proxy 7020 --cache_size=1000000
+curl -sv http://localhost:7020/cached 2>&1 | grep 'X-Exproxyment-Cache: MISS'
+curl -sv http://localhost:7020/cached 2>&1 | grep 'X-Exproxyment-Cache: HIT'
+curl -sv http://localhost:7020/ 2>&1 | grep 'X-Exproxyment-Cache: MISS'
+curl -sv http://localhost:7020/ 2>&1 | grep 'X-Exproxyment-Cache: MISS'
+
+# requests that arrive while the first one is being fetched only share its
+# response if it doesn't vary on something that they sent differently
+curl -s -H 'Accept-Language: en' 'http://localhost:7020/cached?vary=Accept-Language&delay=1' > en.out &
+sleep 0.3
+curl -s -H 'Accept-Language: fr' 'http://localhost:7020/cached?vary=Accept-Language&delay=1' | grep '"vary": "fr"'
+wait $!
+grep '"vary": "en"' en.out
+rm en.out
+curl -sv -H 'Accept-Language: en' 'http://localhost:7020/cached?vary=Accept-Language&delay=1' 2>&1 | grep 'X-Exproxyment-Cache: HIT'
+
+# a restarted proxy picks up where it left off, except for what it's told
+# otherwise on its command line
+rm -f state.json
+start_proxy 7021 --state_file=state.json --state_save_interval=0.1 --weights=past:1
+python -m exproxyment.config --server=localhost:7021 --add=localhost:7003
+python -m exproxyment.config --server=localhost:7021 --weights=past:5,present:1
+sleep 0.5
+kill $PROXY
+wait $PROXY || true
+start_proxy 7021 --state_file=state.json --weights=past:2
+python -m exproxyment.config --server=localhost:7021 --show | grep localhost:7003
+python -m exproxyment.config --server=localhost:7021 --show | grep 'weights: past:2$'
+kill $PROXY
+wait $PROXY || true
+rm state.json
+
+# and one that can't read what it left behind starts from its command line
+echo 'not json' > state.json
+start_proxy 7021 --state_file=state.json
+python -m exproxyment.config --server=localhost:7021 --show | grep localhost:7001
+! python -m exproxyment.config --server=localhost:7021 --show | grep localhost:7003
+kill $PROXY
+wait $PROXY || true
+rm state.json
+
+# response compression, for clients that take it and responses big enough to
+# be worth it
+start_proxy 7022 --compress --compress_min_length=100 --singleflight_prefixes=/cached
+head -c 4096 /dev/zero > upload.bin
+curl -s -D - -o /dev/null -H 'Accept-Encoding: gzip' --data-binary @upload.bin http://localhost:7022/echo | grep -i '^Content-Encoding: gzip'
+curl -s --compressed --data-binary @upload.bin http://localhost:7022/echo | cmp - upload.bin
+! curl -s -D - -o /dev/null --data-binary @upload.bin http://localhost:7022/echo | grep -i '^Content-Encoding'
+! curl -s -D - -o /dev/null -H 'Accept-Encoding: gzip' -d small http://localhost:7022/echo | grep -i '^Content-Encoding'
+rm upload.bin
+
+# identical requests at the same time share one fetch, and different ones don't
+curl -s 'http://localhost:7022/cached?delay=1' > a.out &
+a=$!
+curl -s 'http://localhost:7022/cached?delay=1' > b.out &
+b=$!
+curl -s 'http://localhost:7022/cached?delay=1&other' > c.out &
+c=$!
+wait $a $b $c
+cmp a.out b.out
+grep version c.out
+rm a.out b.out c.out
+curl -s http://localhost:7022/exproxyment/activity | python -c '
+import json, sys
+counts = json.load(sys.stdin)["singleflight"]["/cached"]
+assert counts["flights"] == 2 and counts["merged"] == 1, counts'
+# and only when the response could be theirs
+curl -s -H 'Accept-Language: en' 'http://localhost:7022/cached?vary=Accept-Language&delay=1' > en.out &
+en=$!
+sleep 0.3
+curl -s -H 'Accept-Language: fr' 'http://localhost:7022/cached?vary=Accept-Language&delay=1' | grep '"vary": "fr"'
+wait $en
+grep '"vary": "en"' en.out
+rm en.out
+curl -s 'http://localhost:7022/cached?delay=1&auth' > a.out &
+a=$!
+curl -s -H 'Authorization: Basic Zm9vOmJhcg==' 'http://localhost:7022/cached?delay=1&auth' | grep version
+wait $a
+rm a.out
+curl -s http://localhost:7022/exproxyment/activity | python -c '
+import json, sys
+counts = json.load(sys.stdin)["singleflight"]["/cached"]
+assert (counts["flights"], counts["merged"], counts["fallbacks"]) == (4, 1, 1), counts'
+
+# the streaming proxy, whatever the body and however it's framed
+start_proxy 7023 --streaming
+head -c 1048576 /dev/urandom > upload.bin
+curl -s --data-binary @upload.bin http://localhost:7023/echo | cmp - upload.bin
+curl -s -X PUT -H 'Transfer-Encoding: chunked' --data-binary @upload.bin http://localhost:7023/echo | cmp - upload.bin
+rm upload.bin
+curl -s http://localhost:7023/slow | grep 'model English'
+curl -v http://localhost:7023?exproxyment_require_version=never 2>&1 | grep -E 'no backend available for never'
+# and a client that hangs up part way through its body doesn't leave the
+# backend waiting for the rest
+head -c 200000 /dev/zero > upload.bin
+! curl -s -m 1 --limit-rate 20k --data-binary @upload.bin http://localhost:7023/echo
+sleep 0.5
+curl -s http://localhost:7023/exproxyment/activity | python -c '
+import json, sys
+activity = json.load(sys.stdin)
+assert activity["total"] == 0, activity'
+rm upload.bin
+
+# a limit on requests in flight sheds the ones over it, and a route can have
+# timeouts of its own
+start_proxy 7024 --max_in_flight=1 --queue_timeout=0.1
+curl -s http://localhost:7024/slow > slow.out &
+sleep 0.5
+curl -s -o /dev/null -w '%{http_code}' http://localhost:7024/ | grep 503
+wait $!
+grep 'model English' slow.out
+rm slow.out
+curl -s http://localhost:7024/ | grep version
+# and a client that gives up keeps its slot for as long as the backend's
+# still working on its request
+! curl -s -m 0.5 http://localhost:7024/slow
+curl -s -o /dev/null -w '%{http_code}' http://localhost:7024/ | grep 503
+sleep 2
+curl -s http://localhost:7024/ | grep version
+python -m exproxyment.config --server=localhost:7024 --limits='{"routes": {"/slow": {"total_timeout": 0.5}}}'
+curl -s -o /dev/null -w '%{http_code}' http://localhost:7024/slow | grep 504
+curl -s http://localhost:7024/ | grep version
+
+# the wait for the first byte only starts once the backend has the whole
+# request, however long that takes to send
+start_proxy 7029 --streaming --first_byte_timeout=1
+head -c 200000 /dev/zero > upload.bin
+curl -s --limit-rate 60k --data-binary @upload.bin http://localhost:7029/echo | cmp - upload.bin
+rm upload.bin
+curl -s -o /dev/null -w '%{http_code}' http://localhost:7029/slow | grep 504
+
+# backends that we can stop
+start_backend 7030 --version=present
+B7030=$BACKEND
+start_backend 7031 --version=present
+B7031=$BACKEND
+
+# a deregistered backend finishes the requests that it has, and gets no new
+# ones meanwhile
+start_proxy 7025 --backends=localhost:7030
+curl -s http://localhost:7025/slow > slow.out &
+slow=$!
+sleep 0.5
+curl -s -X POST http://localhost:7025/exproxyment/backends -d '{"remove": [{"host": "localhost", "port": 7030}], "drain": 10}' | grep '"removed": 1'
+backend_health 7025 7030 | grep '"draining": true'
+! curl -sf http://localhost:7025/
+wait $slow
+grep 'model English' slow.out
+sleep 0.5
+[ -z "$(backend_health 7025 7030)" ]
+
+# but only for as long as it's given
+python -m exproxyment.config --server=localhost:7025 --add=localhost:7030
+sleep 0.5
+curl -s http://localhost:7025/slow > slow.out &
+slow=$!
+sleep 0.5
+curl -s -X POST http://localhost:7025/exproxyment/backends -d '{"remove": [{"host": "localhost", "port": 7030}], "drain": 0.5}' | grep '"removed": 1'
+sleep 1
+[ -z "$(backend_health 7025 7030)" ]
+wait $slow || true
+rm slow.out
+
+# SIGHUP hands the listening socket and our state to a new proxy, which
+# answers new requests while the old one finishes what it has
+start_proxy 7026
+python -m exproxyment.config --server=localhost:7026 --add=localhost:7003
+curl -s http://localhost:7026/slow > slow.out &
+slow=$!
+sleep 0.5
+kill -HUP $PROXY
+sleep 1
+curl -s http://localhost:7026/ | grep version
+python -m exproxyment.config --server=localhost:7026 --show | grep localhost:7003
+wait $slow
+grep 'model English' slow.out
+rm slow.out
+wait $PROXY
+# and SIGTERM finishes them and stops
+curl -s http://localhost:7026/slow > slow.out &
+slow=$!
+sleep 0.5
+pkill -TERM -f 'exproxyment.server --logging=warn --port=7026'
+sleep 0.5
+! curl -s http://localhost:7026/
+wait $slow
+grep 'model English' slow.out
+rm slow.out
+
+# requests that can't get through to a backend are retried on another, and a
+# backend that keeps failing them is taken out for a while
+start_proxy 7027 --backends=localhost:7030,localhost:7031 --health_interval=60 --health_max_interval=60 --outlier_consecutive_errors=2 --outlier_ejection_time=2
+kill $B7031
+wait $B7031 || true
+for i in $(seq 20); do
+    curl -sf http://localhost:7027/ | grep 7030
+done
+curl -s http://localhost:7027/exproxyment/metrics | grep -E '^exproxyment_upstream_retries_total\{.*backend="localhost:7031"\} [1-9]'
+backend_health 7027 7031 | grep '"ejected": true'
+sleep 2.5
+backend_health 7027 7031 | grep '"ejected": false'
+# until there's nowhere left to retry them
+kill $B7030
+wait $B7030 || true
+curl -s http://localhost:7027/ | grep 'bad connection'
+
+# health checks only get the whole /health when it's changed
+start_proxy 7028 --health_interval=0.2 --health_max_interval=0.2
+sleep 2
+curl -s http://localhost:7028/exproxyment/metrics | grep -E '^exproxyment_health_probes_total\{backend="localhost:7001",kind="full"\} 1$'
+curl -s http://localhost:7028/exproxyment/metrics | grep -E '^exproxyment_health_probes_total\{backend="localhost:7001",kind="cached"\} [1-9]'
+
+# leased registrations go away on their own
+python -m exproxyment.config --add=localhost:7010 --ttl=1
+python -m exproxyment.config --show | grep localhost:7010
+sleep 3
+! python -m exproxyment.config --show | grep localhost:7010
+! curl -s -X POST http://localhost:7000/exproxyment/backends -d '{"add": [{"host": "localhost", "port": "7010"}]}' | grep ok
+
 echo 'success!'
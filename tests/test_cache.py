@@ -0,0 +1,96 @@
+"""
+Which responses the cache keeps, and for how long
+"""
+
+import unittest
+
+from tornado.httputil import HTTPHeaders
+
+from exproxyment.cache import ResponseCache, parse_cache_control
+from exproxyment.pool import PooledResponse
+from exproxyment.server import Backend
+
+NOW = 1000000.0
+
+
+def response(code=200, body='body', **headers):
+    return PooledResponse(code, 'OK',
+                          HTTPHeaders((name.replace('_', '-'), value)
+                                      for (name, value) in headers.items()),
+                          body)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache(1024 * 1024, max_object=4096,
+                                   stale_while_revalidate=5)
+        self.backend = Backend('a', 80)
+
+    def store(self, response, request_headers=None):
+        return self.cache.store('past', '/a.js',
+                                request_headers or HTTPHeaders(),
+                                self.backend, response, NOW)
+
+    def lifetime(self, response):
+        entry = self.store(response)
+        return entry and (entry.expires - NOW, entry.stale_until - NOW)
+
+    def test_parse_cache_control(self):
+        self.assertEqual(parse_cache_control('public, Max-Age="60",,'),
+                         {'public': None, 'max-age': '60'})
+        self.assertEqual(parse_cache_control(None), {})
+
+    def test_freshness(self):
+        self.assertEqual(self.lifetime(response(Cache_Control='max-age=60')),
+                         (60, 65))
+        self.assertEqual(self.lifetime(response(
+            Cache_Control='max-age=60, s-maxage=30')), (30, 35))
+        self.assertEqual(self.lifetime(response(
+            Cache_Control='max-age=60', Age='50')), (10, 15))
+        self.assertEqual(self.lifetime(response(
+            Date='Mon, 01 Jan 2018 00:00:00 GMT',
+            Expires='Mon, 01 Jan 2018 00:02:00 GMT')), (120, 125))
+
+    def test_staleness(self):
+        self.assertEqual(self.lifetime(response(
+            Cache_Control='max-age=60, stale-while-revalidate=30')),
+            (60, 90))
+        self.assertEqual(self.lifetime(response(
+            Cache_Control='max-age=60, must-revalidate')), (60, 60))
+
+    def test_uncacheable(self):
+        for uncacheable in (response(),
+                            response(500, Cache_Control='max-age=60'),
+                            response(Cache_Control='max-age=0'),
+                            response(Cache_Control='max-age=60', Age='60'),
+                            response(Cache_Control='max-age=60, private'),
+                            response(Cache_Control='no-store, max-age=60'),
+                            response(Cache_Control='no-cache, max-age=60'),
+                            response(Cache_Control='max-age=60',
+                                     Set_Cookie='a=b'),
+                            response(Cache_Control='max-age=60', Vary='*'),
+                            response(Date='Mon, 01 Jan 2018 00:02:00 GMT',
+                                     Expires='Mon, 01 Jan 2018 00:00:00 GMT'),
+                            response(body='x' * 4096,
+                                     Cache_Control='max-age=60')):
+            self.assertEqual(self.store(uncacheable), None,
+                             uncacheable.headers)
+        self.assertEqual(self.cache.stores, 0)
+
+    def test_vary(self):
+        vary = response(Cache_Control='max-age=60', Vary='accept-language')
+        en = HTTPHeaders({'Accept-Language': 'en'})
+        fr = HTTPHeaders({'Accept-Language': 'fr'})
+
+        entry = self.store(vary, en)
+        self.assertIs(self.cache.get(self.cache.key('past', '/a.js', en)),
+                      entry)
+        self.assertEqual(self.cache.get(self.cache.key('past', '/a.js', fr)),
+                         None)
+        self.assertEqual(self.cache.get(self.cache.key('present', '/a.js',
+                                                       en)), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
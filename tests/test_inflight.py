@@ -0,0 +1,85 @@
+"""
+Keeping track of the requests that are out at backends
+"""
+
+import unittest
+
+from exproxyment.inflight import InFlightTable
+from exproxyment.server import Backend
+
+
+class InFlightTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = InFlightTable()
+        self.a = Backend('a', 80)
+        self.b = Backend('b', 80)
+
+    def add(self, backend, version='past'):
+        return self.table.add('client', 'GET', '/', version, backend, 0)
+
+    def test_counts(self):
+        first = self.add(self.a)
+        second = self.add(self.a, 'present')
+        third = self.add(self.b)
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(self.table.outstanding(self.a), 2)
+        self.assertEqual(self.table.by_version, {'past': 2, 'present': 1})
+
+        self.table.remove(second)
+        self.assertEqual(self.table.outstanding(self.a), 1)
+        self.assertEqual(self.table.by_version, {'past': 2})
+
+        # removing it twice doesn't count it twice
+        self.table.remove(second)
+        self.assertEqual(len(self.table), 2)
+
+        self.table.remove(first)
+        self.table.remove(third)
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.outstanding(self.a), 0)
+        self.assertEqual(self.table.by_backend, {})
+        self.assertEqual(self.table.by_version, {})
+
+    def test_slots_are_reused(self):
+        first = self.add(self.a)
+        second = self.add(self.a)
+        self.table.remove(first)
+
+        third = self.add(self.b)
+        self.assertEqual(third.slot, first.slot)
+        self.assertNotEqual(third.id, first.id)
+
+        # a stale record for a reused slot leaves the new one alone
+        self.table.remove(first)
+        self.assertEqual(len(self.table), 2)
+
+        self.table.remove(second)
+        self.table.remove(third)
+        self.assertEqual(self.table.slots, [])
+        self.assertEqual(self.add(self.a).slot, 0)
+
+    def test_page(self):
+        requests = [self.add(self.a) for i in range(5)]
+        self.table.remove(requests[1])
+
+        page, offset = self.table.page(limit=2)
+        self.assertEqual(page, [requests[0], requests[2]])
+        page, offset = self.table.page(offset, limit=2)
+        self.assertEqual(page, [requests[3], requests[4]])
+        self.assertEqual(offset, None)
+
+    def test_sample(self):
+        self.assertEqual(self.table.sample(3), [])
+
+        requests = [self.add(self.a) for i in range(10)]
+        sample = self.table.sample(3)
+        self.assertTrue(1 <= len(sample) <= 3)
+        self.assertEqual(len(set(request.id for request in sample)),
+                         len(sample))
+        for request in sample:
+            self.assertIn(request, requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
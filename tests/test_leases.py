@@ -0,0 +1,61 @@
+"""
+Granting, renewing and expiring backend leases
+"""
+
+import unittest
+
+from exproxyment.leases import Leases
+from exproxyment.server import Backend
+
+
+class LeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.leases = Leases()
+        self.a = Backend('a', 80)
+        self.b = Backend('b', 80)
+
+    def test_expiry(self):
+        self.leases.grant(self.a, 10, 100)
+        self.leases.grant(self.b, 20, 100)
+        self.assertEqual(len(self.leases), 2)
+        self.assertEqual(self.leases.remaining(self.a, 104), 6)
+
+        self.assertEqual(self.leases.expired(109), [])
+        self.assertEqual(self.leases.expired(110), [self.a])
+        self.assertNotIn(self.a, self.leases)
+        self.assertEqual(self.leases.remaining(self.a, 110), None)
+
+        self.assertEqual(self.leases.remaining(self.b, 130), 0)
+        self.assertEqual(self.leases.expired(130), [self.b])
+        self.assertEqual(self.leases.to_json(), {'leased': 0, 'expired': 2})
+
+    def test_renewal(self):
+        self.leases.grant(self.a, 10, 100)
+        self.leases.grant(self.a, 10, 105)
+        self.assertEqual(self.leases.grants, 2)
+
+        # the first lease's entry is still around, but it's been superseded
+        self.assertEqual(self.leases.expired(110), [])
+        self.assertEqual(self.leases.expired(115), [self.a])
+
+    def test_revoke(self):
+        self.leases.grant(self.a, 10, 100)
+        self.leases.revoke(self.a)
+        self.leases.revoke(self.b)
+
+        self.assertEqual(len(self.leases), 0)
+        self.assertEqual(self.leases.expired(110), [])
+        self.assertEqual(self.leases.expired_count, 0)
+
+    def test_heap_compaction(self):
+        for now in range(1000):
+            self.leases.grant(self.a, 10, now)
+        self.leases.expired(0)
+
+        self.assertEqual(self.leases.heap, [(1009, self.a)])
+        self.assertEqual(self.leases.expired(1009), [self.a])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+The parts of limits.py that need an IOLoop but not a whole proxy. Run these
+(and the rest of tests/) from the top of the repository with:
+
+    python -m unittest discover -s tests
+"""
+
+import time
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from exproxyment.limits import Limiter, Limits
+
+
+class LimiterTest(AsyncTestCase):
+
+    @gen_test
+    def test_limit(self):
+        limiter = Limiter(1)
+
+        self.assertTrue((yield limiter.acquire(0)))
+        self.assertFalse((yield limiter.acquire(0)))
+        self.assertEqual(limiter.shed, 1)
+
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    @gen_test
+    def test_release_wakes_waiter(self):
+        limiter = Limiter(1)
+        yield limiter.acquire(0)
+
+        waiting = limiter.acquire(1.0)
+        self.io_loop.call_later(0.01, limiter.release)
+
+        self.assertTrue((yield waiting))
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(len(limiter.waiters), 0)
+
+    @gen_test
+    def test_queue_timeout(self):
+        limiter = Limiter(1)
+        yield limiter.acquire(0)
+
+        self.assertFalse((yield limiter.acquire(0.01)))
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(len(limiter.waiters), 0)
+        self.assertEqual(limiter.shed, 1)
+
+    @gen_test
+    def test_release_races_timeout(self):
+        limiter = Limiter(1)
+        yield limiter.acquire(0)
+
+        waiting = limiter.acquire(0.01)
+
+        # hold up the IOLoop until the timeout is due, and then have a slot
+        # released in the same iteration that it fires in, after it
+        time.sleep(0.05)
+        self.io_loop.call_later(0, limiter.release)
+
+        # the slot went to the waiter, so it has to have gotten it
+        self.assertTrue((yield waiting))
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(len(limiter.waiters), 0)
+
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    @gen_test
+    def test_raise_limit(self):
+        limiter = Limiter(1)
+        yield limiter.acquire(0)
+
+        waiting = limiter.acquire(1.0)
+        limiter.set_limit(2)
+
+        self.assertTrue((yield waiting))
+        self.assertEqual(limiter.active, 2)
+
+
+class LimitsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        limits = Limits(total_timeout=30, max_in_flight=100,
+                        routes={'/slow': {'total_timeout': 120}})
+        js = Limits.from_json(limits.to_json()).to_json()
+        self.assertEqual(js, limits.to_json())
+
+    def test_update_keeps_the_rest(self):
+        limits = Limits(connect_timeout=1.0, total_timeout=30,
+                        queue_timeout=1.0,
+                        routes={'/slow': {'total_timeout': 120}})
+
+        updated = limits.updated({'max_in_flight': 100})
+
+        self.assertEqual(updated.max_in_flight, 100)
+        self.assertEqual(updated.connect_timeout, 1.0)
+        self.assertEqual(updated.total_timeout, 30)
+        self.assertEqual(updated.queue_timeout, 1.0)
+        self.assertEqual(updated.timeouts_for('/slow/thing'),
+                         (1.0, 20.0, 120))
+
+        # and can take them off again
+        self.assertEqual(updated.updated({'max_in_flight': None})
+                         .max_in_flight, None)
+
+    def test_zero_in_flight_is_no_limit(self):
+        limits = Limits(max_in_flight=100, max_in_flight_per_backend=10)
+        updated = limits.updated({'max_in_flight': 0,
+                                  'max_in_flight_per_backend': 0})
+        self.assertEqual(updated.max_in_flight, None)
+        self.assertEqual(updated.max_in_flight_per_backend, None)
+
+    def test_update_replaces_routes(self):
+        limits = Limits(routes={'/slow': {'total_timeout': 120}})
+        updated = limits.updated({'routes': {'/fast': {'total_timeout': 1}}})
+        self.assertEqual(updated.to_json()['routes'],
+                         {'/fast': {'total_timeout': 1}})
+
+    def test_bad(self):
+        limits = Limits()
+
+        for bad in ([], {'max_in_flight': -5}, {'queue_timeout': True},
+                    {'connect_timeout': '1'}, {'nonsense': 1},
+                    {'routes': []}, {'routes': {'/': {'max_in_flight': 1}}},
+                    {'routes': {'/': {'total_timeout': -1}}}):
+            self.assertRaises(ValueError, limits.updated, bad)
+            self.assertRaises(ValueError, Limits.from_json, bad)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Saving a ServerState to a file and reading it back
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tornado.testing import AsyncTestCase
+
+from exproxyment.persist import StateSaver, read_state
+from exproxyment.server import Backend, ServerState
+
+
+class StateSaverTest(AsyncTestCase):
+
+    def setUp(self):
+        super(StateSaverTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.json')
+
+        self.state = ServerState()
+        self.backend = Backend('localhost', 17007)
+        self.state.add_backend(self.backend)
+        self.saver = StateSaver(self.state, self.path, ioloop=self.io_loop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(StateSaverTest, self).tearDown()
+
+    def lease(self):
+        entry, = read_state(self.path)['backends']
+        return entry['lease']
+
+    def test_only_saves_changes(self):
+        self.saver.save()
+        self.saver.save()
+        self.assertEqual(self.saver.saves, 1)
+
+        self.state.add_backend(Backend('localhost', 17008))
+        self.saver.save()
+        self.assertEqual(self.saver.saves, 2)
+
+    def test_saves_renewed_leases(self):
+        now = self.io_loop.time()
+        self.state.leases.grant(self.backend, 3, now - 2)
+        self.saver.save()
+        self.assertLess(self.lease(), 1.5)
+
+        # a heartbeat doesn't change where requests go, but it's still news
+        self.state.leases.grant(self.backend, 3, now)
+        self.saver.save()
+        self.assertEqual(self.saver.saves, 2)
+        self.assertGreater(self.lease(), 2.5)
+
+    def test_unreadable(self):
+        self.assertEqual(read_state(self.path), None)
+
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertEqual(read_state(self.path), None)
+
+        with open(self.path, 'w') as f:
+            f.write('{"backends": {}}')
+        self.assertEqual(read_state(self.path), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Routing from RoutingTables, and what a new table keeps from the one before
+"""
+
+import unittest
+
+from exproxyment.balancing import RandomBalancer
+from exproxyment.routing import RoutingTable
+from exproxyment.server import Backend
+
+
+class RoutingTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = Backend('a', 80)
+        self.b = Backend('b', 80)
+        self.c = Backend('c', 80)
+        self.balancer = RandomBalancer(lambda backend: 0)
+
+        self.table = RoutingTable(1, {}, {'past': (self.a, self.b),
+                                          'present': (self.c,)},
+                                  {'past': 1, 'present': 1})
+        # build the derived tables, as routing a request would
+        self.table.choose_version()
+        self.table.hash_version('user')
+        for version in ('past', 'present'):
+            self.table.backend_for(self.balancer, version, key='user')
+
+    def test_routing(self):
+        self.assertTrue(self.table.healthy())
+        self.assertTrue(self.table.healthy('past'))
+        self.assertFalse(self.table.healthy('future'))
+
+        self.assertEqual(self.table.backend_for(self.balancer, 'future'),
+                         None)
+        self.assertEqual(self.table.backend_for(self.balancer, 'present'),
+                         self.c)
+        self.assertEqual(self.table.backend_for(self.balancer, 'past',
+                                                exclude=set([self.a])), self.b)
+        self.assertEqual(self.table.backend_for(self.balancer, 'present',
+                                                exclude=set([self.c])), None)
+
+        self.assertEqual(self.table.hash_version('user'),
+                         self.table.hash_version('user'))
+
+    def test_unweighted_version(self):
+        table = RoutingTable(1, {}, {'past': (self.a,), 'present': (self.c,)},
+                             {'past': 1})
+        self.assertEqual(set(table.choose_version() for i in range(20)),
+                         set(['past']))
+
+    def test_reuses_unchanged(self):
+        # a backend in 'present' changed state without leaving it
+        table = RoutingTable(2, {}, self.table.version_backends,
+                             self.table.weights, previous=self.table,
+                             changed_versions=set(['present']))
+
+        self.assertIs(table.version_choice, self.table.version_choice)
+        self.assertIs(table.version_ring, self.table.version_ring)
+        self.assertIs(table.backend_rings['past'],
+                      self.table.backend_rings['past'])
+        self.assertNotIn('present', table.backend_rings)
+
+    def test_rebuilds_changed(self):
+        weights = RoutingTable(2, {}, self.table.version_backends,
+                               {'past': 1, 'present': 2},
+                               previous=self.table)
+        self.assertEqual(weights.version_choice, None)
+        self.assertEqual(weights.version_ring, None)
+        self.assertEqual(len(weights.backend_rings), 2)
+
+        versions = RoutingTable(2, {}, {'past': (self.a, self.b)},
+                                self.table.weights, previous=self.table,
+                                changed_versions=set(['present']))
+        self.assertEqual(versions.version_choice, None)
+        self.assertEqual(versions.version_ring, None)
+        self.assertEqual(versions.choose_version(), 'past')
+        self.assertEqual(versions.hash_version('user'), 'past')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+The parts of server.py that can be tried against a ServerState of their own
+or a couple of tiny backends, without starting a whole proxy
+"""
+
+import json
+import unittest
+
+import tornado.gen
+import tornado.httpserver
+import tornado.web
+from tornado.testing import AsyncTestCase, bind_unused_port, gen_test
+
+from exproxyment import server
+from exproxyment.server import Backend, BackendState, CheckSchedule
+from exproxyment.server import HealthDaemon, ServerState
+
+
+class EjectionTest(AsyncTestCase):
+
+    def setUp(self):
+        super(EjectionTest, self).setUp()
+        self.a = Backend('a', 80)
+        self.b = Backend('b', 80)
+        self.state = ServerState(backends={
+            self.a: BackendState(True, 'past'),
+            self.b: BackendState(True, 'past'),
+        })
+
+    def routable(self):
+        return sorted(self.state.routing.version_backends.get('past', ()))
+
+    @gen_test
+    def test_eject_and_readmit(self):
+        self.assertTrue(self.state.eject(self.a, 0.05))
+        self.assertEqual(self.routable(), [self.b])
+
+        # comes back on its own, without waiting for a health check
+        yield tornado.gen.sleep(0.1)
+        self.assertNotIn(self.a, self.state.ejected)
+        self.assertEqual(self.routable(), [self.a, self.b])
+
+    @gen_test
+    def test_max_ejected(self):
+        self.assertTrue(self.state.eject(self.a, 1.0))
+        self.assertFalse(self.state.eject(self.b, 1.0))
+        self.assertEqual(self.routable(), [self.b])
+
+    @gen_test
+    def test_unhealthy_stays_out(self):
+        self.state.eject(self.a, 0.05)
+        self.state.set_backend_state(self.a, BackendState(False, None))
+
+        yield tornado.gen.sleep(0.1)
+        self.assertNotIn(self.a, self.state.ejected)
+        self.assertEqual(self.routable(), [self.b])
+
+    @gen_test
+    def test_removed_while_ejected(self):
+        self.state.eject(self.a, 0.05)
+        self.state.remove_backend(self.a)
+
+        yield tornado.gen.sleep(0.1)
+        self.assertNotIn(self.a, self.state.backends)
+        self.assertEqual(self.routable(), [self.b])
+
+
+class SameEtagHealth(tornado.web.RequestHandler):
+
+    """
+    A /health whose Etag doesn't say anything about the version in it
+    """
+
+    def initialize(self, version):
+        self.version = version
+
+    def compute_etag(self):
+        return None
+
+    def get(self):
+        self.set_header('Etag', '"same"')
+        if self.request.headers.get('If-None-Match') == '"same"':
+            self.set_status(304)
+            return
+
+        self.write(json.dumps({'healthy': True, 'version': self.version}))
+
+
+class HealthCheckTest(AsyncTestCase):
+
+    def setUp(self):
+        super(HealthCheckTest, self).setUp()
+
+        self.saved_state = server.server_state
+        server.server_state = ServerState()
+
+        self.servers = []
+        self.backends = []
+        for version in ('past', 'present'):
+            sock, port = bind_unused_port()
+            app = tornado.web.Application([
+                (r'/health', SameEtagHealth, {'version': version}),
+            ])
+            http_server = tornado.httpserver.HTTPServer(app)
+            http_server.add_sockets([sock])
+            self.servers.append(http_server)
+
+            backend = Backend('127.0.0.1', port)
+            server.server_state.add_backend(backend)
+            self.backends.append(backend)
+
+        self.daemon = HealthDaemon(self.io_loop)
+
+    def tearDown(self):
+        for http_server in self.servers:
+            http_server.stop()
+        server.server_state = self.saved_state
+        super(HealthCheckTest, self).tearDown()
+
+    def probes(self, backend, kind):
+        return getattr(server.server_state.metrics.health[backend], kind)
+
+    @gen_test
+    def test_etags_are_per_backend(self):
+        past, present = self.backends
+        schedules = [CheckSchedule(0), CheckSchedule(0)]
+
+        for i in range(2):
+            for backend, schedule in zip(self.backends, schedules):
+                yield self.daemon.health_check(backend, schedule)
+
+            self.assertEqual(server.server_state.backends[past],
+                             BackendState(True, 'past'))
+            self.assertEqual(server.server_state.backends[present],
+                             BackendState(True, 'present'))
+
+        # the second round of checks didn't have to parse anything
+        for backend in self.backends:
+            self.assertEqual(self.probes(backend, 'full'), 1)
+            self.assertEqual(self.probes(backend, 'cached'), 1)
+
+    @gen_test
+    def test_dead_backend(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        dead = Backend('127.0.0.1', port)
+        server.server_state.add_backend(dead)
+
+        yield self.daemon.health_check(dead, CheckSchedule(0))
+        self.assertEqual(server.server_state.backends[dead],
+                         BackendState(False, None))
+        self.assertEqual(self.probes(dead, 'full'), 1)
+        self.assertEqual(self.probes(dead, 'cached'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Which requests share fetches, and which responses they can share
+"""
+
+import unittest
+
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+from exproxyment.pool import PooledResponse
+from exproxyment.singleflight import SingleFlight
+
+
+def response(**headers):
+    return PooledResponse(200, 'OK',
+                          HTTPHeaders((name.replace('_', '-'), value)
+                                      for (name, value) in headers.items()),
+                          'body')
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_prefix_for(self):
+        flights = SingleFlight(['/static', '/static/big'])
+
+        def prefix_for(method, uri, **headers):
+            request = HTTPServerRequest(method, uri,
+                                        headers=HTTPHeaders(headers))
+            return flights.prefix_for(request)
+
+        self.assertEqual(prefix_for('GET', '/static/a.js'), '/static')
+        self.assertEqual(prefix_for('HEAD', '/static/big/b'), '/static/big')
+        self.assertEqual(prefix_for('GET', '/api'), None)
+        self.assertEqual(prefix_for('POST', '/static/a.js'), None)
+        self.assertEqual(prefix_for('GET', '/static/a.js',
+                                    Authorization='Basic Zm9v'), None)
+
+    def test_shareable(self):
+        shareable = SingleFlight.shareable
+        en = HTTPHeaders({'Accept-Language': 'en'})
+        fr = HTTPHeaders({'Accept-Language': 'fr'})
+
+        self.assertTrue(shareable(response(), en, fr))
+        self.assertTrue(shareable(response(Cache_Control='public'), en, fr))
+
+        self.assertFalse(shareable(response(Set_Cookie='a=b'), en, en))
+        self.assertFalse(shareable(response(Cache_Control='private'), en, en))
+        self.assertFalse(shareable(response(Cache_Control='max-age=0, '
+                                            'no-store'), en, en))
+
+        vary = response(Vary='accept-language, Accept-Encoding')
+        self.assertTrue(shareable(vary, en, HTTPHeaders(en)))
+        self.assertFalse(shareable(vary, en, fr))
+        self.assertFalse(shareable(vary, en, HTTPHeaders()))
+        self.assertFalse(shareable(response(Vary='*'), en, en))
+
+    def test_waiters(self):
+        flights = SingleFlight(['/'])
+        key = ('past', 'GET', '/')
+
+        self.assertEqual(flights.wait(key), None)
+        flights.start(key)
+        pending = flights.wait(key)
+
+        headers = HTTPHeaders()
+        flights.finish(key, 'result', headers)
+        self.assertEqual(pending.result(), ('result', headers))
+        self.assertEqual(flights.wait(key), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
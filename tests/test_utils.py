@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+The pure logic in utils.py
+"""
+
+import unittest
+
+from exproxyment.utils import HashRing, RetryBudget, SlidingCounts
+from exproxyment.utils import VersionCookies, WeightedChoice
+
+
+class WeightedChoiceTest(unittest.TestCase):
+
+    def test_skips_unweighted(self):
+        choice = WeightedChoice([('a', 1), ('b', 0), ('c', -1), ('d', 3)])
+        self.assertEqual(len(choice), 2)
+        self.assertEqual(choice.total, 4)
+        self.assertEqual(WeightedChoice([('a', 0)]).choose(), None)
+        self.assertEqual(WeightedChoice([]).choose(), None)
+
+    def test_boundaries(self):
+        choice = WeightedChoice([('a', 1), ('b', 3)])
+        self.assertEqual(choice.choose(0.0), 'a')
+        self.assertEqual(choice.choose(0.2499), 'a')
+        self.assertEqual(choice.choose(0.25), 'b')
+        self.assertEqual(choice.choose(0.9999), 'b')
+
+        # a point of exactly 1 shouldn't run off the end
+        self.assertEqual(choice.choose(1.0), 'b')
+
+    def test_proportions(self):
+        choice = WeightedChoice([('a', 1), ('b', 3)])
+        picks = [choice.choose(i / 1000.0) for i in range(1000)]
+        self.assertEqual(picks.count('a'), 250)
+        self.assertEqual(picks.count('b'), 750)
+
+
+class HashRingTest(unittest.TestCase):
+
+    keys = ['key-%d' % i for i in range(2000)]
+
+    def owners(self, ring):
+        return dict((key, ring.get(key)) for key in self.keys)
+
+    def test_empty(self):
+        self.assertEqual(HashRing([]).get('key'), None)
+        self.assertEqual(HashRing([('a', 0)]).get('key'), None)
+
+    def test_stable(self):
+        weighted = [('a', 1), ('b', 1), ('c', 1)]
+        self.assertEqual(self.owners(HashRing(weighted)),
+                         self.owners(HashRing(reversed(weighted))))
+
+    def test_removing_only_moves_its_keys(self):
+        before = self.owners(HashRing([('a', 1), ('b', 1), ('c', 1),
+                                       ('d', 1)]))
+        after = self.owners(HashRing([('a', 1), ('b', 1), ('c', 1)]))
+
+        for key in self.keys:
+            if before[key] != 'd':
+                self.assertEqual(after[key], before[key], key)
+
+    def test_weights(self):
+        ring = HashRing([('a', 1), ('b', 3)])
+        self.assertEqual(len(ring), 320)
+
+        shares = self.owners(ring).values()
+        self.assertTrue(0.15 < shares.count('a') / 2000.0 < 0.35)
+
+    def test_unicode_hashes_as_utf8(self):
+        text = HashRing([(u'caf\xe9', 1), (u'past', 1)])
+        encoded = HashRing([('caf\xc3\xa9', 1), ('past', 1)])
+        self.assertEqual(text.points, encoded.points)
+
+        for key in (u'\u2603', u'caf\xe9', u'plain'):
+            self.assertEqual(text.get(key), text.get(key.encode('utf-8')))
+
+
+class SlidingCountsTest(unittest.TestCase):
+
+    def test_sliding(self):
+        counts = SlidingCounts(10.0, 100.0)
+        counts.add(100.0, 0, 4)
+        counts.add(105.0, 1)
+        self.assertEqual(counts.totals(105.0), [4, 1])
+
+        # halfway through the next window, half of the last one still counts
+        counts.add(115.0, 0, 2)
+        self.assertEqual(counts.totals(115.0), [4.0, 0.5])
+
+        self.assertEqual(counts.totals(120.0), [2.0, 0.0])
+        self.assertEqual(counts.totals(150.0), [0.0, 0.0])
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_ratio(self):
+        budget = RetryBudget(ratio=0.1, min_per_second=0.0)
+        for i in range(100):
+            budget.request(1.0)
+
+        self.assertEqual([budget.retry(1.0) for i in range(11)],
+                         [True] * 10 + [False])
+
+        # the budget comes back as the retries slide out of the window
+        self.assertFalse(budget.retry(15.0))
+        for i in range(100):
+            budget.request(15.0)
+        self.assertTrue(budget.retry(15.0))
+
+    def test_minimum(self):
+        budget = RetryBudget(ratio=0.1, min_per_second=1.0, window=5.0)
+        self.assertEqual([budget.retry(1.0) for i in range(6)],
+                         [True] * 5 + [False])
+
+
+class VersionCookiesTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for compact in (False, True):
+            cookies = VersionCookies(compact=compact)
+            for version in (u'present', u'caf\xe9', u'a b;c'):
+                value = cookies.encode(version)
+                # it has to be something that can go in a Set-Cookie
+                value.encode('ascii')
+                self.assertEqual(VersionCookies().decode(str(value)),
+                                 version)
+
+    def test_both_formats(self):
+        cookies = VersionCookies()
+        self.assertEqual(cookies.decode('v1:past'), u'past')
+        self.assertEqual(cookies.decode('v1:caf%C3%A9'), u'caf\xe9')
+        self.assertEqual(cookies.decode('%7B%22version%22%3A%20%22past%22%7D'),
+                         u'past')
+        self.assertEqual(cookies.decode('{"version": "caf\\u00e9"}'),
+                         u'caf\xe9')
+
+    def test_malformed(self):
+        cookies = VersionCookies(max_length=20)
+        for value in ('', 'v1:', 'v1:%FF', '%7Bnope', '%5B%5D', '"past"',
+                      '{"version": 5}', '{"version": ""}', '{"other": 1}',
+                      'v1:' + 'x' * 20):
+            self.assertEqual(cookies.decode(value), None, value)
+
+        # and again, from what it remembers
+        self.assertEqual(cookies.decode('%7Bnope'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()